@@ -0,0 +1,95 @@
+"""
+Compare bytes on disk and read latency of preprocessed single channel images saved as ome-tiffs
+with the chunked, compressed volumes of brightfield2fish.data.chunked, for a few codecs.
+Reads are timed for whole volumes and for random training patches.
+
+    $ python benchmarks/benchmark_chunked.py
+"""
+
+import os
+import time
+import tempfile
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from brightfield2fish.data.dataset import read_zyx, read_zyx_crop
+from brightfield2fish.data.preprocess_images import write_chunked_volume, write_ome_tiff
+from brightfield2fish.data.utils import RandomCrop
+
+
+def fake_image(shape=(50, 624, 924), seed=0):
+    r"""
+    A smooth, noisy uint16 volume spanning the full range, roughly like a normalized image.
+
+    Args:
+        shape (tuple): z,y,x shape
+        seed (int): random seed
+    Returns:
+        (numpy.ndarray): uint16 volume
+    """
+    rng = np.random.RandomState(seed)
+    im = gaussian_filter(rng.normal(size=shape), sigma=(1, 4, 4))
+    im += 0.05 * im.std() * rng.normal(size=shape)
+    im = (im - im.min()) / (im.max() - im.min())
+    return (im * (2 ** 16 - 1)).astype(np.uint16)
+
+
+def time_reads(path, slices, repeats=3):
+    r"""
+    Time whole volume reads and patch reads of one file.
+
+    Args:
+        path (str): image path
+        slices (list): tuples of z,y,x slices of the patches to read
+        repeats (int): number of whole volume reads, the fastest is reported
+    Returns:
+        (tuple): (seconds per whole volume read, seconds per patch read)
+    """
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        read_zyx(path)
+        times += [time.perf_counter() - t0]
+
+    t0 = time.perf_counter()
+    for s in slices:
+        read_zyx_crop(path, s)
+    return min(times), (time.perf_counter() - t0) / len(slices)
+
+
+if __name__ == "__main__":
+    patch = (32, 64, 64)
+    n_patches = 100
+
+    im = fake_image()
+    slices = [RandomCrop(im, patch).slices for _ in range(n_patches)]
+    pixel_size = (0.108, 0.108, 0.29)
+
+    cases = {"ome-tiff": (write_ome_tiff, ".tif", {})}
+    for codec in ("none", "zlib", "lzma", "bz2"):
+        cases["chunked {}".format(codec)] = (
+            write_chunked_volume,
+            ".cvol",
+            {"chunks": patch, "codec": codec},
+        )
+
+    print("input: {} {}, {:.0f} MB".format(im.shape, im.dtype, im.nbytes / 2 ** 20))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, (write, ext, kwargs) in cases.items():
+            path = os.path.join(tmp_dir, "image" + ext)
+            t0 = time.perf_counter()
+            write(path, im, "Brightfield", pixel_size, **kwargs)
+            t_write = time.perf_counter() - t0
+            size = os.path.getsize(path)
+            t_full, t_patch = time_reads(path, slices)
+            print(
+                "{:16s} {:7.1f} MB {:6.2f}x  write {:6.2f} s  read {:6.3f} s  {} patch {:7.2f} ms".format(
+                    name,
+                    size / 2 ** 20,
+                    im.nbytes / size,
+                    t_write,
+                    t_full,
+                    patch,
+                    1000 * t_patch,
+                )
+            )
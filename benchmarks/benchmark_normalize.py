@@ -0,0 +1,76 @@
+"""
+Compare peak memory and wall time of the float64 cast / normalize / clip chain used by the datasets
+with the fused, in place float32 version, brightfield2fish.data.utils.normalize_into.
+
+    $ python benchmarks/benchmark_normalize.py
+"""
+
+import time
+import tracemalloc
+import numpy as np
+
+from brightfield2fish.data.utils import normalize, normalize_into
+
+
+def chain_float64(im, content="Brightfield", clip_percentiles=None):
+    out = normalize(im.astype(np.float64), content=content).astype(np.float32)
+    if clip_percentiles is not None:
+        out = np.clip(
+            out,
+            a_min=np.percentile(out, clip_percentiles[0]),
+            a_max=np.percentile(out, clip_percentiles[1]),
+        )
+        out = normalize(out, content=content)
+    return out
+
+
+def fused_float32(im, content="Brightfield", clip_percentiles=None):
+    return normalize_into(im, content=content, clip_percentiles=clip_percentiles)
+
+
+def measure(fn, *args, repeats=3, **kwargs):
+    r"""
+    Time a function and record its peak traced memory allocation.
+
+    Args:
+        fn (callable): function to benchmark
+        repeats (int): number of timed calls, the fastest is reported
+    Returns:
+        (tuple): (seconds, peak MB)
+    """
+    tracemalloc.start()
+    fn(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn(*args, **kwargs)
+        times += [time.perf_counter() - t0]
+    return min(times), peak / 2 ** 20
+
+
+if __name__ == "__main__":
+    im = np.random.randint(
+        low=0, high=2 ** 16 - 1, size=(50, 624, 924), dtype=np.uint16
+    )
+
+    cases = {
+        "target (min/max)": {"content": "Target"},
+        "brightfield (mean/std)": {"content": "Brightfield"},
+        "brightfield (clip + renormalize)": {
+            "content": "Brightfield",
+            "clip_percentiles": [0.01, 99.99],
+        },
+    }
+
+    print("input: {} {}, {:.0f} MB".format(im.shape, im.dtype, im.nbytes / 2 ** 20))
+    for name, kwargs in cases.items():
+        for fn in (chain_float64, fused_float32):
+            t, peak = measure(fn, im, **kwargs)
+            print(
+                "{:34s} {:14s} {:7.3f} s {:8.0f} MB peak".format(
+                    name, fn.__name__, t, peak
+                )
+            )
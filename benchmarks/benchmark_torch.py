@@ -0,0 +1,80 @@
+"""
+Compare wall time of the numpy prep_fish and normalize with their torch versions, brightfield2fish.data.utils.prep_fish_torch and normalize_torch,
+over a range of torch intra-op thread counts (torch.set_num_threads). The numpy versions are single threaded, and are timed once.
+
+    $ python benchmarks/benchmark_torch.py 1 2 4 8
+"""
+
+import os
+import sys
+import time
+import numpy as np
+import torch
+from aicsimageio import AICSImage
+
+from brightfield2fish.data.utils import (
+    normalize,
+    normalize_torch,
+    prep_fish,
+    prep_fish_torch,
+    to_tensor,
+)
+
+
+def measure(fn, *args, repeats=3, **kwargs):
+    r"""
+    Time a function.
+
+    Args:
+        fn (callable): function to benchmark
+        repeats (int): number of timed calls, the fastest is reported
+    Returns:
+        (float): seconds
+    """
+    fn(*args, **kwargs)
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn(*args, **kwargs)
+        times += [time.perf_counter() - t0]
+    return min(times)
+
+
+if __name__ == "__main__":
+    threads = [int(n) for n in sys.argv[1:]] or [1, 2, 4, 8]
+
+    raw = np.random.randint(
+        low=0, high=2 ** 16 - 1, size=(50, 624, 924), dtype=np.uint16
+    )
+    image = AICSImage(raw[np.newaxis, np.newaxis], dims="TCZYX")
+    im = raw.astype(np.float32)
+    raw_t, im_t = to_tensor(raw), to_tensor(im)
+
+    print(
+        "input: {} {}, {} cpus".format(
+            raw.shape, raw.dtype, len(os.sched_getaffinity(0))
+        )
+    )
+    print(
+        "{:28s} {:>10s} {:7.3f} s".format(
+            "prep_fish", "numpy", measure(prep_fish, image, channel=0)
+        )
+    )
+    print(
+        "{:28s} {:>10s} {:7.3f} s".format(
+            "normalize (float32)", "numpy", measure(normalize, im)
+        )
+    )
+    for n in threads:
+        torch.set_num_threads(n)
+        name = "{} threads".format(n)
+        print(
+            "{:28s} {:>10s} {:7.3f} s".format(
+                "prep_fish_torch", name, measure(prep_fish_torch, raw_t)
+            )
+        )
+        print(
+            "{:28s} {:>10s} {:7.3f} s".format(
+                "normalize_torch (float32)", name, measure(normalize_torch, im_t)
+            )
+        )
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run the preprocessing pipeline: index the czis, normalize the images, match the fish segmentations, and split the dataset.
+Stages whose inputs and parameters haven't changed since their last successful run are skipped, and independent stages run concurrently.
+
+    $ brightfield2fish                     # bring every stage up to date
+    $ brightfield2fish split --dry-run     # what would run to bring the splits up to date
+    $ brightfield2fish --force csv         # re-list the czi directories, e.g. after new images were acquired
+"""
+
+import os
+import sys
+import argparse
+
+from brightfield2fish.data.pipeline import Stage, run_pipeline
+from brightfield2fish.data.preprocess_csv import preprocess_csv
+from brightfield2fish.data.preprocess_fish_segs import (
+    FISH_SEG_CSV,
+    SEG_EXPORT_CSV,
+    preprocess_fish_segs,
+)
+from brightfield2fish.data.preprocess_images import WRITERS, preprocess_dataset
+from brightfield2fish.data.split_data import split_and_save
+
+STAGES = ["csv", "images", "fish_segs", "split"]
+SPLITS = {"train": 0.7, "valid": 0.15, "test": 0.15}
+
+
+def make_stages(
+    data_dir="data",
+    preprocessed_dir="/allen/aics/modeling/data/brightfield2fish/preprocessed",
+    fish_seg_dir="/allen/aics/microscopy/Data/fish/mip_with_seg",
+    split_dir="data/splits",
+    writer="ome-tiff",
+    split_col="file",
+    seed=0,
+    table_ext=".csv",
+    max_workers=None,
+    block_z=None,
+):
+    r"""
+    The preprocessing stages, with their inputs, outputs and parameters.
+
+    Args:
+        data_dir (str): directory with data.csv, where the czi and channel csvs are written
+        preprocessed_dir (str): directory for the normalized images and their csv
+        fish_seg_dir (str): directory with the fish segmentations and their csvs
+        split_dir (str): directory for the split csvs
+        writer (str): output format of the normalized images, one of brightfield2fish.data.preprocess_images.WRITERS
+        split_col (str or list): column(s) whose values are kept together when splitting, see brightfield2fish.data.split_data.group_keys
+        seed (int): salt of the hash used for splitting
+        table_ext (str): extension, and so format, of the tables written by the stages, e.g. ".csv" or ".parquet", see brightfield2fish.data.tables
+        max_workers (int or None): number of processes (or threads) used within a stage
+        block_z (int or None): if not None, normalize images this many z slices at a time, see brightfield2fish.data.preprocess_images.preprocess_file
+    Returns:
+        (list): list of brightfield2fish.data.pipeline.Stage
+    """
+    images_csv = os.path.join(data_dir, "data_by_images" + table_ext)
+    channels_csv = os.path.join(data_dir, "data_by_channels" + table_ext)
+    normalized_csv = os.path.join(
+        preprocessed_dir, "data_by_images_normalized" + table_ext
+    )
+    fish_segs_csv = os.path.join(
+        data_dir, "data_by_images_with_fish_segmentations" + table_ext
+    )
+
+    return [
+        Stage(
+            "csv",
+            preprocess_csv,
+            inputs=[os.path.join(data_dir, "data.csv")],
+            outputs=[images_csv, channels_csv],
+            params={
+                "data_csv": os.path.join(data_dir, "data.csv"),
+                "images_csv": images_csv,
+                "channels_csv": channels_csv,
+                "listing_cache": os.path.join(data_dir, "czi_listings.json"),
+                "metadata_cache": os.path.join(data_dir, "czi_metadata.json"),
+            },
+            options={"max_workers": max_workers},
+        ),
+        Stage(
+            "images",
+            preprocess_dataset,
+            inputs=[channels_csv],
+            outputs=[normalized_csv, os.path.join(preprocessed_dir, "manifest.jsonl")],
+            params={
+                "channels_csv": channels_csv,
+                "preprocessed_dir": preprocessed_dir,
+                "out_csv": normalized_csv,
+                "writer": writer,
+            },
+            options={"max_workers": max_workers, "block_z": block_z},
+        ),
+        Stage(
+            "fish_segs",
+            preprocess_fish_segs,
+            inputs=[
+                os.path.join(fish_seg_dir, FISH_SEG_CSV),
+                os.path.join(fish_seg_dir, SEG_EXPORT_CSV),
+                images_csv,
+            ],
+            outputs=[fish_segs_csv],
+            params={
+                "par_dir": fish_seg_dir,
+                "images_csv": images_csv,
+                "out_csv": fish_segs_csv,
+            },
+            options={"max_workers": max_workers},
+        ),
+        Stage(
+            "split",
+            split_and_save,
+            inputs=[normalized_csv],
+            outputs=[os.path.join(split_dir, "splits.json")]
+            + [os.path.join(split_dir, k + table_ext) for k in SPLITS],
+            params={
+                "csv_name": os.path.basename(normalized_csv),
+                "csv_dir": preprocessed_dir,
+                "split_col": split_col,
+                "save_dir": split_dir,
+                "splits": SPLITS,
+                "seed": seed,
+                "ext": table_ext,
+            },
+        ),
+    ]
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="brightfield2fish",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        metavar="stage",
+        help="stages to bring up to date, along with the stages they depend on, any of {} (default: all)".format(
+            ", ".join(STAGES)
+        ),
+    )
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument(
+        "--preprocessed-dir",
+        default="/allen/aics/modeling/data/brightfield2fish/preprocessed",
+    )
+    parser.add_argument(
+        "--fish-seg-dir", default="/allen/aics/microscopy/Data/fish/mip_with_seg"
+    )
+    parser.add_argument("--split-dir", default=os.path.join("data", "splits"))
+    parser.add_argument("--writer", default="ome-tiff", choices=sorted(WRITERS))
+    parser.add_argument(
+        "--split-by",
+        nargs="+",
+        default=["file"],
+        help="columns whose values are kept together in one split, e.g. plate well",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="salt of the split hash")
+    parser.add_argument(
+        "--table-ext",
+        default=".csv",
+        choices=[".csv", ".parquet", ".feather"],
+        help="format of the tables written by the stages",
+    )
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=None,
+        help="processes (or threads) used within a stage",
+    )
+    parser.add_argument(
+        "--block-z",
+        type=int,
+        default=None,
+        help="normalize images this many z slices at a time, to bound memory on large volumes",
+    )
+    parser.add_argument(
+        "--stage-workers", type=int, default=None, help="stages run at once"
+    )
+    parser.add_argument(
+        "--state",
+        default=None,
+        help="pipeline state file (default: <data-dir>/pipeline_state.json)",
+    )
+    parser.add_argument(
+        "--force",
+        action="append",
+        default=[],
+        choices=STAGES,
+        help="stage to run even if it is up to date, can be repeated",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+
+    args = parser.parse_args(argv)
+    unknown = [t for t in args.targets if t not in STAGES]
+    if len(unknown) > 0:
+        parser.error("unknown stages {}, choose from {}".format(unknown, STAGES))
+    return args
+
+
+def main(argv=None):
+    args = get_args(argv)
+    stages = make_stages(
+        data_dir=args.data_dir,
+        preprocessed_dir=args.preprocessed_dir,
+        fish_seg_dir=args.fish_seg_dir,
+        split_dir=args.split_dir,
+        writer=args.writer,
+        split_col=args.split_by[0] if len(args.split_by) == 1 else args.split_by,
+        seed=args.seed,
+        table_ext=args.table_ext,
+        max_workers=args.max_workers,
+        block_z=args.block_z,
+    )
+    status = run_pipeline(
+        stages,
+        args.state or os.path.join(args.data_dir, "pipeline_state.json"),
+        targets=args.targets or None,
+        force=args.force,
+        max_workers=args.stage_workers,
+        dry_run=args.dry_run,
+    )
+
+    for name in STAGES:
+        if name in status:
+            print("{:10s} {}".format(name, status[name]["status"]))
+            if status[name]["error"] is not None:
+                print(status[name]["error"], file=sys.stderr)
+
+    return int(any(s["status"] == "failed" for s in status.values()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""
+Shared memory cache of decoded image volumes, so that DataLoader workers don't re-read the same files from disk.
+"""
+
+import sys
+import uuid
+import weakref
+import multiprocessing
+import numpy as np
+
+
+def _open_block(name, create=False, size=0):
+    # blocks belong to the cache, not to the process that happens to create or attach them. Before python 3.13
+    # every process registers the blocks it touches with its resource tracker, which unlinks them when e.g. a DataLoader worker exits
+    from multiprocessing import shared_memory, resource_tracker
+
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(
+            name=name, create=create, size=size, track=False
+        )
+    shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def _unlink_all(index, lock):
+    try:
+        with lock:
+            for entry in index.values():
+                try:
+                    block = _open_block(entry["name"])
+                    block.close()
+                    block.unlink()
+                except FileNotFoundError:
+                    pass
+            index.clear()
+    except Exception:
+        # the manager may already be gone at interpreter exit
+        pass
+
+
+class SharedVolumeCache:
+    r"""
+    LRU cache of decoded numpy volumes, held in shared memory and visible to every process (e.g. DataLoader worker) that holds a reference to it.
+    The index and counters live in a multiprocessing.Manager, the pixel data in named shared memory blocks.
+    Blocks outlive the processes that create them (e.g. non persistent DataLoader workers), and are freed by `clear`,
+    or when the cache object of the process that constructed it is garbage collected.
+    Requires python >= 3.8 (multiprocessing.shared_memory).
+
+    Args:
+        max_bytes (int): byte budget for cached pixel data, least recently used volumes are evicted beyond this
+        manager (multiprocessing.managers.SyncManager or None): manager to hold the shared index, if None, start a new one
+
+    Example:
+        >>> cache = SharedVolumeCache(max_bytes=2 ** 34)
+        >>> dset = FishDataframeDatasetTIFF(df, cache=cache)
+        >>> loader = torch.utils.data.DataLoader(dset, num_workers=8)
+        >>> cache.stats()
+        {'hits': 0, 'misses': 0, 'evictions': 0, 'volumes': 0, 'bytes': 0}
+    """
+
+    def __init__(self, max_bytes=2 ** 33, manager=None):
+        if manager is None:
+            manager = multiprocessing.Manager()
+        self._manager = manager
+        self._max_bytes = int(max_bytes)
+        self._index = manager.dict()
+        self._counts = manager.dict(hits=0, misses=0, evictions=0, bytes=0, tick=0)
+        self._lock = manager.Lock()
+        self._finalizer = weakref.finalize(self, _unlink_all, self._index, self._lock)
+
+    def __getstate__(self):
+        # the manager process itself can't be pickled, but the proxies to it can
+        state = self.__dict__.copy()
+        state["_manager"] = None
+        state["_finalizer"] = None
+        return state
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    def _tick(self):
+        self._counts["tick"] += 1
+        return self._counts["tick"]
+
+    def _unlink(self, key):
+        entry = self._index.pop(key)
+        self._counts["bytes"] -= entry["nbytes"]
+        try:
+            shm = _open_block(entry["name"])
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+    def get(self, key):
+        r"""
+        Look up a volume in the cache.
+
+        Args:
+            key (str): cache key, e.g. the image file path
+        Returns:
+            (numpy.ndarray or None): a private copy of the cached volume, or None on a miss, which includes a block that was freed from outside the cache
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            shm = None
+            if entry is not None:
+                # attach while holding the lock so the block can't be evicted out from under us
+                try:
+                    shm = _open_block(entry["name"])
+                except FileNotFoundError:
+                    self._index.pop(key)
+                    self._counts["bytes"] -= entry["nbytes"]
+            if shm is None:
+                self._counts["misses"] += 1
+                return None
+            self._counts["hits"] += 1
+            entry["tick"] = self._tick()
+            self._index[key] = entry
+        try:
+            arr = np.ndarray(
+                entry["shape"], dtype=entry["dtype"], buffer=shm.buf
+            ).copy()
+        finally:
+            shm.close()
+        return arr
+
+    def put(self, key, arr):
+        r"""
+        Add a volume to the cache, evicting least recently used volumes as needed to stay within the byte budget.
+        Volumes larger than the whole budget are not cached.
+
+        Args:
+            key (str): cache key, e.g. the image file path
+            arr (numpy.ndarray): volume to cache
+        Returns:
+            (bool): True if the volume is in the cache after the call
+        """
+        arr = np.ascontiguousarray(arr)
+        if arr.nbytes > self._max_bytes:
+            return False
+
+        shm = _open_block(
+            "bf2f_{}".format(uuid.uuid4().hex), create=True, size=max(arr.nbytes, 1)
+        )
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+
+        with self._lock:
+            if key in self._index:
+                # another worker beat us to it
+                keep = False
+            else:
+                keep = True
+                while self._index and (
+                    self._counts["bytes"] + arr.nbytes > self._max_bytes
+                ):
+                    lru = min(self._index.items(), key=lambda kv: kv[1]["tick"])[0]
+                    self._unlink(lru)
+                    self._counts["evictions"] += 1
+                self._index[key] = {
+                    "name": shm.name,
+                    "shape": arr.shape,
+                    "dtype": arr.dtype.str,
+                    "nbytes": arr.nbytes,
+                    "tick": self._tick(),
+                }
+                self._counts["bytes"] += arr.nbytes
+
+        shm.close()
+        if not keep:
+            shm.unlink()
+        return True
+
+    def get_or_load(self, key, loader):
+        r"""
+        Look up a volume in the cache, loading and caching it on a miss.
+
+        Args:
+            key (str): cache key, e.g. the image file path
+            loader (callable): zero argument function that returns the volume as a numpy.ndarray
+        Returns:
+            (numpy.ndarray): the volume
+        """
+        arr = self.get(key)
+        if arr is None:
+            arr = loader()
+            self.put(key, arr)
+        return arr
+
+    def stats(self):
+        r"""
+        Cache hit/miss counters and current occupancy.
+
+        Returns:
+            (dict): hits, misses, evictions, number of cached volumes and cached bytes
+        """
+        with self._lock:
+            return {
+                "hits": self._counts["hits"],
+                "misses": self._counts["misses"],
+                "evictions": self._counts["evictions"],
+                "volumes": len(self._index),
+                "bytes": self._counts["bytes"],
+            }
+
+    def clear(self):
+        r"""
+        Remove all volumes from the cache and free their shared memory.
+        """
+        with self._lock:
+            for key in list(self._index.keys()):
+                self._unlink(key)
@@ -0,0 +1,270 @@
+"""
+This module writes and reads single channel 3D volumes as a grid of independently compressed chunks in a single file,
+so that a training patch only decompresses the few chunks it overlaps.
+Unlike a zarr directory store it is one file per volume, written atomically like the other stage outputs, and unlike zarr or h5py it needs
+no dependency beyond numpy and the standard library codecs. The header fields (shape, dtype, chunks, codec) map directly onto zarr array metadata.
+
+File layout: an 8 byte magic string, an 8 byte little endian header length, a json header (shape, dtype, chunks, codec, shuffle, attrs,
+and the offset and length of every chunk in C order) padded with spaces, then the compressed chunks.
+"""
+
+import os
+import json
+import zlib
+import lzma
+import bz2
+import struct
+import itertools
+import numpy as np
+
+EXTENSION = ".cvol"
+MAGIC = b"B2FCVOL1"
+
+
+def _zstd():
+    import zstandard
+
+    return (
+        lambda b, level: zstandard.ZstdCompressor(level=level or 3).compress(b),
+        lambda b: zstandard.ZstdDecompressor().decompress(b),
+    )
+
+
+def _lz4():
+    import lz4.frame
+
+    return (
+        lambda b, level: lz4.frame.compress(b, compression_level=level or 0),
+        lz4.frame.decompress,
+    )
+
+
+# codec name -> function returning (compress(bytes, level), decompress(bytes)), optional codecs are imported on first use
+CODECS = {
+    "none": lambda: (lambda b, level: b, lambda b: b),
+    "zlib": lambda: (
+        lambda b, level: zlib.compress(b, 6 if level is None else level),
+        zlib.decompress,
+    ),
+    "lzma": lambda: (
+        lambda b, level: lzma.compress(b, preset=6 if level is None else level),
+        lzma.decompress,
+    ),
+    "bz2": lambda: (
+        lambda b, level: bz2.compress(b, 9 if level is None else level),
+        bz2.decompress,
+    ),
+    "zstd": _zstd,
+    "lz4": _lz4,
+}
+
+
+def is_chunked(path):
+    r"""
+    Whether a path names a chunked volume, by its extension.
+
+    Args:
+        path (str): file path
+    Returns:
+        (bool): True if path ends with EXTENSION
+    """
+    return str(path).endswith(EXTENSION)
+
+
+def _chunk_slices(shape, chunks):
+    grid = [range(0, s, c) for s, c in zip(shape, chunks)]
+    for start in itertools.product(*grid):
+        yield tuple(slice(a, min(a + c, s)) for a, c, s in zip(start, chunks, shape))
+
+
+def _slabs(blocks, depth):
+    # regroup consecutive blocks along the first axis into slabs one chunk deep, the last one possibly thinner
+    pending, n = [], 0
+    for block in blocks:
+        block = np.asarray(block)
+        while len(block) > 0:
+            pending += [block[: depth - n]]
+            n += len(pending[-1])
+            block = block[len(pending[-1]) :]
+            if n == depth:
+                yield np.concatenate(pending)
+                pending, n = [], 0
+    if n > 0:
+        yield np.concatenate(pending)
+
+
+def _encode(block, shuffle):
+    block = np.ascontiguousarray(block)
+    if shuffle and block.dtype.itemsize > 1:
+        # group bytes of equal significance together, which compresses much better for smooth uint16 data
+        block = block.view(np.uint8).reshape(-1, block.dtype.itemsize).T
+    return np.ascontiguousarray(block).tobytes()
+
+
+def _decode(buf, shape, dtype, shuffle):
+    if shuffle and dtype.itemsize > 1:
+        arr = np.frombuffer(buf, dtype=np.uint8).reshape(dtype.itemsize, -1).T
+        return np.ascontiguousarray(arr).view(dtype).reshape(shape)
+    return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+
+def write_chunked(
+    path, arr, chunks=(32, 64, 64), codec="zlib", level=None, shuffle=True, attrs=None
+):
+    r"""
+    Save an array as a chunked, compressed volume.
+    The array can also be given as consecutive blocks along its first axis, which are compressed as they come, one chunk deep slab at a time,
+    and so are never all held in memory.
+
+    Args:
+        path (str): output file path, conventionally ending with EXTENSION
+        arr (numpy.ndarray or brightfield2fish.data.utils.ZBlocks): array to save, e.g. a ZYX volume, or any iterable of its blocks along the first axis with shape and dtype attributes
+        chunks (tuple): chunk shape, e.g. the training patch size, one entry per dimension of arr
+        codec (str): compression codec, one of CODECS. "zstd" and "lz4" need the zstandard and lz4 packages
+        level (int or None): compression level, if None, the codec's default
+        shuffle (bool): if True, byte shuffle multi-byte data before compressing
+        attrs (dict or None): json serializable metadata stored in the header, e.g. channel name and pixel size
+    Returns:
+        (dict): the file header
+    """
+    compress, _ = CODECS[codec]()
+    shape = tuple(int(s) for s in arr.shape)
+    # chunks at least one deep, even along empty dimensions
+    chunks = tuple(max(int(min(c, s)), 1) for c, s in zip(chunks, shape))
+    n_chunks = int(np.prod([-(-s // c) for s, c in zip(shape, chunks)]))
+
+    header = {
+        "shape": list(shape),
+        "dtype": np.dtype(arr.dtype).str,
+        "chunks": list(chunks),
+        "codec": codec,
+        "shuffle": bool(shuffle),
+        "attrs": {} if attrs is None else attrs,
+    }
+    # the offsets are only known once the chunks are written, so reserve room for the largest possible ones
+    n_header = len(json.dumps({**header, "offsets": [[2 ** 63, 2 ** 63]] * n_chunks}))
+
+    tmp_path = path + ".tmp"
+    offsets, n_z = [], 0
+    with open(tmp_path, "wb") as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack("<Q", n_header))
+        fp.write(b" " * n_header)
+        data_start = fp.tell()
+        for slab in _slabs([arr] if isinstance(arr, np.ndarray) else arr, chunks[0]):
+            for slices in _chunk_slices(slab.shape, (len(slab),) + chunks[1:]):
+                buf = compress(_encode(slab[slices], shuffle), level)
+                offsets += [[fp.tell() - data_start, len(buf)]]
+                fp.write(buf)
+            n_z += len(slab)
+        if n_z != shape[0]:
+            raise ValueError("got {} slices, expected {}".format(n_z, shape[0]))
+
+        header["offsets"] = offsets
+        fp.seek(len(MAGIC) + 8)
+        fp.write(json.dumps(header).encode("utf-8").ljust(n_header))
+    os.replace(tmp_path, path)
+
+    return header
+
+
+class ChunkedVolume:
+    r"""
+    Read access to a volume written by write_chunked. Only the header is read on construction,
+    and indexing with slices reads and decompresses only the chunks the selection overlaps.
+
+    Args:
+        path (str): path to the chunked volume
+
+    Example:
+        >>> vol = ChunkedVolume("/path/to/image_channel_0.cvol")
+        >>> vol.shape
+        (50, 624, 924)
+        >>> patch = vol[10:42, 100:164, 200:264]
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a chunked volume".format(path))
+            (n,) = struct.unpack("<Q", fp.read(8))
+            self.header = json.loads(fp.read(n).decode("utf-8"))
+        self._data_start = len(MAGIC) + 8 + n
+        self.shape = tuple(self.header["shape"])
+        self.dtype = np.dtype(self.header["dtype"])
+        self.chunks = tuple(self.header["chunks"])
+        self.attrs = self.header["attrs"]
+        self._decompress = CODECS[self.header["codec"]]()[1]
+        self._grid = [-(-s // c) for s, c in zip(self.shape, self.chunks)]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _normalize_slices(self, slices):
+        if not isinstance(slices, tuple):
+            slices = (slices,)
+        slices = slices + (slice(None),) * (len(self.shape) - len(slices))
+        out = []
+        for s, n in zip(slices, self.shape):
+            if not isinstance(s, slice):
+                raise TypeError("only slices are supported, got {}".format(s))
+            start, stop, step = s.indices(n)
+            if step != 1:
+                raise ValueError("only contiguous slices are supported")
+            out += [slice(start, max(start, stop))]
+        return tuple(out)
+
+    def __getitem__(self, slices):
+        slices = self._normalize_slices(slices)
+        out = np.empty([s.stop - s.start for s in slices], dtype=self.dtype)
+
+        ranges = [
+            range(s.start // c, -(-s.stop // c)) for s, c in zip(slices, self.chunks)
+        ]
+        with open(self.path, "rb") as fp:
+            for index in itertools.product(*ranges):
+                flat = int(np.ravel_multi_index(index, self._grid))
+                offset, nbytes = self.header["offsets"][flat]
+                fp.seek(self._data_start + offset)
+                starts = [i * c for i, c in zip(index, self.chunks)]
+                shape = [
+                    min(c, n - a) for c, n, a in zip(self.chunks, self.shape, starts)
+                ]
+                chunk = _decode(
+                    self._decompress(fp.read(nbytes)),
+                    shape,
+                    self.dtype,
+                    self.header["shuffle"],
+                )
+                # overlap of the chunk and the selection, in chunk and output coordinates
+                src, dst = [], []
+                for s, a, n in zip(slices, starts, shape):
+                    lo, hi = max(s.start, a), min(s.stop, a + n)
+                    src += [slice(lo - a, hi - a)]
+                    dst += [slice(lo - s.start, hi - s.start)]
+                out[tuple(dst)] = chunk[tuple(src)]
+        return out
+
+    def read(self):
+        r"""
+        Read the whole volume.
+
+        Returns:
+            (numpy.ndarray): the volume
+        """
+        return self[tuple(slice(None) for _ in self.shape)]
+
+
+def read_chunked(path, slices=None):
+    r"""
+    Read a chunked volume, or a sub-block of it.
+
+    Args:
+        path (str): path to the chunked volume
+        slices (tuple or None): if not None, tuple of slices selecting a sub-block
+    Returns:
+        (numpy.ndarray): the volume or sub-block
+    """
+    vol = ChunkedVolume(path)
+    return vol.read() if slices is None else vol[slices]
@@ -0,0 +1,160 @@
+"""
+Collate functions for building batches out of dataset samples.
+"""
+
+import numpy as np
+import torch
+
+from brightfield2fish.data.utils import to_tensor
+
+
+def collate_crops(batch):
+    r"""
+    Collate samples from a dataset with `n_crops` set, flattening the crops of every sample into the batch dimension.
+    A batch of B samples with K crops each becomes a batch of B*K crops.
+
+    Args:
+        batch (list): list of samples, each a tuple or dict of tensors with a leading crop dimension
+    Returns:
+        (tuple or dict): tuple or dict of tensors, concatenated along the first dimension
+
+    Example:
+        >>> dset = FishDataframeDatasetTIFF(df, random_crop=(32, 64, 64), n_crops=8)
+        >>> loader = torch.utils.data.DataLoader(dset, batch_size=4, collate_fn=collate_crops)
+        >>> bf, target = next(iter(loader))  # bf.shape == (32, 1, 32, 64, 64)
+    """
+    if isinstance(batch[0], dict):
+        return {k: torch.cat([b[k] for b in batch]) for k in batch[0]}
+    return tuple(torch.cat(tensors) for tensors in zip(*batch))
+
+
+def _stack_as(arrays, dtype):
+    # stack and cast in one pass with torch copies, which use torch's intra-op threads,
+    # flattening any leading crop dimension into the batch
+    if arrays[0].ndim == 4:
+        arrays = [crop for a in arrays for crop in a]
+    out = torch.empty((len(arrays),) + tuple(arrays[0].shape), dtype=dtype)
+    for o, a in zip(out, arrays):
+        o.copy_(a if torch.is_tensor(a) else to_tensor(a))
+    return out
+
+
+class NormalizeAugmentCollate:
+    r"""
+    Collate raw (e.g. uint16) crops from a dataset with `raw=True` into a batch, then convert dtype, normalize, and augment the whole batch at once with batched torch ops.
+    The same random flips and rotations are applied to each brightfield/target pair.
+
+    Args:
+        flip (bool): if True, randomly flip each sample along y and along x
+        rot90 (bool): if True, randomly rotate each sample by a multiple of 90 degrees in the yx plane (only when y and x sizes are equal)
+        intensity_jitter (float): if > 0, std of a random per sample scale (about one) and offset (about zero) applied to the normalized brightfield
+        dtype (torch.dtype): output data type, normalization runs in at least float32
+        channel_dim (bool): if True, include a singleton channel dimension in the output
+        return_tuple (bool): if True, return (brightfield, target), else return a dict
+        generator (torch.Generator or None): random number generator for the augmentations
+
+    Example:
+        >>> dset = FishDataframeDatasetTIFF(df, random_crop=(32, 64, 64), raw=True, n_crops=4)
+        >>> collate = NormalizeAugmentCollate(flip=True, rot90=True, intensity_jitter=0.1)
+        >>> loader = torch.utils.data.DataLoader(dset, batch_size=8, collate_fn=collate)
+        >>> bf, target = next(iter(loader))  # bf.shape == (32, 1, 32, 64, 64)
+    """
+
+    def __init__(
+        self,
+        flip=False,
+        rot90=False,
+        intensity_jitter=0.0,
+        dtype=torch.float32,
+        channel_dim=True,
+        return_tuple=True,
+        generator=None,
+    ):
+        self.flip = flip
+        self.rot90 = rot90
+        self.intensity_jitter = intensity_jitter
+        self.dtype = dtype
+        self.channel_dim = channel_dim
+        self.return_tuple = return_tuple
+        self.generator = generator
+
+    def __call__(self, batch):
+        if isinstance(batch[0], dict):
+            batch = [(b["Brightfield"], b["Target"], b["norm"]) for b in batch]
+        bf, target, norm = zip(*batch)
+
+        # normalize in at least float32: raw uint16 values above 65504 overflow float16
+        math_dtype = torch.promote_types(self.dtype, torch.float32)
+        n_crops = bf[0].shape[0] if bf[0].ndim == 4 else 1
+        out = {
+            "Brightfield": _stack_as(bf, math_dtype),
+            "Target": _stack_as(target, math_dtype),
+        }
+        norm = torch.from_numpy(np.repeat(np.stack(norm), n_crops, axis=0)).to(
+            math_dtype
+        )
+
+        n = out["Brightfield"].shape[0]
+        view = (n,) + (1,) * (out["Brightfield"].dim() - 1)
+        for i, k in enumerate(("Brightfield", "Target")):
+            out[k].sub_(norm[:, i, 0].view(view)).div_(norm[:, i, 1].view(view))
+        out = {k: v.to(self.dtype) for k, v in out.items()}
+
+        if self.flip:
+            for dim in (-2, -1):
+                mask = torch.rand(n, generator=self.generator) < 0.5
+                for v in out.values():
+                    v[mask] = v[mask].flip(dim)
+
+        if self.rot90 and out["Brightfield"].shape[-1] == out["Brightfield"].shape[-2]:
+            turns = torch.randint(4, (n,), generator=self.generator)
+            for r in (1, 2, 3):
+                mask = turns == r
+                if mask.any():
+                    for v in out.values():
+                        v[mask] = torch.rot90(v[mask], r, dims=(-2, -1))
+
+        if self.intensity_jitter > 0:
+            scale = 1 + self.intensity_jitter * torch.randn(n, generator=self.generator)
+            offset = self.intensity_jitter * torch.randn(n, generator=self.generator)
+            out["Brightfield"].mul_(scale.to(self.dtype).view(view)).add_(
+                offset.to(self.dtype).view(view)
+            )
+
+        if self.channel_dim:
+            out = {k: v.unsqueeze(1) for k, v in out.items()}
+
+        if self.return_tuple:
+            out = (out["Brightfield"], out["Target"])
+
+        return out
+
+
+def collate_extrude(batch, crops=False):
+    r"""
+    Collate samples from FishSegDataframeDatasetTIFF with `fish_3d=False`, extruding the 2D targets along z only once per batch, as a stride 0 view.
+    Only the 2D targets are stacked and passed between processes.
+
+    Args:
+        batch (list): list of (brightfield, target) tuples or dicts, with targets that have a singleton z dimension
+        crops (bool): if True, samples come from a dataset with `n_crops` set, and their crops are flattened into the batch dimension as in `collate_crops`
+    Returns:
+        (tuple or dict): brightfield batch and target batch expanded to the same shape
+
+    Example:
+        >>> dset = FishSegDataframeDatasetTIFF(df, random_crop=(32, 64, 64), fish_3d=False)
+        >>> loader = torch.utils.data.DataLoader(dset, batch_size=8, collate_fn=collate_extrude)
+        >>> bf, target = next(iter(loader))  # target.stride(2) == 0
+    """
+    if isinstance(batch[0], dict):
+        bf, target = [b["Brightfield"] for b in batch], [b["Target"] for b in batch]
+    else:
+        bf, target = zip(*batch)
+
+    join = torch.cat if crops else torch.stack
+    bf, target = join(bf), join(target)
+    target = target.expand(*bf.shape)
+
+    if isinstance(batch[0], dict):
+        return {"Brightfield": bf, "Target": target}
+    return bf, target
@@ -1,11 +1,133 @@
 import warnings
+from functools import partial
 import numpy as np
-import pandas as pd
 from scipy.ndimage.interpolation import zoom
 import torch
 from torch.utils.data import Dataset
-from aicsimageio import AICSImage
-from brightfield2fish.data.utils import RandomCrop, normalize
+from aicsimageio import AICSImage, OmeTifReader
+from brightfield2fish.data.utils import (
+    RandomCrop,
+    bounding_slices,
+    normalize,
+    normalize_into,
+    normalize_torch,
+    percentile,
+    percentile_key,
+    shift_scale,
+    to_tensor,
+    volume_stats,
+    volume_stats_torch,
+)
+from brightfield2fish.data.volume_store import VolumeStore
+from brightfield2fish.data.chunked import ChunkedVolume, is_chunked
+from brightfield2fish.data.stats_index import load_stats_index
+from brightfield2fish.data.tables import read_table
+
+
+def _read_zyx(path):
+    if is_chunked(path):
+        return ChunkedVolume(path).read()
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=FutureWarning)
+        return AICSImage(path).get_image_data("ZYX")
+
+
+def read_zyx(path, cache=None, store=None):
+    r"""
+    Read a single channel 3D image from disk, from a memory-mapped volume store, or from a shared cache of decoded volumes.
+
+    Args:
+        path (str): path to the image file
+        cache (brightfield2fish.data.cache.SharedVolumeCache or None): if not None, look up / store the decoded volume here
+        store (brightfield2fish.data.volume_store.VolumeStore or None): if not None and path has been converted into it, memory map the volume from here
+    Returns:
+        (numpy.ndarray): ZYX image array
+    """
+    if store is not None and path in store:
+        return store.read(path)
+    if cache is None:
+        return _read_zyx(path)
+    return cache.get_or_load(path, partial(_read_zyx, path))
+
+
+def read_zyx_shape(path, store=None):
+    r"""
+    Read the shape of a single channel 3D image from its metadata, without decoding any pixels.
+
+    Args:
+        path (str): path to the ome-tiff file or chunked volume
+        store (brightfield2fish.data.volume_store.VolumeStore or None): if not None and path has been converted into it, read the shape from its index
+    Returns:
+        (tuple): (z,y,x) shape of the image
+    """
+    if store is not None and path in store:
+        return store.shape(path)
+    if is_chunked(path):
+        return ChunkedVolume(path).shape
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=FutureWarning)
+        with OmeTifReader(path) as reader:
+            return (reader.size_z(), reader.size_y(), reader.size_x())
+
+
+def read_zyx_crop(path, slices, store=None):
+    r"""
+    Read only a sub-block of a single channel 3D image.
+    From ome-tiffs only the z-slices inside the block are decoded, from chunked volumes only the chunks overlapping the block,
+    and from a volume store only the pages inside the block are touched.
+
+    Args:
+        path (str): path to the ome-tiff file or chunked volume
+        slices (tuple): tuple of z,y,x slices selecting the sub-block, e.g. `RandomCrop.slices`
+        store (brightfield2fish.data.volume_store.VolumeStore or None): if not None and path has been converted into it, read the sub-block from here
+    Returns:
+        (numpy.ndarray): ZYX sub-block of the image
+    """
+    if store is not None and path in store:
+        return np.array(store.read(path)[slices])
+    if is_chunked(path):
+        return ChunkedVolume(path)[tuple(slices)]
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=FutureWarning)
+        with OmeTifReader(path) as reader:
+            zs = range(*slices[0].indices(reader.size_z()))
+            return np.stack([reader.load_slice(z=z)[slices[1:]] for z in zs])
+
+
+def stack_crops(crops):
+    r"""
+    Stack several crops of the same sample along a new leading axis.
+
+    Args:
+        crops (list): list of dicts of torch.Tensor or numpy.ndarray, all with the same keys and shapes
+    Returns:
+        (dict): dict of stacked tensors (or arrays)
+    """
+    return {
+        k: torch.stack([c[k] for c in crops])
+        if torch.is_tensor(crops[0][k])
+        else np.stack([c[k] for c in crops])
+        for k in crops[0]
+    }
+
+
+def _torch_dtype(dtype):
+    return torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+
+
+def _trailing(factors, ndim):
+    # zoom factors for an image with maybe fewer (leading) dimensions than the original 3D images
+    if np.isscalar(factors):
+        return factors
+    return tuple(factors)[len(factors) - ndim :]
+
+
+def _load_stats(stats):
+    if stats is None:
+        return {}
+    if isinstance(stats, dict):
+        return dict(stats)
+    return load_stats_index(stats)
 
 
 class FishDataframeDatasetTIFF(Dataset):
@@ -14,15 +136,22 @@ class FishDataframeDatasetTIFF(Dataset):
 
     Args:
         df (pd.DataFrame): input dataframe that specifies dataset
-        csv (bool): if True, accept a csv file path rahter than a DataFrame
+        csv (bool): if True, accept a csv (or parquet or feather) file path rahter than a DataFrame, see brightfield2fish.data.tables.read_table
         channel_content (str): what content to pair with brightfiled, e.g. DNA
         resize_original (float, tuple, or None): if not None, how to resize the original 3D images
         random_crop (tuple, or None): if not None, tuple of z,y,x sizes (in pixels) to which image woll be randomly cropped
-        math_dtype (numpy.dtype): data type in which internal computations will be done
+        math_dtype (numpy.dtype): data type in which internal computations will be done. If the same as out_dtype (e.g. np.float32), normalization is done in place in a single buffer, see `brightfield2fish.data.utils.normalize_into`
         out_dtype (numpy.dtype): data type that will be output
         output_torch (boool): if True, output a torch.tensor rather than a np.array
         channel_dim (bool): if True, include a singleton channel dimension for output 3D images
         return_tuple (bool): if True, return images as (brightfield, target), else return as a dict
+        cache (brightfield2fish.data.cache.SharedVolumeCache or None): if not None, shared cache of decoded volumes used across DataLoader workers
+        store (str, brightfield2fish.data.volume_store.VolumeStore, or None): if not None, volume store (or its directory) from which to memory map images instead of decoding tiffs
+        crop_first (bool): if True and random_crop is set (without resize_original), read only the crop region from disk and normalize it with whole-volume statistics, which are looked up in `stats` or computed on the first full read of each image
+        stats (str, pd.DataFrame, dict, or None): if not None, precomputed normalization statistics (see brightfield2fish.data.stats_index) used instead of recomputing them every sample
+        n_crops (int or None): if not None (and random_crop is set), return this many independent random crops per decoded image pair, stacked along a new leading axis. Use with brightfield2fish.data.collate.collate_crops
+        raw (bool): if True, skip normalization, torch conversion and the channel dim, and return the raw (e.g. uint16) numpy crops plus a "norm" array of whole-volume [[shift, scale], ...] for (brightfield, target), to be normalized and augmented per batch by brightfield2fish.data.collate.NormalizeAugmentCollate
+        torch_math (bool): if True, cast and normalize in math_dtype with torch ops (see brightfield2fish.data.utils.normalize_torch), which use torch's intra-op threads (see torch.set_num_threads) rather than a single core
     """
 
     def __init__(
@@ -37,9 +166,16 @@ class FishDataframeDatasetTIFF(Dataset):
         output_torch=True,
         channel_dim=True,
         return_tuple=True,
+        cache=None,
+        store=None,
+        crop_first=True,
+        stats=None,
+        n_crops=None,
+        raw=False,
+        torch_math=False,
     ):
         if csv:
-            df = pd.read_csv(df)
+            df = read_table(df)
 
         df_channel = df[df["channel_content"] == channel_content].reset_index(
             drop=True
@@ -70,46 +206,313 @@ class FishDataframeDatasetTIFF(Dataset):
         self._output_torch = output_torch
         self._channel_dim = channel_dim
         self._return_tuple = return_tuple
+        self._cache = cache
+        self._store = VolumeStore(store) if isinstance(store, str) else store
+        self._crop_first = (
+            crop_first and random_crop is not None and resize_original is None
+        )
+        self._stats = _load_stats(stats) if resize_original is None else {}
+        self._fused = np.dtype(math_dtype) == np.dtype(out_dtype)
+        self._buffers = {}
+        self._n_crops = n_crops
+        self._raw = raw
+        self._torch_math = torch_math
 
     def __len__(self):
         return len(self.df)
 
+    def _to_math_tensor(self, v):
+        return to_tensor(v).to(_torch_dtype(self._math_dtype), copy=True)
+
+    def _from_math_tensor(self, v):
+        return v.to(_torch_dtype(self._out_dtype)).numpy()
+
+    def _buffer(self, k, shape):
+        # full size buffers can only be reused when samples are cropped (i.e. copied) out of them
+        if self._random_crop is None:
+            return None
+        if k not in self._buffers or self._buffers[k].shape != shape:
+            self._buffers[k] = np.empty(shape, dtype=self._out_dtype)
+        return self._buffers[k]
+
+    def _normalize_block(self, v, content, stats):
+        # normalize part of a volume as the whole volume would be, with its stats
+        if self._torch_math:
+            return self._from_math_tensor(
+                normalize_torch(self._to_math_tensor(v), content=content, stats=stats)
+            )
+        if self._fused:
+            return normalize_into(
+                v, content=content, stats=stats, dtype=self._out_dtype
+            )
+        return normalize(
+            v.astype(self._math_dtype), content=content, stats=stats
+        ).astype(self._out_dtype)
+
+    def _getitem_crop_first(self, row):
+        shape = read_zyx_shape(row["Brightfield"], store=self._store)
+        croppers = [
+            RandomCrop(shape, self._random_crop) for _ in range(self._n_crops or 1)
+        ]
+        block = bounding_slices(croppers)
+        out = {
+            k: read_zyx_crop(row[k], block, store=self._store)
+            for k in ("Brightfield", "Target")
+        }
+        if not self._raw:
+            out = {
+                k: self._normalize_block(v, k, self._stats[row[k]])
+                for k, v in out.items()
+            }
+        origin = [s.start for s in block]
+        return [{k: c.crop(v, origin=origin) for k, v in out.items()} for c in croppers]
+
     def __getitem__(self, idx):
 
         row = self.df.iloc[idx]
 
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=FutureWarning)
+        if self._crop_first and all(
+            row[k] in self._stats for k in ("Brightfield", "Target")
+        ):
+            crops = self._getitem_crop_first(row)
+        else:
             out = {
-                k: AICSImage(row[k]).get_image_data("ZYX")
+                k: read_zyx(row[k], cache=self._cache, store=self._store)
                 for k in ("Brightfield", "Target")
             }
 
-        if self._resize_original is not None:
-            out = {
-                k: zoom(v.astype(self._math_dtype), self._resize_original).astype(
-                    self._out_dtype
+            if self._resize_original is not None:
+                out = {
+                    k: zoom(v.astype(self._math_dtype), self._resize_original).astype(
+                        self._out_dtype
+                    )
+                    for k, v in out.items()
+                }
+
+            if self._raw:
+                self._stats.update(
+                    {
+                        row[k]: volume_stats(v, by_slice=True)
+                        for k, v in out.items()
+                        if row[k] not in self._stats
+                    }
                 )
-                for k, v in out.items()
-            }
+            elif self._torch_math:
+                out = {k: self._to_math_tensor(v) for k, v in out.items()}
+                if self._crop_first:
+                    self._stats.update(
+                        {
+                            row[k]: {
+                                s: float(x) for s, x in volume_stats_torch(v).items()
+                            }
+                            for k, v in out.items()
+                        }
+                    )
+                out = {
+                    k: self._from_math_tensor(normalize_torch(v, content=k))
+                    for k, v in out.items()
+                }
+            elif self._fused:
+                if self._crop_first:
+                    self._stats.update(
+                        {row[k]: volume_stats(v, by_slice=True) for k, v in out.items()}
+                    )
+                out = {
+                    k: normalize_into(
+                        v,
+                        content=k,
+                        stats=self._stats.get(row[k]),
+                        out=self._buffer(k, v.shape),
+                        dtype=self._out_dtype,
+                    )
+                    for k, v in out.items()
+                }
+            else:
+                out = {k: v.astype(self._math_dtype) for k, v in out.items()}
+                if self._crop_first:
+                    self._stats.update(
+                        {row[k]: volume_stats(v) for k, v in out.items()}
+                    )
+                out = {
+                    k: normalize(v, content=k).astype(self._out_dtype)
+                    for k, v in out.items()
+                }
+
+            crops = [out]
+            if self._random_crop is not None:
+                croppers = [
+                    RandomCrop(out["Brightfield"], self._random_crop)
+                    for _ in range(self._n_crops or 1)
+                ]
+                crops = [{k: c.crop(v) for k, v in out.items()} for c in croppers]
+                if self._fused and not self._raw:
+                    # don't hand out views of the reused buffers
+                    crops = [{k: v.copy() for k, v in o.items()} for o in crops]
+
+        for i, out in enumerate(crops):
+            if self._output_torch and not self._raw:
+                out = {k: torch.from_numpy(v) for k, v in out.items()}
+
+            if self._channel_dim and not self._raw:
+                out = {k: torch.unsqueeze(v, 0) for k, v in out.items()}
+
+            crops[i] = out
+
+        out = crops[0] if self._n_crops is None else stack_crops(crops)
+
+        if self._raw:
+            out["norm"] = np.array(
+                [
+                    shift_scale(self._stats[row[k]], content=k)
+                    for k in ("Brightfield", "Target")
+                ],
+                dtype=np.float64,
+            )
 
-        out = {
-            k: normalize(v.astype(self._math_dtype), content=k).astype(self._out_dtype)
-            for k, v in out.items()
-        }
+        if self._return_tuple:
+            out = tuple(out[k] for k in ("Brightfield", "Target", "norm") if k in out)
 
-        if self._random_crop is not None:
-            randomcropper = RandomCrop(out["Brightfield"], self._random_crop)
-            out = {k: randomcropper.crop(v) for k, v in out.items()}
+        return out
+
+
+class FishMultiDataframeDatasetTIFF(Dataset):
+    r"""
+    Dataset class for Brightfield -> many FISH probes prediction that reads single channel tiffs.
+    Each brightfield image is read once, and returned with every available target for its file, stacked along the channel dimension,
+    plus a boolean presence mask. Missing targets are all zeros.
+
+    Args:
+        df (pd.DataFrame): input dataframe that specifies dataset
+        csv (bool): if True, accept a csv (or parquet or feather) file path rahter than a DataFrame, see brightfield2fish.data.tables.read_table
+        channel_contents (list): what contents to pair with brightfield, e.g. ["DNA", "CAAX", "TNNT2"]
+        random_crop (tuple, or None): if not None, tuple of z,y,x sizes (in pixels) to which image woll be randomly cropped, at the same location in every channel
+        math_dtype (numpy.dtype): data type in which internal computations will be done. If the same as out_dtype (e.g. np.float32), normalization is done in place in a single buffer, see `brightfield2fish.data.utils.normalize_into`
+        out_dtype (numpy.dtype): data type that will be output
+        output_torch (boool): if True, output a torch.tensor rather than a np.array
+        channel_dim (bool): if True, include a singleton channel dimension for the output brightfield image
+        return_tuple (bool): if True, return images as (brightfield, targets, mask), else return as a dict
+        cache (brightfield2fish.data.cache.SharedVolumeCache or None): if not None, shared cache of decoded volumes used across DataLoader workers
+        store (str, brightfield2fish.data.volume_store.VolumeStore, or None): if not None, volume store (or its directory) from which to memory map images instead of decoding tiffs
+        stats (str, pd.DataFrame, dict, or None): if not None, precomputed normalization statistics (see brightfield2fish.data.stats_index). When every image of a sample has stats and random_crop is set, only the crop region is read from disk
+
+    Example:
+        >>> dset = FishMultiDataframeDatasetTIFF(df, channel_contents=["DNA", "CAAX"], random_crop=(32, 64, 64))
+        >>> bf, targets, mask = dset[0]
+        >>> bf.shape, targets.shape, mask
+        (torch.Size([1, 32, 64, 64]), torch.Size([2, 32, 64, 64]), tensor([True, False]))
+    """
+
+    def __init__(
+        self,
+        df,
+        csv=False,
+        channel_contents=("DNA",),
+        random_crop=None,
+        math_dtype=np.float64,
+        out_dtype=np.float32,
+        output_torch=True,
+        channel_dim=True,
+        return_tuple=True,
+        cache=None,
+        store=None,
+        stats=None,
+    ):
+        if csv:
+            df = read_table(df)
+
+        self.channel_contents = list(channel_contents)
+
+        # one row per file, one column per content, NaN where a file has no such channel
+        df_targets = df[df["channel_content"].isin(self.channel_contents)].pivot_table(
+            index="file",
+            columns="channel_content",
+            values="normalized_single_channel_image",
+            aggfunc="first",
+        )
+        df_brightf = df[df["channel_content"] == "Brightfield"][
+            ["file", "normalized_single_channel_image"]
+        ].rename({"normalized_single_channel_image": "Brightfield"}, axis="columns")
+
+        self.df = (
+            df_brightf.drop_duplicates("file")
+            .merge(df_targets.reset_index(), how="inner", on="file")
+            .reindex(columns=["Brightfield"] + self.channel_contents)
+            .reset_index(drop=True)
+        )
+
+        self._random_crop = random_crop
+        self._math_dtype = math_dtype
+        self._out_dtype = out_dtype
+        self._output_torch = output_torch
+        self._channel_dim = channel_dim
+        self._return_tuple = return_tuple
+        self._cache = cache
+        self._store = VolumeStore(store) if isinstance(store, str) else store
+        self._stats = _load_stats(stats)
+        self._fused = np.dtype(math_dtype) == np.dtype(out_dtype)
+
+    def __len__(self):
+        return len(self.df)
+
+    def _normalize(self, im, path, content):
+        stats = self._stats.get(path)
+        if self._fused:
+            return normalize_into(
+                im, content=content, stats=stats, dtype=self._out_dtype
+            )
+        return normalize(
+            im.astype(self._math_dtype), content=content, stats=stats
+        ).astype(self._out_dtype)
+
+    def __getitem__(self, idx):
+
+        row = self.df.iloc[idx]
+        paths = [row["Brightfield"]] + [
+            row[c] for c in self.channel_contents if isinstance(row[c], str)
+        ]
+        mask = np.array([isinstance(row[c], str) for c in self.channel_contents])
+
+        cropper = None
+        if self._random_crop is not None and all(p in self._stats for p in paths):
+            # read only the crop region of every channel
+            shape = read_zyx_shape(row["Brightfield"], store=self._store)
+            cropper = RandomCrop(shape, self._random_crop)
+
+            def read(path):
+                return read_zyx_crop(path, cropper.slices, store=self._store)
+
+        else:
+
+            def read(path):
+                return read_zyx(path, cache=self._cache, store=self._store)
+
+        bf = self._normalize(
+            read(row["Brightfield"]), row["Brightfield"], "Brightfield"
+        )
+        if self._random_crop is not None and cropper is None:
+            cropper = RandomCrop(bf, self._random_crop)
+            bf = cropper.crop(bf)
+            crop = cropper.crop
+        else:
+            crop = np.asarray
+
+        targets = np.zeros(
+            (len(self.channel_contents),) + bf.shape, dtype=self._out_dtype
+        )
+        for i, c in enumerate(self.channel_contents):
+            if mask[i]:
+                targets[i] = crop(self._normalize(read(row[c]), row[c], "Target"))
+
+        out = {"Brightfield": bf, "Target": targets, "mask": mask}
 
         if self._output_torch:
-            out = {k: torch.from_numpy(v) for k, v in out.items()}
+            out = {k: torch.from_numpy(np.ascontiguousarray(v)) for k, v in out.items()}
 
         if self._channel_dim:
-            out = {k: torch.unsqueeze(v, 0) for k, v in out.items()}
+            out["Brightfield"] = out["Brightfield"][None]
 
         if self._return_tuple:
-            out = (out["Brightfield"], out["Target"])
+            out = (out["Brightfield"], out["Target"], out["mask"])
 
         return out
 
@@ -121,18 +524,22 @@ class FishSegDataframeDatasetTIFF(Dataset):
 
     Args:
         df (pd.DataFrame): input dataframe that specifies dataset
-        csv (bool): if True, accept a csv file path rahter than a DataFrame
+        csv (bool): if True, accept a csv (or parquet or feather) file path rahter than a DataFrame, see brightfield2fish.data.tables.read_table
         channel_content (str): what content to pair with brightfiled, e.g. DNA
         resize_original (float, tuple, or None): if not None, how to resize the original 3D images
         random_crop (tuple, or None): if not None, tuple of z,y,x sizes (in pixels) to which image woll be randomly cropped
-        math_dtype (numpy.dtype): data type in which internal computations will be done
+        math_dtype (numpy.dtype): data type in which internal computations will be done. If the same as out_dtype (e.g. np.float32), clipping and normalization are done in place in a single buffer, see `brightfield2fish.data.utils.normalize_into`
         out_dtype (numpy.dtype): data type that will be output
         output_torch (boool): if True, output a torch.tensor rather than a np.array
         channel_dim (bool): if True, include a singleton channel dimension for output 3D images
         return_tuple (bool): if True, return images as (brightfield, target), else return as a dict
-        fish_3d (bool): if True, return fish image as 3D, extruded along z axis
+        fish_3d (bool): if True, return fish image as 3D, extruded along z axis (as a stride 0 view, which default collation materializes). If False, return it with a singleton z axis, and extrude it per batch with brightfield2fish.data.collate.collate_extrude
         bf_clip_percentiles (list): lower and upper percentiales of pixel intesity at which to clip the brightfield image
         normalize (bool): if True, normalize the brightfield image to zero mean and unit varinace, and normalize the fish image to min zero and max one
+        stats (str, pd.DataFrame, dict, or None): if not None, precomputed normalization statistics and percentiles (see brightfield2fish.data.stats_index) used instead of recomputing them every sample, when resize_original is None
+        cache (brightfield2fish.data.cache.SharedVolumeCache or None): if not None, shared cache of decoded volumes used across DataLoader workers
+        store (str, brightfield2fish.data.volume_store.VolumeStore, or None): if not None, volume store (or its directory) from which to memory map images instead of decoding tiffs
+        n_crops (int or None): if not None (and random_crop is set), return this many independent random crops per decoded image pair, stacked along a new leading axis. Use with brightfield2fish.data.collate.collate_crops
     """
 
     def __init__(
@@ -150,10 +557,14 @@ class FishSegDataframeDatasetTIFF(Dataset):
         fish_3d=True,
         bf_clip_percentiles=[0.01, 99.99],
         normalize=True,
+        stats=None,
+        cache=None,
+        store=None,
+        n_crops=None,
     ):
 
         if csv:
-            df = pd.read_csv(df)
+            df = read_table(df)
 
         self.df = (
             df[df["probe name"] == channel_content][["file", "fish segmetation path"]]
@@ -176,61 +587,131 @@ class FishSegDataframeDatasetTIFF(Dataset):
         self._fish_3d = fish_3d
         self._bf_clip_percentiles = bf_clip_percentiles
         self._normalize = normalize
+        self._stats = _load_stats(stats) if resize_original is None else {}
+        self._cache = cache
+        self._store = VolumeStore(store) if isinstance(store, str) else store
+        self._fused = np.dtype(math_dtype) == np.dtype(out_dtype)
+        self._n_crops = n_crops
 
     def __len__(self):
         return len(self.df)
 
+    def _bf_clip_bounds(self, raw, im, stats):
+        if not np.issubdtype(raw.dtype, np.integer):
+            return np.percentile(im, self._bf_clip_percentiles)
+
+        # exactly np.percentile(im): casting and normalizing are non-decreasing,
+        # so the order statistics of im are those of the raw image put through the same ops, see `percentile`
+        def transform(x):
+            x = normalize(
+                x.astype(self._math_dtype), content="Brightfield", stats=stats
+            )
+            return x.astype(self._out_dtype)
+
+        # the raw order statistics come from the stats index when it has them, else from a histogram of raw
+        keys = [
+            [percentile_key(q, side) for q in self._bf_clip_percentiles]
+            for side in ("lower", "upper")
+        ]
+        neighbours = None
+        if all(k in stats for k in keys[0] + keys[1]):
+            neighbours = [[stats[k] for k in side] for side in keys]
+        return percentile(
+            raw, self._bf_clip_percentiles, transform=transform, neighbours=neighbours
+        )
+
     def __getitem__(self, idx):
 
         row = self.df.iloc[idx]
 
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=FutureWarning)
-            out = {
-                k: AICSImage(row[k]).get_image_data("ZYX")
-                for k in ("Brightfield", "Target")
-            }
+        out = {
+            k: read_zyx(row[k], cache=self._cache, store=self._store)
+            for k in ("Brightfield", "Target")
+        }
+
+        # keep the 2d fish seg 2d, it only gets extruded along z at the very end
+        if out["Target"].shape[0] == 1:
+            out["Target"] = out["Target"][0]
 
         if self._resize_original is not None:
             out = {
                 k: zoom(
                     v.astype(self._math_dtype),
-                    self._resize_original,
+                    _trailing(self._resize_original, v.ndim),
                     order=1,
                     mode="reflect",
                 ).astype(self._out_dtype)
                 for k, v in out.items()
             }
 
-        out = {
-            k: normalize(v.astype(self._math_dtype), content=k).astype(self._out_dtype)
-            for k, v in out.items()
-        }
+        stats = {k: self._stats.get(row[k]) for k in ("Brightfield", "Target")}
 
-        if self._bf_clip_percentiles is not None:
-            out["Brightfield"] = np.clip(
-                out["Brightfield"],
-                a_min=np.percentile(out["Brightfield"], self._bf_clip_percentiles[0]),
-                a_max=np.percentile(out["Brightfield"], self._bf_clip_percentiles[1]),
-            )
+        if self._fused:
+            out = {
+                "Brightfield": normalize_into(
+                    out["Brightfield"],
+                    content="Brightfield",
+                    stats=stats["Brightfield"],
+                    clip_percentiles=self._bf_clip_percentiles,
+                    renormalize=self._normalize,
+                    dtype=self._out_dtype,
+                ),
+                "Target": normalize_into(
+                    out["Target"],
+                    content="Target",
+                    stats=stats["Target"],
+                    dtype=self._out_dtype,
+                ),
+            }
+        else:
+            raw = out["Brightfield"]
+            out = {k: v.astype(self._math_dtype) for k, v in out.items()}
+
+            if self._bf_clip_percentiles is not None and stats["Brightfield"] is None:
+                # the clip bounds are mapped through the same stats
+                stats["Brightfield"] = volume_stats(out["Brightfield"])
 
-        if self._normalize:
-            out = {k: normalize(v, content=k) for k, v in out.items()}
+            out = {
+                k: normalize(v, content=k, stats=stats[k]).astype(self._out_dtype)
+                for k, v in out.items()
+            }
 
+            if self._bf_clip_percentiles is not None:
+                a_min, a_max = self._bf_clip_bounds(
+                    raw, out["Brightfield"], stats["Brightfield"]
+                )
+                out["Brightfield"] = np.clip(
+                    out["Brightfield"], a_min=a_min, a_max=a_max
+                )
+
+            if self._normalize:
+                out = {k: normalize(v, content=k) for k, v in out.items()}
+
+        crops = [out]
         if self._random_crop is not None:
-            randomcropper = RandomCrop(out["Brightfield"], self._random_crop)
-            out = {k: randomcropper.crop(v) for k, v in out.items()}
+            croppers = [
+                RandomCrop(out["Brightfield"], self._random_crop)
+                for _ in range(self._n_crops or 1)
+            ]
+            crops = [{k: c.crop(v) for k, v in out.items()} for c in croppers]
 
-        if self._output_torch:
-            out = {k: torch.from_numpy(v) for k, v in out.items()}
+        for i, out in enumerate(crops):
+            if self._output_torch:
+                out = {k: torch.from_numpy(v) for k, v in out.items()}
 
-        if self._fish_3d:
-            out["Target"] = out["Target"].expand(
-                *out["Brightfield"].shape
-            )  # extrudes the 2d fish seg in 3d
+            if self._fish_3d:
+                out["Target"] = out["Target"].expand(
+                    *out["Brightfield"].shape
+                )  # extrudes the 2d fish seg in 3d, as a stride 0 view
+            elif out["Target"].ndim == 2:
+                out["Target"] = out["Target"][None]  # singleton z
 
-        if self._channel_dim:
-            out = {k: torch.unsqueeze(v, 0) for k, v in out.items()}
+            if self._channel_dim:
+                out = {k: torch.unsqueeze(v, 0) for k, v in out.items()}
+
+            crops[i] = out
+
+        out = crops[0] if self._n_crops is None else stack_crops(crops)
 
         if self._return_tuple:
             out = (out["Brightfield"], out["Target"])
@@ -0,0 +1,163 @@
+"""
+This module runs per-file jobs (e.g. preprocessing czis) in a process pool without oversubscribing memory:
+the worker count is capped by a per-worker memory estimate, only a bounded number of jobs are in flight at once,
+failed jobs are retried, and every outcome is returned and optionally logged as a json line.
+"""
+
+import os
+import json
+import time
+import traceback
+import concurrent
+from concurrent.futures.process import BrokenProcessPool
+from tqdm import tqdm
+
+
+def available_memory():
+    r"""
+    Physical memory currently available to new processes.
+
+    Returns:
+        (int or None): bytes, or None if it can't be determined on this platform
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def n_workers(max_workers=None, worker_memory=None, memory_budget=None):
+    r"""
+    Number of worker processes that fit in the memory budget.
+
+    Args:
+        max_workers (int or None): upper bound on the number of workers, if None, the number of cpus
+        worker_memory (int or None): estimated peak bytes used by one worker, if None, memory is not limiting
+        memory_budget (int or None): bytes the workers may use together, if None, the currently available memory
+    Returns:
+        (int): number of workers, at least one
+    """
+    n = max_workers or os.cpu_count() or 1
+    if worker_memory is not None:
+        budget = memory_budget if memory_budget is not None else available_memory()
+        if budget is not None:
+            n = min(n, budget // worker_memory)
+    return max(int(n), 1)
+
+
+def _timed(fn, item):
+    # exceptions are returned as formatted tracebacks, since not every exception can be pickled
+    start = time.time()
+    try:
+        return True, fn(item), None, time.time() - start
+    except Exception:
+        return False, None, traceback.format_exc(), time.time() - start
+
+
+def run_jobs(
+    fn,
+    items,
+    max_workers=None,
+    worker_memory=None,
+    memory_budget=None,
+    max_in_flight=None,
+    retries=1,
+    log_path=None,
+    key=str,
+    callback=None,
+):
+    r"""
+    Apply fn to every item in a process pool, with bounded submission and retries.
+    A worker killed mid-job (e.g. by the out of memory killer) breaks the pool, in which case the pool is restarted and the jobs that were in flight are rerun one at a time,
+    so that only the job that actually kills its worker counts a failed attempt.
+
+    Args:
+        fn (callable): picklable function of one item, run in the worker processes
+        items (list): items to process
+        max_workers (int or None): upper bound on the number of worker processes, see `n_workers`
+        worker_memory (int or None): estimated peak bytes used by one job, see `n_workers`
+        memory_budget (int or None): bytes all workers may use together, see `n_workers`
+        max_in_flight (int or None): maximum number of submitted but unfinished jobs, if None, twice the number of workers
+        retries (int): number of times a failed job is retried
+        log_path (str or None): if not None, append one json line per finished job here
+        key (callable): function of an item giving its name in the log
+        callback (callable or None): if not None, called in the parent process with each finished job's record, as soon as it finishes
+    Returns:
+        (list): one record per item, in the order of items, {"item", "ok", "result", "error", "attempts", "seconds"}
+    """
+    items = list(items)
+    workers = n_workers(max_workers, worker_memory, memory_budget)
+    max_in_flight = max_in_flight or 2 * workers
+
+    records = [None] * len(items)
+    attempts = [0] * len(items)
+    todo = list(range(len(items)))[::-1]
+
+    def finish(i, ok, result, error, seconds):
+        attempts[i] += 1
+        if not ok and attempts[i] <= retries:
+            todo.append(i)
+            return False
+        records[i] = {
+            "item": key(items[i]),
+            "ok": ok,
+            "result": result,
+            "error": error,
+            "attempts": attempts[i],
+            "seconds": seconds,
+        }
+        if log_path is not None:
+            with open(log_path, "a") as fp:
+                log = {k: v for k, v in records[i].items() if k != "result"}
+                fp.write(json.dumps(log) + "\n")
+        if callback is not None:
+            callback(records[i])
+        return True
+
+    # jobs that were in flight when a worker died are rerun one at a time, to find the culprit
+    suspects = set()
+    died = "worker process died, e.g. out of memory"
+
+    with tqdm(total=len(items)) as pbar:
+        while todo:
+            broken = False
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                in_flight = {}
+                while (todo or in_flight) and not broken:
+                    while todo and len(in_flight) < max_in_flight:
+                        isolate = [todo[-1]] + list(in_flight.values())
+                        if len(in_flight) > 0 and suspects.intersection(isolate):
+                            break
+                        i = todo.pop()
+                        in_flight[pool.submit(_timed, fn, items[i])] = i
+                    done, _ = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    broken = any(
+                        isinstance(f.exception(), BrokenProcessPool) for f in done
+                    )
+                    if broken:
+                        # keep whatever finished before the pool broke
+                        done = [
+                            f
+                            for f in in_flight
+                            if f.done()
+                            and not isinstance(f.exception(), BrokenProcessPool)
+                        ]
+                    for future in done:
+                        try:
+                            ok, result, error, seconds = future.result()
+                        except Exception:
+                            # e.g. an unpicklable result
+                            ok, result, error = False, None, traceback.format_exc()
+                            seconds = None
+                        i = in_flight.pop(future)
+                        pbar.update(finish(i, ok, result, error, seconds))
+                if broken:
+                    if len(in_flight) == 1:
+                        i = in_flight.popitem()[1]
+                        pbar.update(finish(i, False, None, died, None))
+                    suspects.update(in_flight.values())
+                    todo.extend(in_flight.values())
+
+    return records
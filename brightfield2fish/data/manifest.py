@@ -0,0 +1,180 @@
+"""
+This module keeps a run manifest for preprocessing: one json line per processed input file, recording its path, size and mtime,
+a hash of the prep parameters, and the size, mtime and checksum of every output written from it.
+Reruns skip inputs whose record is still up to date, and since records are only appended once all of a file's outputs are written,
+a run that crashed partway through resumes from where it stopped.
+"""
+
+import os
+import json
+import hashlib
+
+from brightfield2fish.data.stats_index import file_key
+
+
+def params_hash(params):
+    r"""
+    Hash prep parameters, so that changing any of them invalidates the outputs made with the old ones.
+
+    Args:
+        params (dict): json serializable prep parameters
+    Returns:
+        (str): sha1 hex digest of the parameters
+    """
+    return hashlib.sha1(
+        json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def file_checksum(path, chunk_size=2 ** 20):
+    r"""
+    Checksum of a file's contents.
+
+    Args:
+        path (str): path to the file
+        chunk_size (int): number of bytes read at a time
+    Returns:
+        (str): sha1 hex digest of the file
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def output_record(paths):
+    r"""
+    Record the current version of output files.
+
+    Args:
+        paths (list): paths to output files
+    Returns:
+        (dict): {path: {"size", "mtime", "sha1"}}
+    """
+    out = {}
+    for path in paths:
+        key = file_key(path)
+        out[path] = {"size": key["size"], "mtime": key["mtime"]}
+        out[path]["sha1"] = file_checksum(path)
+    return out
+
+
+class RunManifest:
+    r"""
+    Manifest of processed input files, stored as json lines appended as inputs are processed. The last record of an input wins,
+    and the file is compacted to one line per input once superseded lines outnumber live records, or after a crash cut a line short.
+
+    Args:
+        path (str): path to the manifest file, created on the first record
+
+    Example:
+        >>> manifest = RunManifest("/path/to/preprocessed/manifest.jsonl")
+        >>> if not manifest.up_to_date(czi_path, params, outputs):
+        ...     write_outputs(czi_path, outputs)
+        ...     manifest.record(czi_path, params, outputs)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self._n_lines = 0
+        partial = False
+        if os.path.exists(path):
+            with open(path, "r") as fp:
+                for line in fp:
+                    self._n_lines += 1
+                    # the last line may be cut short by a crash
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        partial = True
+                        continue
+                    self.records[record["input"]] = record
+        # a partial line has to go before anything is appended after it
+        if partial or self._n_lines - len(self.records) > len(self.records):
+            self.compact()
+
+    def __contains__(self, input_path):
+        return input_path in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def up_to_date(self, input_path, params, outputs=None, verify=False):
+        r"""
+        Check whether an input's outputs were made from its current version with the same parameters, and are unchanged since.
+
+        Args:
+            input_path (str): path to the input file
+            params (dict): prep parameters of this run
+            outputs (list or None): if not None, the outputs this run expects from the input, which must all have been recorded
+            verify (bool): if True, also recompute output checksums rather than trusting their size and mtime
+        Returns:
+            (bool): True if the input can be skipped
+        """
+        record = self.records.get(input_path)
+        if record is None or not os.path.exists(input_path):
+            return False
+
+        key = file_key(input_path)
+        if (record["size"], record["mtime"]) != (key["size"], key["mtime"]):
+            return False
+        if record["params"] != params_hash(params):
+            return False
+        if outputs is not None and not set(outputs) <= set(record["outputs"]):
+            return False
+
+        for path, out in record["outputs"].items():
+            if not os.path.exists(path):
+                return False
+            key = file_key(path)
+            if (out["size"], out["mtime"]) != (key["size"], key["mtime"]):
+                return False
+            if verify and out["sha1"] != file_checksum(path):
+                return False
+
+        return True
+
+    def record(self, input_path, params, outputs):
+        r"""
+        Append a record for an input whose outputs have all been written.
+
+        Args:
+            input_path (str): path to the input file
+            params (dict): prep parameters the outputs were made with
+            outputs (list): paths to the output files
+        Returns:
+            (dict): the appended record
+        """
+        key = file_key(input_path)
+        record = {
+            "input": input_path,
+            "size": key["size"],
+            "mtime": key["mtime"],
+            "params": params_hash(params),
+            "outputs": output_record(outputs),
+        }
+        with open(self.path, "a") as fp:
+            fp.write(json.dumps(record) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.records[input_path] = record
+        self._n_lines += 1
+        if self._n_lines - len(self.records) > len(self.records):
+            self.compact()
+        return record
+
+    def compact(self):
+        r"""
+        Rewrite the manifest with only the last record of every input, so that its size doesn't grow with the number of reruns.
+        The new file is written to a temporary path first and then moved into place, so a crash leaves either the old or the new manifest.
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            for record in self.records.values():
+                fp.write(json.dumps(record) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
+        self._n_lines = len(self.records)
@@ -0,0 +1,243 @@
+"""
+This module runs preprocessing as a graph of stages. Each stage declares the files it reads and writes,
+a stage depends on the stages that write its inputs, and independent stages run concurrently.
+A stage is skipped when the checksums of its inputs and its parameters match its last successful run and its outputs are unchanged since,
+which is recorded in a json state file.
+"""
+
+import os
+import json
+import threading
+import traceback
+import concurrent
+
+from brightfield2fish.data.manifest import file_checksum, output_record, params_hash
+from brightfield2fish.data.stats_index import file_key
+
+
+class Stage:
+    r"""
+    One step of a pipeline.
+
+    Args:
+        name (str): unique name of the stage
+        fn (callable): function run with params and options as keyword arguments, which writes every path in outputs
+        inputs (list): paths of the files the stage reads
+        outputs (list): paths of the files the stage writes
+        params (dict or None): json serializable keyword arguments for fn, changing any of them reruns the stage
+        options (dict or None): keyword arguments for fn that don't change its outputs, e.g. worker counts
+
+    Example:
+        >>> Stage("split", split_and_save, inputs=["normalized.csv"], outputs=["splits/splits.json"], params={...})
+    """
+
+    def __init__(self, name, fn, inputs, outputs, params=None, options=None):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = {} if params is None else params
+        self.options = {} if options is None else options
+
+    def __repr__(self):
+        return "Stage({!r})".format(self.name)
+
+
+def stage_graph(stages):
+    r"""
+    Find the stages each stage depends on, i.e. the stages writing its inputs.
+
+    Args:
+        stages (list): list of Stage
+    Returns:
+        (dict): {stage name: set of names of the stages it depends on}
+    Raises:
+        ValueError: if two stages write the same file, or the stages depend on each other in a cycle
+    """
+    writers = {}
+    for stage in stages:
+        for path in stage.outputs:
+            if path in writers:
+                raise ValueError(
+                    "{} is written by both {} and {}".format(
+                        path, writers[path], stage.name
+                    )
+                )
+            writers[path] = stage.name
+
+    deps = {
+        stage.name: {writers[p] for p in stage.inputs if p in writers} - {stage.name}
+        for stage in stages
+    }
+
+    # check for cycles by repeatedly removing stages without remaining dependencies
+    remaining = {k: set(v) for k, v in deps.items()}
+    while remaining:
+        ready = [k for k, v in remaining.items() if not v]
+        if not ready:
+            raise ValueError(
+                "stages depend on each other: {}".format(sorted(remaining))
+            )
+        for k in ready:
+            del remaining[k]
+        for v in remaining.values():
+            v.difference_update(ready)
+
+    return deps
+
+
+def upstream(deps, targets):
+    r"""
+    Stages needed to run targets: the targets and everything they depend on.
+
+    Args:
+        deps (dict): output of `stage_graph`
+        targets (list): names of the stages to run
+    Returns:
+        (set): names of the needed stages
+    """
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in deps:
+            raise KeyError("unknown stage {}".format(name))
+        if name not in needed:
+            needed.add(name)
+            todo += list(deps[name])
+    return needed
+
+
+class PipelineState:
+    r"""
+    Record of the last successful run of every stage, stored as a json file.
+
+    Args:
+        path (str): path to the state file, created on the first record
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, "r") as fp:
+                self.records = json.load(fp)
+        self._lock = threading.Lock()
+
+    def _key(self, stage):
+        return {
+            "inputs": {p: file_checksum(p) for p in stage.inputs},
+            "params": params_hash(stage.params),
+        }
+
+    def up_to_date(self, stage):
+        r"""
+        Check whether a stage ran successfully with the same inputs and parameters, and its outputs are unchanged since.
+
+        Args:
+            stage (Stage): the stage
+        Returns:
+            (bool): True if the stage can be skipped
+        """
+        record = self.records.get(stage.name)
+        if record is None or not all(os.path.exists(p) for p in stage.inputs):
+            return False
+        if {k: record[k] for k in ("inputs", "params")} != self._key(stage):
+            return False
+        if set(record["outputs"]) != set(stage.outputs):
+            return False
+        for path, out in record["outputs"].items():
+            if not os.path.exists(path):
+                return False
+            key = file_key(path)
+            if (out["size"], out["mtime"]) != (key["size"], key["mtime"]):
+                return False
+        return True
+
+    def record(self, stage):
+        r"""
+        Record a successful run of a stage, after all of its outputs are written.
+
+        Args:
+            stage (Stage): the stage
+        Returns:
+            (dict): the stage's record
+        """
+        record = {**self._key(stage), "outputs": output_record(stage.outputs)}
+        with self._lock:
+            self.records[stage.name] = record
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as fp:
+                json.dump(self.records, fp, indent=1)
+            os.replace(tmp_path, self.path)
+        return record
+
+
+def run_pipeline(
+    stages, state_path, targets=None, force=(), max_workers=None, dry_run=False
+):
+    r"""
+    Run stages in dependency order, concurrently where they are independent, skipping the ones that are up to date.
+    Stages downstream of a failed stage are not run.
+
+    Args:
+        stages (list): list of Stage
+        state_path (str): path to the json state file, see `PipelineState`
+        targets (list or None): names of the stages to bring up to date, along with everything they depend on. If None, all stages
+        force (list): names of stages to run even if they are up to date
+        max_workers (int or None): number of stages run at once
+        dry_run (bool): if True, report which stages would run without running them
+    Returns:
+        (dict): {stage name: {"status", "error"}}, where status is one of "ran", "skipped", "failed", "blocked" or "would run"
+    """
+    deps = stage_graph(stages)
+    by_name = {stage.name: stage for stage in stages}
+    needed = upstream(deps, by_name if targets is None else targets)
+    state = PipelineState(state_path)
+
+    status = {}
+
+    def run(stage):
+        if dry_run and any(
+            status[d]["status"] == "would run" for d in deps[stage.name]
+        ):
+            return "would run"
+        if stage.name not in force and state.up_to_date(stage):
+            return "skipped"
+        if dry_run:
+            return "would run"
+        missing = [p for p in stage.inputs if not os.path.exists(p)]
+        if len(missing) > 0:
+            raise FileNotFoundError("inputs not found: {}".format(missing))
+        stage.fn(**stage.params, **stage.options)
+        state.record(stage)
+        return "ran"
+
+    pending = [s for s in stages if s.name in needed]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        in_flight = {}
+        while pending or in_flight:
+            for stage in list(pending):
+                dep_status = [status.get(d, {}).get("status") for d in deps[stage.name]]
+                if any(s in ("failed", "blocked") for s in dep_status):
+                    status[stage.name] = {"status": "blocked", "error": None}
+                    pending.remove(stage)
+                elif all(s in ("ran", "skipped", "would run") for s in dep_status):
+                    in_flight[pool.submit(run, stage)] = stage
+                    pending.remove(stage)
+            if not in_flight:
+                continue
+            done, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                stage = in_flight.pop(future)
+                try:
+                    status[stage.name] = {"status": future.result(), "error": None}
+                except Exception:
+                    status[stage.name] = {
+                        "status": "failed",
+                        "error": traceback.format_exc(),
+                    }
+
+    return status
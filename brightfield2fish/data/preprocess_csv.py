@@ -4,11 +4,19 @@ and creates csvs indexing all the images and the content of each image channel.
 """
 
 import os
+import json
 import warnings
 import concurrent
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from aicsimageio import AICSImage
+from aicsimageio import OmeTifReader
+from aicsimageio.cziReader import CziReader
+from aicsimageio.tifReader import TifReader
+from aicsimageio.typeChecker import TypeChecker
+
+from brightfield2fish.data.jobs import run_jobs
+from brightfield2fish.data.stats_index import file_key
+from brightfield2fish.data.tables import read_table, write_table
 
 
 def parse_plate_well(path):
@@ -18,51 +26,218 @@ def parse_plate_well(path):
     return {"plate": plate, "well": well}
 
 
-def find_czis(df):
-    czis = {d: os.listdir(d) for d in df["directory"].unique()}
-    czis = {k: [f for f in v if ".czi" in f] for k, v in czis.items()}
-    czis = [[os.path.join(k, f) for f in v] for k, v in czis.items()]
-    czis = [item for sublist in czis for item in sublist]
-    df_czi = pd.DataFrame([{**parse_plate_well(czi), "file": czi} for czi in czis])
+def parse_plate_well_paths(paths):
+    r"""
+    Vectorized `parse_plate_well` over many czi paths.
+
+    Args:
+        paths (list): czi file paths
+    Returns:
+        (pd.DataFrame): plate, well and file columns, one row per path
+    """
+    files = pd.Series(list(paths), dtype=object)
+    parts = files.str.rsplit(os.path.sep, n=1)
+    plate = parts.str[0].str.split(os.path.sep).str[6]
+    well = parts.str[1].str.split("_").str[-1].str.split("-").str[4]
+    # like os.path.splitext, drop the last extension unless the name starts with it
+    well = well.str.replace(r"(?<=.)\.[^.]*$", "", regex=True)
+    return pd.DataFrame({"plate": plate, "well": well, "file": files})
+
+
+def _scan_dir(directory):
+    with os.scandir(directory) as it:
+        return [entry.name for entry in it]
+
+
+def list_dirs(directories, cache_path=None, max_workers=None):
+    r"""
+    List the contents of many directories concurrently, reusing cached listings of directories whose mtime hasn't changed.
+
+    Args:
+        directories (list): directories to list
+        cache_path (str or None): if not None, json file to read cached listings from and save the updated cache to
+        max_workers (int or None): number of threads listing directories
+    Returns:
+        (dict): {directory: list of entry names}
+    """
+    directories = sorted(set(directories))
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, "r") as fp:
+            cache = json.load(fp)
+
+    mtimes = {d: os.stat(d).st_mtime for d in directories}
+    listings = {
+        d: cache[d]["files"]
+        for d in directories
+        if d in cache and cache[d]["mtime"] == mtimes[d]
+    }
+
+    todo = [d for d in directories if d not in listings]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        listings.update(zip(todo, executor.map(_scan_dir, todo)))
+
+    if cache_path is not None:
+        cache.update({d: {"mtime": mtimes[d], "files": listings[d]} for d in todo})
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(cache, fp)
+        os.replace(tmp_path, cache_path)
+
+    return listings
+
+
+def find_czis(df, cache_path=None, max_workers=None):
+    czis = list_dirs(df["directory"], cache_path=cache_path, max_workers=max_workers)
+    czis = [os.path.join(k, f) for k, v in czis.items() for f in v if ".czi" in f]
+    df_czi = parse_plate_well_paths(czis)
     df = df.merge(df_czi, how="inner")
     df = df[~df["file"].str.contains("FORFUN")]
     return df
 
 
-def image_shape(czi_path):
+def _header_reader(path):
+    checker = TypeChecker(path)
+    if checker.is_czi:
+        return CziReader(path)
+    if checker.is_ome:
+        return OmeTifReader(path)
+    if checker.is_tiff:
+        return TifReader(path)
+    raise ValueError("{} is not a czi or tiff file".format(path))
+
+
+def image_metadata(path):
+    r"""
+    Read an image's shape, dims, dtype and physical pixel size from its header only, without decoding any pixels (unlike AICSImage).
+
+    Args:
+        path (str): path to a czi or tiff file
+    Returns:
+        (dict): file, shape (as AICSImage(path).shape), dims, dtype and physical_pixel_size (x,y,z, as AICSImage.get_physical_pixel_size)
+    """
     with warnings.catch_warnings():
         warnings.filterwarnings("ignore", category=FutureWarning)
-        image = AICSImage(czi_path)
-    return {"file": czi_path, "shape": image.shape}
+        reader = _header_reader(path)
+        with reader:
+            if isinstance(reader, CziReader):
+                # map czi axes by letter, like AICSImage does, since czis can have extra axes (e.g. S, B)
+                sizes = dict(zip(reader.czi.axes, reader.czi.shape))
+                shape = tuple(int(sizes.get(d, 1)) for d in "TCZYX")
+            else:
+                shape = tuple(
+                    int(f())
+                    for f in (
+                        reader.size_t,
+                        reader.size_c,
+                        reader.size_z,
+                        reader.size_y,
+                        reader.size_x,
+                    )
+                )
+            metadata = reader.get_metadata()
+            dtype = np.dtype(reader.dtype()).str
 
+    if metadata is None:
+        pixel_size = None
+    elif isinstance(reader, CziReader):
+        pixel_size = []
+        for d in "XYZ":
+            ref = metadata.find(
+                "./Metadata/Scaling/Items/Distance[@Id='{}']/Value".format(d)
+            )
+            pixel_size += [float("1.0" if ref is None else ref.text)]
+    else:
+        p = metadata.image().Pixels
+        pixel_size = [
+            p.get_PhysicalSizeX(),
+            p.get_PhysicalSizeY(),
+            p.get_PhysicalSizeZ(),
+        ]
 
-def filter_czis(df, shape=(1, 5, 50, 624, 924)):
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        shapes = list(tqdm(executor.map(image_shape, df["file"]), total=len(df)))
-    full_ims = [x["file"] for x in shapes if x["shape"] == shape]
-    return df[df["file"].isin(full_ims)].reset_index(drop=True)
+    return {
+        "file": path,
+        "shape": shape,
+        "dims": "TCZYX",
+        "dtype": dtype,
+        "physical_pixel_size": pixel_size,
+    }
 
 
-if __name__ == "__main__":
-    # load original csv and fix some typos
-    df = pd.read_csv("data.csv")
-    df = df.rename(index=str, columns={"link_to_data": "directory"})
-    df["plate"] = df["plate"].astype(str)
-    df = df.replace({"PRSS35": "PRSS3", "COL2A": "COL2A1"})
+def probe_images(paths, cache_path=None, max_workers=None, log_path=None):
+    r"""
+    Header metadata (see `image_metadata`) for many images, read in parallel and cached on disk keyed by path, size and mtime,
+    so that repeat runs only read the headers of new or changed files.
 
-    # add CAAX signal to channel info:
-    for i, row in df.iterrows():
-        if row["cell_line"] == "CAAX":
-            df.loc[i, "probe_561"] = "CAAX"
+    Args:
+        paths (list): paths to image files
+        cache_path (str or None): if not None, json file to read cached metadata from and save the updated cache to
+        max_workers (int or None): upper bound on the number of processes reading headers
+        log_path (str or None): if not None, append a json line per newly probed file here, see brightfield2fish.data.jobs.run_jobs
+    Returns:
+        (list): metadata dict per path, in order, or None for files that are missing or couldn't be read
+    """
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, "r") as fp:
+            cache = json.load(fp)
 
-    # find the actual czis and filter for ones that are the right shape
-    df = find_czis(df)
-    df = filter_czis(df)
+    keys = {}
+    for p in set(paths):
+        try:
+            keys[p] = file_key(p)
+        except OSError:
+            # missing or inaccessible files are unreadable, not fatal
+            continue
+
+    cache = {
+        p: v
+        for p, v in cache.items()
+        if p in keys and (v["size"], v["mtime"]) == (keys[p]["size"], keys[p]["mtime"])
+    }
 
-    # save a filtered copy
-    df.to_csv("data_by_images.csv", index=False)
+    todo = sorted(p for p in keys if p not in cache)
+    for result in run_jobs(
+        image_metadata, todo, max_workers=max_workers, log_path=log_path
+    ):
+        if result["ok"]:
+            cache[result["item"]] = {**result["result"], **keys[result["item"]]}
 
-    # melt the dataframe so each row is a seprate channel
+    if cache_path is not None:
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(cache, fp)
+        os.replace(tmp_path, cache_path)
+
+    return [
+        {**cache[p], "shape": tuple(cache[p]["shape"])} if p in cache else None
+        for p in paths
+    ]
+
+
+def image_shape(czi_path):
+    return {"file": czi_path, "shape": image_metadata(czi_path)["shape"]}
+
+
+def filter_czis(
+    df, shape=(1, 5, 50, 624, 924), cache_path=None, max_workers=None, log_path=None,
+):
+    metadata = probe_images(
+        df["file"], cache_path=cache_path, max_workers=max_workers, log_path=log_path
+    )
+    full_ims = [m["file"] for m in metadata if m is not None and m["shape"] == shape]
+    return df[df["file"].isin(full_ims)].reset_index(drop=True)
+
+
+def melt_channels(df):
+    r"""
+    Melt a dataframe of images into one row per image channel, with its index and content.
+
+    Args:
+        df (pd.DataFrame): data_by_images.csv, with probe_488, probe_561 and probe_638 columns
+    Returns:
+        (pd.DataFrame): data_by_channels.csv, with "channel_index" and "channel_content" columns
+    """
     df = df.rename(
         index=str,
         columns={
@@ -81,7 +256,49 @@ if __name__ == "__main__":
         value_name="channel_content",
     )
     df["channel_index"] = df["channel_index"].str[-1].astype(int)
-    df = df[df["channel_content"].astype(str) != "nan"]
+    return df[df["channel_content"].astype(str) != "nan"]
+
+
+def preprocess_csv(
+    data_csv="data.csv",
+    images_csv="data_by_images.csv",
+    channels_csv="data_by_channels.csv",
+    listing_cache=None,
+    metadata_cache=None,
+    max_workers=None,
+):
+    r"""
+    Find the czis of every directory in data_csv, keep the ones with the expected shape, and save csvs indexing the images and their channels.
 
-    # save it
-    df.to_csv("data_by_channels.csv", index=False)
+    Args:
+        data_csv (str): csv of image directories, with plate, cell line and probe columns
+        images_csv (str): path to save the csv of images to, in the format given by its extension (see brightfield2fish.data.tables)
+        channels_csv (str): path to save the csv of image channels to, in the format given by its extension
+        listing_cache (str or None): json cache of directory listings, see `list_dirs`
+        metadata_cache (str or None): json cache of image metadata, see `probe_images`
+        max_workers (int or None): number of threads listing directories and processes reading image headers
+    Returns:
+        (list): [images_csv, channels_csv]
+    """
+    # load original csv and fix some typos
+    df = read_table(data_csv)
+    df = df.rename(index=str, columns={"link_to_data": "directory"})
+    df["plate"] = df["plate"].astype(str)
+    df = df.replace({"PRSS35": "PRSS3", "COL2A": "COL2A1"})
+
+    # add CAAX signal to channel info
+    df.loc[df["cell_line"] == "CAAX", "probe_561"] = "CAAX"
+
+    # find the actual czis and filter for ones that are the right shape
+    df = find_czis(df, cache_path=listing_cache, max_workers=max_workers)
+    df = filter_czis(df, cache_path=metadata_cache, max_workers=max_workers)
+    write_table(df, images_csv)
+
+    write_table(melt_channels(df), channels_csv)
+    return [images_csv, channels_csv]
+
+
+if __name__ == "__main__":
+    preprocess_csv(
+        listing_cache="czi_listings.json", metadata_cache="czi_metadata.json"
+    )
@@ -1,28 +1,31 @@
 """
-This script takes the provisinoal 2D fish segmentations and matches them with 3D brightfield data.
-Not cleaning this up since the whole process should really be pulls from a database.
+This module/script takes the provisional 2D fish segmentations and matches them with 3D brightfield data.
 """
 
+import os
+import re
+import numpy as np
+import pandas as pd
 
-if __name__ == "__main__":
-
-    import os
-    from pathlib import Path
-    import numpy as np
-    import pandas as pd
+from brightfield2fish.data.preprocess_csv import list_dirs
+from brightfield2fish.data.tables import read_table, write_table
 
-    PAR_DIR = "/allen/aics/microscopy/Data/fish/mip_with_seg"
-    FISH_SEG_CSV = "fish_seg.csv"
-    SEG_EXPORT_CSV = "seg_export.csv"
+ID_VARS = ["plate", "cell_line", "cell_age", "well"]
+FISH_SEG_CSV = "fish_seg.csv"
+SEG_EXPORT_CSV = "seg_export.csv"
 
-    fpath_fish_seg_csv = Path(PAR_DIR).joinpath(FISH_SEG_CSV)
-    fpath_fish_export_csv = Path(PAR_DIR).joinpath(SEG_EXPORT_CSV)
 
-    df_seg = pd.read_csv(fpath_fish_seg_csv)
-    df_exp = pd.read_csv(fpath_fish_export_csv)
-
-    idvars = ["plate", "cell_line", "cell_age", "well"]
+def tidy_fish_segs(df_seg, df_exp, par_dir):
+    r"""
+    One row per (scene, probe) from the fish segmentation csvs, with the output subdirectory its segmentation should be in.
 
+    Args:
+        df_seg (pd.DataFrame): fish_seg.csv, with probe and dot value columns per wavelength
+        df_exp (pd.DataFrame): seg_export.csv, with a FileName_BF column of brightfield file names
+        par_dir (str): directory containing the per plate and cell line segmentation directories
+    Returns:
+        (pd.DataFrame): tidy dataframe with "probe name", "dot value", "scene id" and "out subdir" columns
+    """
     df_bf = pd.DataFrame({"brightfield filename": np.unique(df_exp[["FileName_BF"]])})
     df_bf["scene id"] = (
         df_bf["brightfield filename"].str.split("-OME").str[0].str.split(".").str[0]
@@ -32,7 +35,7 @@ if __name__ == "__main__":
 
     df_probe = pd.melt(
         df_seg,
-        id_vars=idvars,
+        id_vars=ID_VARS,
         value_vars=["probe_488", "probe_638", "probe_561"],
         var_name="wavelength",
         value_name="probe name",
@@ -41,20 +44,20 @@ if __name__ == "__main__":
 
     df_dot = pd.melt(
         df_seg,
-        id_vars=idvars,
+        id_vars=ID_VARS,
         value_vars=["dot_488", "dot_638", "dot_561"],
         var_name="wavelength",
         value_name="dot value",
     ).dropna()
     df_dot["wavelength"] = df_dot["wavelength"].str.split("_").str[-1].astype(int)
 
-    df_tidy = df_probe.merge(df_dot, how="inner", on=idvars + ["wavelength"])
+    df_tidy = df_probe.merge(df_dot, how="inner", on=ID_VARS + ["wavelength"])
     df_tidy["plate"] = df_tidy["plate"].astype(str)
     df_tidy["directory"] = (
-        PAR_DIR
+        par_dir
         + os.path.sep
         + (df_tidy["plate"].astype(str) + "_" + df_tidy["cell_line"]).str.replace(
-            "_0", ""
+            "_0", "", regex=False
         )
     )
     df_tidy["out subdir"] = (
@@ -65,31 +68,67 @@ if __name__ == "__main__":
         + "_"
         + df_tidy["dot value"].astype(str)
     )
-    df_tidy = df_tidy.merge(df_bf, on=["plate", "well"], how="inner")
-
-    ls_out = {
-        d: os.listdir(os.path.join(PAR_DIR, d)) for d in df_tidy["directory"].unique()
-    }
-    ls_out = {d: [s for s in subdirs if "out" in s] for d, subdirs in ls_out.items()}
-    ls_out = [
-        [os.path.join(PAR_DIR, d, s) for s in subdirs] for d, subdirs in ls_out.items()
-    ]
-    ls_out = [item for sublist in ls_out for item in sublist]
-
-    seg_tiff_list = [
-        [os.path.abspath(tiff) for tiff in os.listdir(lso)] for lso in ls_out
-    ]
-    seg_tiff_list = [item for sublist in seg_tiff_list for item in sublist]
-
-    df_tidy["fish segmentation filename"] = ""
-    for i, row in df_tidy.iterrows():
-        seg_tiff = [
-            tiff for tiff in os.listdir(row["out subdir"]) if row["scene id"] in tiff
-        ]
-        assert len(seg_tiff) == 1
-        df_tidy.loc[i, "fish segmentation filename"] = seg_tiff[0]
-
-    df_3d = pd.read_csv("../data/data_by_images.csv")
+    return df_tidy.merge(df_bf, on=["plate", "well"], how="inner")
+
+
+def index_seg_files(listings, scene_ids):
+    r"""
+    Index segmentation files by output subdirectory and the scene id their file name contains.
+
+    Args:
+        listings (dict): {out subdir: list of file names}, e.g. from brightfield2fish.data.preprocess_csv.list_dirs
+        scene_ids (list): scene ids to look for in the file names
+    Returns:
+        (pd.DataFrame): "out subdir", "scene id" and "fish segmentation filename" columns, one row per matching file
+    """
+    df_files = pd.DataFrame(
+        [(d, f) for d, files in listings.items() for f in files],
+        columns=["out subdir", "fish segmentation filename"],
+    )
+    # longest ids first, so an id that is a prefix of another doesn't shadow it
+    ids = sorted(set(scene_ids), key=len, reverse=True)
+    pattern = "({})".format("|".join(re.escape(i) for i in ids))
+    df_files["scene id"] = df_files["fish segmentation filename"].str.extract(
+        pattern, expand=False
+    )
+    return df_files.dropna(subset=["scene id"])
+
+
+def match_fish_segs(df_tidy, df_3d, max_workers=None):
+    r"""
+    Match each (scene, probe) row with its segmentation file and its 3D image.
+    Each output subdirectory is listed once, and rows are joined to files by (out subdir, scene id) in one merge.
+
+    Args:
+        df_tidy (pd.DataFrame): output of `tidy_fish_segs`
+        df_3d (pd.DataFrame): data_by_images.csv, with a "file" column of 3D images
+        max_workers (int or None): number of threads listing output subdirectories
+    Returns:
+        (pd.DataFrame): df_tidy rows with "fish segmetation path" and "file" columns
+    """
+    listings = list_dirs(df_tidy["out subdir"], max_workers=max_workers)
+    df_files = index_seg_files(listings, df_tidy["scene id"])
+
+    dups = df_files.duplicated(["out subdir", "scene id"], keep=False)
+    if dups.any():
+        raise ValueError(
+            "several segmentation files for one scene, e.g. {}".format(
+                df_files.loc[dups, "fish segmentation filename"].tolist()[:2]
+            )
+        )
+
+    df_tidy = df_tidy.merge(df_files, how="left", on=["out subdir", "scene id"])
+    missing = df_tidy["fish segmentation filename"].isna()
+    if missing.any():
+        raise ValueError(
+            "no segmentation file for {} scenes, e.g. {} in {}".format(
+                missing.sum(),
+                df_tidy.loc[missing, "scene id"].iloc[0],
+                df_tidy.loc[missing, "out subdir"].iloc[0],
+            )
+        )
+
+    df_3d = df_3d[["file"]].copy()
     df_3d["scene id"] = df_3d["file"].apply(
         lambda x: os.path.splitext(os.path.basename(x))[0]
     )
@@ -97,7 +136,7 @@ if __name__ == "__main__":
     df_tidy["fish segmetation path"] = (
         df_tidy["out subdir"] + os.path.sep + df_tidy["fish segmentation filename"]
     )
-    df_final = (
+    return (
         df_tidy.drop(
             [
                 "directory",
@@ -107,8 +146,42 @@ if __name__ == "__main__":
             ],
             axis=1,
         )
-        .merge(df_3d[["file", "scene id"]], how="inner", on="scene id")
+        .merge(df_3d, how="inner", on="scene id")
         .drop(["scene id"], axis=1)
     )
 
-    df_final.to_csv("../data/data_by_images_with_fish_segmentations.csv", index=False)
+
+def preprocess_fish_segs(
+    par_dir,
+    images_csv="data_by_images.csv",
+    out_csv="data_by_images_with_fish_segmentations.csv",
+    max_workers=None,
+):
+    r"""
+    Match the fish segmentations in par_dir with the 3D images of images_csv, and save the result.
+
+    Args:
+        par_dir (str): directory containing fish_seg.csv, seg_export.csv and the per plate and cell line segmentation directories
+        images_csv (str): data_by_images.csv, with a "file" column of 3D images, or a parquet or feather version of it (see brightfield2fish.data.tables)
+        out_csv (str): path to save the matched csv to, in the format given by its extension
+        max_workers (int or None): number of threads listing output subdirectories
+    Returns:
+        (str): out_csv
+    """
+    df_seg = pd.read_csv(os.path.join(par_dir, FISH_SEG_CSV))
+    df_exp = pd.read_csv(os.path.join(par_dir, SEG_EXPORT_CSV))
+    df_3d = read_table(images_csv)
+
+    df_final = match_fish_segs(
+        tidy_fish_segs(df_seg, df_exp, par_dir), df_3d, max_workers=max_workers
+    )
+    write_table(df_final, out_csv)
+    return out_csv
+
+
+if __name__ == "__main__":
+    preprocess_fish_segs(
+        "/allen/aics/microscopy/Data/fish/mip_with_seg",
+        images_csv="../data/data_by_images.csv",
+        out_csv="../data/data_by_images_with_fish_segmentations.csv",
+    )
@@ -4,18 +4,74 @@ and saves normalized versions of each single channel 3D image, along with a csv
 """
 
 import os
+import json
+import time
 import warnings
 import concurrent
-import functools
-from tqdm import tqdm
-
-import pandas as pd
 import numpy as np
 
-from brightfield2fish.data.utils import prep_fish
+from brightfield2fish.data.utils import prep_fish, iter_prep_fish_channels
+from brightfield2fish.data.manifest import RunManifest
+from brightfield2fish.data.jobs import run_jobs
+from brightfield2fish.data.tables import read_table, write_table
+from brightfield2fish.data.chunked import write_chunked, EXTENSION as CHUNKED_EXTENSION
 
 from aicsimageio import AICSImage, OmeTifWriter
 
+# estimated peak bytes to decode a 5x50x624x924 czi and normalize one channel, with room to spare
+WORKER_MEMORY = 2 ** 31
+# estimated bytes per normalized 50x624x924 uint16 channel held for a write thread, with the writer's buffers
+CHANNEL_MEMORY = 2 ** 27
+
+# everything that determines the pixels written by preprocess_file, recorded in the run manifest
+PREP_PARAMS = {
+    "T": 0,
+    "brightfield_clip_percentiles": [0.01, 99.99],
+    "fish_clip_percentiles": [0, 99.99],
+    "math_dtype": "float64",
+    "out_dtype": "uint16",
+}
+
+
+def write_ome_tiff(path, image_ZYX, channel_name, pixel_size):
+    r"""
+    Save a single channel 3D image as an ome-tiff.
+
+    Args:
+        path (str): output path
+        image_ZYX (numpy.ndarray or brightfield2fish.data.utils.ZBlocks): image to save, blocks are assembled into an array first
+        channel_name (str): channel name stored in the metadata
+        pixel_size (tuple): physical (x,y,z) pixel size stored in the metadata
+    """
+    with OmeTifWriter(path, overwrite_file=True) as writer:
+        writer.save(
+            np.asarray(image_ZYX),
+            channel_names=channel_name,
+            pixels_physical_size=pixel_size,
+        )
+
+
+def write_chunked_volume(path, image_ZYX, channel_name, pixel_size, **kwargs):
+    r"""
+    Save a single channel 3D image as a chunked, compressed volume, see `brightfield2fish.data.chunked.write_chunked`.
+
+    Args:
+        path (str): output path
+        image_ZYX (numpy.ndarray or brightfield2fish.data.utils.ZBlocks): image to save, blocks are compressed as they are computed
+        channel_name (str): channel name stored in the header
+        pixel_size (tuple): physical (x,y,z) pixel size stored in the header
+        **kwargs: chunks, codec, level and shuffle, passed to write_chunked
+    """
+    attrs = {"channel_name": channel_name, "pixel_size": list(pixel_size)}
+    write_chunked(path, image_ZYX, attrs=attrs, **kwargs)
+
+
+# output format -> (writer function, conventional file extension)
+WRITERS = {
+    "ome-tiff": (write_ome_tiff, ".tif"),
+    "chunked": (write_chunked_volume, CHUNKED_EXTENSION),
+}
+
 
 def normalize(image, channel=0):
     if channel == 0:
@@ -41,43 +97,290 @@ def normalize(image, channel=0):
     return out
 
 
-if __name__ == "__main__":
-    preprocessed_par_dir = "/allen/aics/modeling/data/brightfield2fish/preprocessed"
-    preprocessed_im_dir = os.path.join(preprocessed_par_dir, "images")
+def _prep_kwargs(channels):
+    return {
+        "T": PREP_PARAMS["T"],
+        "clip_percentiles": [
+            PREP_PARAMS["brightfield_clip_percentiles"]
+            if c == 0
+            else PREP_PARAMS["fish_clip_percentiles"]
+            for c in channels
+        ],
+        "median_subtract": [c != 0 for c in channels],
+        "math_dtype": np.dtype(PREP_PARAMS["math_dtype"]),
+        "out_dtype": np.dtype(PREP_PARAMS["out_dtype"]),
+    }
+
+
+def normalize_all(image, channels):
+    r"""
+    Normalize several channels of an image as `normalize` does, decoding the image only once.
+
+    Args:
+        image (aicsimageio.AICSImage): input image object
+        channels (list): channel indices to normalize
+    Returns:
+        (list): normalized single channel 3D arrays, one per channel
+    """
+    return list(iter_prep_fish_channels(image, channels, **_prep_kwargs(channels)))
+
+
+def _write_timed(write, out_path, image_ZYX, channel_name, pixel_size, writer_kwargs):
+    start = time.time()
+    write(out_path + ".tmp", image_ZYX, channel_name, pixel_size, **writer_kwargs)
+    os.replace(out_path + ".tmp", out_path)
+    return time.time() - start
+
+
+def preprocess_file(
+    file,
+    df_file,
+    writer="ome-tiff",
+    writer_kwargs=None,
+    write_threads=2,
+    block_z=None,
+    timing=None,
+):
+    r"""
+    Normalize every channel of an image listed in df_file, and save each to its "normalized_single_channel_image" path.
+    Channels are normalized one at a time while the previous ones are encoded and written by a small thread pool, so disk writes overlap with computation.
+    Each output is written to a temporary file first and then moved into place, so a crash never leaves a truncated output behind.
+
+    Args:
+        file (str): path to the czi file
+        df_file (pd.DataFrame): rows of data_by_channels.csv for this file, with a "normalized_single_channel_image" column
+        writer (str): output format, one of WRITERS
+        writer_kwargs (dict or None): extra arguments for the writer, e.g. {"chunks": (32, 64, 64), "codec": "zlib"} for "chunked"
+        write_threads (int): number of threads writing outputs. At most this many normalized channels are held in memory, counting the one being normalized
+        block_z (int or None): if not None, normalize block_z z slices at a time as each channel is written (see brightfield2fish.data.utils.prep_fish_blocks), which bounds the float memory used per channel. The outputs are the same
+        timing (dict or None): if not None, filled with the seconds spent decoding, normalizing and writing (summed over threads), and the wall time. With block_z, normalizing only counts the first pass, the second one is part of writing
+    Returns:
+        (list): paths to the written images
+    """
+    start = time.time()
+    timing = {} if timing is None else timing
+    write = WRITERS[writer][0]
+    writer_kwargs = {} if writer_kwargs is None else writer_kwargs
+    channels = df_file["channel_index"].tolist()
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=FutureWarning)
+        image = AICSImage(file)
+        pixel_size = image.get_physical_pixel_size()
+    timing.update({"decode": time.time() - start, "normalize": 0.0, "write": 0.0})
+
+    images_ZYX = iter_prep_fish_channels(
+        image, channels, block_z=block_z, **_prep_kwargs(channels)
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=write_threads) as pool:
+        pending = []
+        for i, row in df_file.iterrows():
+            # bound the number of normalized channels held in memory, counting the next one
+            if len(pending) >= write_threads:
+                timing["write"] += pending.pop(0).result()
+
+            t = time.time()
+            image_ZYX = next(images_ZYX)
+            timing["normalize"] += time.time() - t
+            pending += [
+                pool.submit(
+                    _write_timed,
+                    write,
+                    row["normalized_single_channel_image"],
+                    image_ZYX,
+                    row["channel_content"],
+                    pixel_size,
+                    writer_kwargs,
+                )
+            ]
+            # only the pending write holds on to the channel
+            del image_ZYX
+        for future in pending:
+            timing["write"] += future.result()
 
-    df = pd.read_csv("data_by_channels.csv")
+    timing["wall"] = time.time() - start
+    return df_file["normalized_single_channel_image"].tolist()
+
+
+def _preprocess_job(job):
+    timing = {}
+    return {"outputs": preprocess_file(*job, timing=timing), "timing": timing}
+
+
+def preprocess_images(
+    df,
+    manifest_path=None,
+    verify=False,
+    max_workers=None,
+    worker_memory=None,
+    memory_budget=None,
+    retries=1,
+    log_path=None,
+    writer="ome-tiff",
+    writer_kwargs=None,
+    write_threads=2,
+    block_z=None,
+    timing_path=None,
+):
+    r"""
+    Normalize and save every image in df, skipping files whose outputs are up to date according to a run manifest.
+    A file is reprocessed if it is new, its size or mtime changed, PREP_PARAMS or the writer changed, or any of its outputs is missing or was modified.
+    Files are processed with brightfield2fish.data.jobs.run_jobs, failures are retried, then reported in a warning and the result log.
+
+    Args:
+        df (pd.DataFrame): data_by_channels.csv with a "normalized_single_channel_image" column
+        manifest_path (str or None): if not None, run manifest (see brightfield2fish.data.manifest) to check and append to
+        verify (bool): if True, also recompute the checksums of recorded outputs before skipping their inputs
+        max_workers (int or None): upper bound on the number of processes used for preprocessing
+        worker_memory (int or None): estimated peak bytes used to preprocess one file. If None, WORKER_MEMORY plus CHANNEL_MEMORY per write thread,
+            which fits a 5x50x624x924 czi
+        memory_budget (int or None): bytes all workers may use together, if None, the currently available memory
+        retries (int): number of times a failed file is retried
+        log_path (str or None): if not None, append a json line with the outcome and timing of every file here
+        writer (str): output format, one of WRITERS, see `preprocess_file`
+        writer_kwargs (dict or None): extra arguments for the writer, see `preprocess_file`
+        write_threads (int): number of threads writing outputs in each worker process, see `preprocess_file`
+        block_z (int or None): if not None, normalize block_z z slices at a time, see `preprocess_file`. Lower worker_memory accordingly
+        timing_path (str or None): if not None, append a json line with the decode, normalize, write and wall seconds of every processed file here
+    Returns:
+        (list): czi files that were (re)processed successfully
+    """
+    manifest = None if manifest_path is None else RunManifest(manifest_path)
+    if worker_memory is None:
+        worker_memory = WORKER_MEMORY + write_threads * CHANNEL_MEMORY
+
+    todo, params = [], {}
+    for file, df_file in df.groupby("file", sort=True):
+        params[file] = {
+            **PREP_PARAMS,
+            "channels": df_file["channel_index"].tolist(),
+            "writer": writer,
+            "writer_kwargs": writer_kwargs,
+        }
+        outputs = df_file["normalized_single_channel_image"].tolist()
+        if manifest is None or not manifest.up_to_date(
+            file, params[file], outputs=outputs, verify=verify
+        ):
+            todo += [(file, df_file, writer, writer_kwargs, write_threads, block_z)]
+
+    def record(result):
+        if not result["ok"]:
+            return
+        if manifest is not None:
+            manifest.record(
+                result["item"], params[result["item"]], result["result"]["outputs"]
+            )
+        if timing_path is not None:
+            with open(timing_path, "a") as fp:
+                line = {"item": result["item"], **result["result"]["timing"]}
+                fp.write(json.dumps(line) + "\n")
+
+    results = run_jobs(
+        _preprocess_job,
+        todo,
+        max_workers=max_workers,
+        worker_memory=worker_memory,
+        memory_budget=memory_budget,
+        retries=retries,
+        log_path=log_path,
+        key=lambda job: job[0],
+        callback=record,
+    )
+
+    failed = [r["item"] for r in results if not r["ok"]]
+    if len(failed) > 0:
+        warnings.warn(
+            "{} of {} files failed to preprocess, e.g. {}".format(
+                len(failed), len(results), failed[0]
+            )
+        )
+
+    return [r["item"] for r in results if r["ok"]]
+
+
+def add_output_paths(df, image_dir, writer="ome-tiff"):
+    r"""
+    Name the normalized single channel image of every row, "<czi name>_channel_<index><extension>" in image_dir.
+
+    Args:
+        df (pd.DataFrame): data_by_channels.csv
+        image_dir (str): directory of the normalized images
+        writer (str): output format, one of WRITERS, which sets the file extension
+    Returns:
+        (pd.DataFrame): copy of df with a "normalized_single_channel_image" column
+    """
+    df = df.copy()
     df["normalized_single_channel_image"] = (
-        preprocessed_im_dir
+        image_dir
         + os.path.sep
         + df["file"].apply(lambda x: os.path.splitext(os.path.basename(x))[0])
         + "_channel_"
         + df["channel_index"].astype(str)
-        + ".tif"
-    )
-    assert len(np.unique(df["normalized_single_channel_image"])) == len(df)
-    df.to_csv(
-        os.path.join(preprocessed_par_dir, "data_by_images_normalized.csv"), index=False
+        + WRITERS[writer][1]
     )
+    if df["normalized_single_channel_image"].duplicated().any():
+        raise ValueError("several channels map to the same normalized image path")
+    return df
 
-    def worker_full(file, df):
-        df_file = df[df["file"] == file]
-        with warnings.catch_warnings():
-            warnings.filterwarnings("ignore", category=FutureWarning)
-            image = AICSImage(file)
-        for i, row in df_file.iterrows():
-            image_ZYX = normalize(image, channel=row["channel_index"])
-            with OmeTifWriter(
-                row["normalized_single_channel_image"], overwrite_file=True
-            ) as writer:
-                writer.save(
-                    image_ZYX,
-                    channel_names=row["channel_content"],
-                    pixels_physical_size=image.get_physical_pixel_size(),
-                )
 
-    worker = functools.partial(worker_full, df=df)
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        tqdm(
-            executor.map(worker, np.unique(df["file"])),
-            total=len(np.unique(df["file"])),
+def preprocess_dataset(
+    channels_csv="data_by_channels.csv",
+    preprocessed_dir="/allen/aics/modeling/data/brightfield2fish/preprocessed",
+    out_csv=None,
+    writer="ome-tiff",
+    writer_kwargs=None,
+    max_workers=None,
+    memory_budget=None,
+    block_z=None,
+):
+    r"""
+    Normalize every channel listed in channels_csv into preprocessed_dir/images, and save the csv indexing them.
+    Files are skipped or redone according to the run manifest preprocessed_dir/manifest.jsonl, see `preprocess_images`.
+
+    Args:
+        channels_csv (str): data_by_channels.csv, or a parquet or feather version of it (see brightfield2fish.data.tables)
+        preprocessed_dir (str): directory for the normalized images, their csv, the run manifest and the preprocessing log
+        out_csv (str or None): path to save the csv of normalized images to, in the format given by its extension, if None, preprocessed_dir/data_by_images_normalized.csv
+        writer (str): output format, one of WRITERS
+        writer_kwargs (dict or None): extra arguments for the writer, see `preprocess_file`
+        max_workers (int or None): upper bound on the number of processes used for preprocessing
+        memory_budget (int or None): bytes all workers may use together, if None, the currently available memory
+        block_z (int or None): if not None, normalize block_z z slices at a time, see `preprocess_file`
+    Returns:
+        (str): out_csv
+    Raises:
+        RuntimeError: if any normalized image is missing after preprocessing
+    """
+    image_dir = os.path.join(preprocessed_dir, "images")
+    if not os.path.exists(image_dir):
+        os.makedirs(image_dir)
+    if out_csv is None:
+        out_csv = os.path.join(preprocessed_dir, "data_by_images_normalized.csv")
+
+    df = add_output_paths(read_table(channels_csv), image_dir, writer=writer)
+    write_table(df, out_csv)
+
+    preprocess_images(
+        df,
+        manifest_path=os.path.join(preprocessed_dir, "manifest.jsonl"),
+        log_path=os.path.join(preprocessed_dir, "preprocess_log.jsonl"),
+        timing_path=os.path.join(preprocessed_dir, "preprocess_timing.jsonl"),
+        max_workers=max_workers,
+        memory_budget=memory_budget,
+        writer=writer,
+        writer_kwargs=writer_kwargs,
+        block_z=block_z,
+    )
+
+    missing = [
+        p for p in df["normalized_single_channel_image"] if not os.path.exists(p)
+    ]
+    if len(missing) > 0:
+        raise RuntimeError(
+            "{} normalized images are missing, e.g. {}".format(len(missing), missing[0])
         )
+    return out_csv
+
+
+if __name__ == "__main__":
+    preprocess_dataset()
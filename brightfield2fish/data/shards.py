@@ -0,0 +1,337 @@
+"""
+This module packs the (Brightfield, Target) image pairs of a split csv (as written by split_and_save) into a few large tar shards,
+and streams them back with an IterableDataset, so that training reads a handful of big files sequentially instead of thousands of small tiffs at random.
+"""
+
+import os
+import io
+import json
+import random
+import tarfile
+import concurrent
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+
+from brightfield2fish.data.tables import read_table
+from brightfield2fish.data.utils import (
+    RandomCrop,
+    normalize_into,
+    shift_scale,
+    volume_stats,
+)
+
+INDEX_NAME = "shards.json"
+
+
+def _add_array(tar, name, arr):
+    buf = io.BytesIO()
+    np.save(buf, np.ascontiguousarray(arr))
+    info = tarfile.TarInfo(name)
+    info.size = buf.tell()
+    buf.seek(0)
+    tar.addfile(info, buf)
+
+
+def _write_shard(pairs, path):
+    from brightfield2fish.data.dataset import read_zyx
+
+    tmp_path = path + ".tmp"
+    with tarfile.open(tmp_path, "w") as tar:
+        for key, bf_path, target_path in pairs:
+            _add_array(tar, "{}.brightfield.npy".format(key), read_zyx(bf_path))
+            _add_array(tar, "{}.target.npy".format(key), read_zyx(target_path))
+    os.replace(tmp_path, path)
+    return os.path.basename(path), len(pairs)
+
+
+def export_shards(
+    df,
+    shard_dir,
+    dataset_class=None,
+    channel_content="DNA",
+    samples_per_shard=256,
+    csv=False,
+    max_workers=None,
+):
+    r"""
+    Decode every (Brightfield, Target) pair of a dataset once, and write the raw arrays into uncompressed tar shards of .npy files.
+
+    Args:
+        df (pd.DataFrame): input dataframe that specifies dataset, e.g. data/splits/train.csv
+        shard_dir (str): directory to write the shards and their json index to, created if needed
+        dataset_class (type or None): dataset class used to pair images, e.g. FishSegDataframeDatasetTIFF. If None, FishDataframeDatasetTIFF
+        channel_content (str): what content to pair with brightfield, passed to dataset_class
+        samples_per_shard (int): number of image pairs per shard
+        csv (bool): if True, accept a csv (or parquet or feather) file path rather than a DataFrame, see brightfield2fish.data.tables.read_table
+        max_workers (int or None): number of processes used to write shards
+    Returns:
+        (dict): the shard index, {"channel_content", "shards": [{"file", "samples"}, ...]}
+    """
+    if dataset_class is None:
+        from brightfield2fish.data.dataset import FishDataframeDatasetTIFF
+
+        dataset_class = FishDataframeDatasetTIFF
+
+    if csv:
+        df = read_table(df)
+
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    pairs = dataset_class(df, channel_content=channel_content).df
+    pairs = [
+        ("{:08d}".format(i), row["Brightfield"], row["Target"])
+        for i, row in pairs.iterrows()
+    ]
+    chunks = [
+        pairs[i : i + samples_per_shard]
+        for i in range(0, len(pairs), samples_per_shard)
+    ]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _write_shard, chunk, os.path.join(shard_dir, "{:06d}.tar".format(i))
+            )
+            for i, chunk in enumerate(chunks)
+        ]
+        for _ in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            pass
+
+    index = {
+        "channel_content": channel_content,
+        "shards": [
+            {"file": fname, "samples": n} for fname, n in (f.result() for f in futures)
+        ],
+    }
+    tmp_path = os.path.join(shard_dir, INDEX_NAME + ".tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(index, fp)
+    os.replace(tmp_path, os.path.join(shard_dir, INDEX_NAME))
+
+    return index
+
+
+def read_shard(path, start=0, stop=None):
+    r"""
+    Stream the image pairs of one shard, reading the tar file sequentially.
+
+    Args:
+        path (str): path to a shard written by export_shards
+        start (int): index of the first pair to yield, earlier pairs are skipped without being decoded
+        stop (int or None): if not None, index of the pair to stop before
+    Returns:
+        (generator): yields {"Brightfield": numpy.ndarray, "Target": numpy.ndarray} dicts of raw ZYX arrays
+    """
+    sample = {}
+    with tarfile.open(path, mode="r|") as tar:
+        # export_shards writes the two arrays of each pair next to each other
+        for i, member in enumerate(tar):
+            if i // 2 < start:
+                continue
+            if stop is not None and i // 2 >= stop:
+                break
+            content = member.name.rsplit(".", 2)[1]
+            arr = np.load(io.BytesIO(tar.extractfile(member).read()))
+            sample["Brightfield" if content == "brightfield" else "Target"] = arr
+            if len(sample) == 2:
+                yield sample
+                sample = {}
+
+
+def _dist_info(rank, world_size):
+    if rank is None or world_size is None:
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+    return rank, world_size
+
+
+class ShardedPairDataset(IterableDataset):
+    r"""
+    Stream (Brightfield, Target) pairs from shards written by export_shards.
+    Every epoch the shard order is reshuffled (see set_epoch), and the samples, in that order, are split into equal contiguous ranges,
+    one per DataLoader worker of every rank, so each process reads only a few shards, sequentially.
+    Every rank yields the same number of samples, as DistributedDataParallel needs to run the same number of steps on every rank,
+    so up to ranks * workers - 1 samples at the end of each epoch's order are left out.
+    Samples are shuffled within a bounded buffer, after they are normalized and cropped.
+
+    Args:
+        shard_dir (str): directory of the shards and their json index
+        shuffle_buffer (int): number of samples held in the shuffle buffer of each DataLoader worker, 0 or 1 to read in order.
+            These are crops if random_crop is set, but whole volume pairs of out_dtype otherwise (about 230 MB each for 50x624x924 float32 pairs)
+        seed (int): seed for the shard order and the shuffle buffer, identical on every rank
+        random_crop (tuple, or None): if not None, tuple of z,y,x sizes (in pixels) to which images will be randomly cropped
+        out_dtype (numpy.dtype): data type that will be output, normalization is done in place in this dtype, see `brightfield2fish.data.utils.normalize_into`
+        output_torch (boool): if True, output a torch.tensor rather than a np.array
+        channel_dim (bool): if True, include a singleton channel dimension for output 3D images
+        return_tuple (bool): if True, return images as (brightfield, target), else return as a dict
+        raw (bool): if True, skip normalization, torch conversion and the channel dim, and return raw crops plus a "norm" array, as in FishDataframeDatasetTIFF
+        rank (int or None): rank of this process, if None, taken from torch.distributed when initialized
+        world_size (int or None): number of ranks, if None, taken from torch.distributed when initialized
+
+    Example:
+        >>> dset = ShardedPairDataset("/path/to/shards/train", shuffle_buffer=64, random_crop=(32, 64, 64))
+        >>> loader = torch.utils.data.DataLoader(dset, batch_size=8, num_workers=4)
+        >>> for epoch in range(n_epochs):
+        ...     dset.set_epoch(epoch)
+        ...     for bf, target in loader:
+        ...         ...
+    """
+
+    def __init__(
+        self,
+        shard_dir,
+        shuffle_buffer=16,
+        seed=0,
+        random_crop=None,
+        out_dtype=np.float32,
+        output_torch=True,
+        channel_dim=True,
+        return_tuple=True,
+        raw=False,
+        rank=None,
+        world_size=None,
+    ):
+        with open(os.path.join(shard_dir, INDEX_NAME), "r") as fp:
+            self.index = json.load(fp)
+        self.shards = [os.path.join(shard_dir, s["file"]) for s in self.index["shards"]]
+
+        self._shuffle_buffer = shuffle_buffer
+        self._seed = seed
+        self._epoch = 0
+        self._random_crop = random_crop
+        self._out_dtype = out_dtype
+        self._output_torch = output_torch
+        self._channel_dim = channel_dim
+        self._return_tuple = return_tuple
+        self._raw = raw
+        self._rank = rank
+        self._world_size = world_size
+
+    def set_epoch(self, epoch):
+        r"""
+        Set the epoch, which reseeds the shard order and the shuffle buffer. Call it on every rank before iterating.
+
+        Args:
+            epoch (int): current epoch
+        """
+        self._epoch = epoch
+
+    def shards_for(self, rank, world_size, worker_id=0, num_workers=1):
+        r"""
+        Shards, and the range of samples within each, read by one DataLoader worker of one rank in the current epoch.
+
+        Args:
+            rank (int): rank of the process
+            world_size (int): number of ranks
+            worker_id (int): id of the DataLoader worker
+            num_workers (int): number of DataLoader workers per rank
+        Returns:
+            (list): (shard path, start, stop) tuples, see `read_shard`, whose samples add up to the same number for every worker and rank
+        """
+        order = list(range(len(self.shards)))
+        random.Random(self._seed + self._epoch).shuffle(order)
+
+        samples = [s["samples"] for s in self.index["shards"]]
+        per_process = sum(samples) // (world_size * num_workers)
+        begin = (rank * num_workers + worker_id) * per_process
+        end = begin + per_process
+
+        ranges = []
+        offset = 0
+        for i in order:
+            start, stop = max(begin - offset, 0), min(end - offset, samples[i])
+            if start < stop:
+                ranges += [(self.shards[i], start, stop)]
+            offset += samples[i]
+        return ranges
+
+    def _prepare(self, sample):
+        out = dict(sample)
+        # keep the 2d fish seg 2d, it only gets extruded along z at the very end
+        extrude = out["Target"].shape[0] == 1 and out["Brightfield"].shape[0] > 1
+        if extrude:
+            out["Target"] = out["Target"][0]
+
+        if self._raw:
+            norm = np.array(
+                [
+                    shift_scale(volume_stats(out[k], by_slice=True), content=k)
+                    for k in ("Brightfield", "Target")
+                ],
+                dtype=np.float64,
+            )
+        else:
+            out = {
+                k: normalize_into(v, content=k, dtype=self._out_dtype)
+                for k, v in out.items()
+            }
+
+        if self._random_crop is not None:
+            cropper = RandomCrop(out["Brightfield"], self._random_crop)
+            out = {k: cropper.crop(v) for k, v in out.items()}
+
+        if extrude:
+            out["Target"] = np.broadcast_to(out["Target"], out["Brightfield"].shape)
+
+        if self._raw:
+            out = {k: np.ascontiguousarray(v) for k, v in out.items()}
+            out["norm"] = norm
+        else:
+            if self._output_torch:
+                out = {
+                    k: torch.from_numpy(np.ascontiguousarray(v)) for k, v in out.items()
+                }
+            if self._channel_dim:
+                out = {k: torch.unsqueeze(v, 0) for k, v in out.items()}
+
+        if self._return_tuple:
+            out = tuple(out[k] for k in ("Brightfield", "Target", "norm") if k in out)
+
+        return out
+
+    def __iter__(self):
+        rank, world_size = _dist_info(self._rank, self._world_size)
+        worker = get_worker_info()
+        worker_id, num_workers = (
+            (0, 1) if worker is None else (worker.id, worker.num_workers)
+        )
+
+        shards = self.shards_for(rank, world_size, worker_id, num_workers)
+        rng = random.Random(
+            (self._seed + self._epoch) * world_size * num_workers
+            + rank * num_workers
+            + worker_id
+        )
+
+        # buffer prepared samples, i.e. crops rather than whole raw volumes
+        buffer = []
+        for shard, start, stop in shards:
+            for sample in read_shard(shard, start, stop):
+                sample = self._prepare(sample)
+                if self._shuffle_buffer <= 1:
+                    yield sample
+                    continue
+                buffer += [sample]
+                if len(buffer) >= self._shuffle_buffer:
+                    i = rng.randrange(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield buffer.pop()
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+if __name__ == "__main__":
+    split_dir = "data/splits"
+    shard_par_dir = "/allen/aics/modeling/data/brightfield2fish/preprocessed/shards"
+
+    for split in ("train", "valid", "test"):
+        export_shards(
+            os.path.join(split_dir, "{}.csv".format(split)),
+            os.path.join(shard_par_dir, split),
+            csv=True,
+        )
@@ -1,14 +1,82 @@
 import os
 import json
 import hashlib
+import shutil
 
 import numpy as np
 import pandas as pd
 
+from brightfield2fish.data.tables import iter_table, read_table, write_table
+
+
+def _digit_prefix(digests, N):
+    # (value of the first N decimal hex digits, number of them found) per row of digest bytes
+    nibbles = np.stack([digests >> 4, digests & 15], axis=-1).reshape(
+        len(digests), 2 * digests.shape[1]
+    )
+    is_digit = nibbles < 10
+    rank = np.cumsum(is_digit, axis=1)
+    use = is_digit & (rank <= N)
+    n_digits = np.minimum(rank[:, -1:], N)
+    power = np.where(use, n_digits - rank, 0)
+    value = np.sum(nibbles * use * np.power(10, power, dtype=np.int64), axis=1)
+    return np.stack([value, n_digits[:, 0]], axis=1)
+
+
+def hash_bins(keys, salt=1, N=5):
+    r"""
+    Deterministic pseudorandom numbers in [0,1] for keys, as used by `hashsplit`.
+    A key's number is the first N decimal digits of the hex sha512 digest of str(key) + str(salt), read as a fraction.
+    The digits are found from the digest bytes with numpy, rather than by filtering the hex string.
+
+    Args:
+        keys (list): list of str
+        salt (str): str(salt) is appended to each key before hashing
+        N (int): number of significant figures to compute for binning each key, at most 18
+
+    Returns:
+        (numpy.ndarray): one float per key
+    """
+    if N > 18:
+        raise ValueError("N must be at most 18, got {}".format(N))
+
+    digests = np.frombuffer(
+        b"".join(
+            hashlib.sha512((str(k) + str(salt)).encode("utf-8")).digest() for k in keys
+        ),
+        dtype=np.uint8,
+    ).reshape(-1, 64)
+
+    # hex digits of the digest, in order, of which the first N decimal ones are read as a number.
+    # the first few bytes almost always hold N decimal digits, so only fall back to the whole digest for rows where they don't
+    nums = _digit_prefix(digests[:, : N + 4], N)
+    short = np.flatnonzero(nums[:, 1] < N)
+    if len(short) > 0:
+        nums[short] = _digit_prefix(digests[short], N)
+
+    return nums[:, 0] / 10 ** N
+
+
+def group_keys(df, by):
+    r"""
+    Split keys of the rows of a dataframe, so that rows with the same values in the by columns end up in the same split.
+
+    Args:
+        df (pd.DataFrame): dataframe to split
+        by (str or list): column, or list of columns, e.g. "file", or ["plate", "well"]
+
+    Returns:
+        (pd.Series): one key per row. For a single column, the column itself, for several columns, their values joined with "/"
+    """
+    if isinstance(by, str):
+        return df[by]
+    return df[list(by)].astype(str).agg("/".join, axis=1)
+
 
 def hashsplit(X, splits={"train": 0.8, "test": 0.2}, salt=1, N=5):
     r"""
     Splits a list of items pseudorandomly (but deterministically) based on the hashes of the items.
+    Each distinct item is hashed once, and items that are equal as strings always end up in the same split, so repeated items (e.g. one file per channel) act as groups.
 
     Args:
         X (list): list of items to be split into non-overlapping groups
@@ -34,21 +102,15 @@ def hashsplit(X, splits={"train": 0.8, "test": 0.2}, salt=1, N=5):
         k: [bounds[i], bounds[i + 1]] for i, (k, v) in enumerate(sorted(splits.items()))
     }
 
-    # hash the strings deterministically
-    hashes = [
-        hashlib.sha512((str(x) + str(salt)).encode("utf-8")).hexdigest() for x in X
-    ]
-
-    # create some numbers in [0,1] (at N sig figs) from the hashes
-    nums = np.array(
-        [float("".join(filter(str.isdigit, h))[:N]) / 10 ** N for h in hashes]
-    )
+    # hash each distinct item once, then broadcast the numbers in [0,1] back to the items
+    inverse, keys = pd.factorize(pd.Series([str(x) for x in X], dtype=object))
+    nums = hash_bins(keys, salt=salt, N=N)[inverse]
 
     # check where the nums fall in [0,1] relative to the bins left and right boundaries
-    inds = {k: np.where((nums > l) & (nums <= r)) for k, (l, r) in bins.items()}
-
-    # np.where returns a singleton tuple containing an np array, so convert to list
-    return {k: list(*v) for k, v in inds.items()}
+    return {
+        k: np.flatnonzero((nums > l) & (nums <= r)).tolist()
+        for k, (l, r) in bins.items()
+    }
 
 
 def split_and_save(
@@ -58,22 +120,24 @@ def split_and_save(
     save_dir="data/splits",
     splits={"train": 0.7, "valid": 0.15, "test": 0.15},
     seed=0,
+    ext=".csv",
 ):
 
     r"""
     Split a csv dataset and save the splits and indices to disk.
 
     Args:
-        csv_name (str): csv to be split into non-overlapping groups
+        csv_name (str): csv (or parquet or feather, by extension, see brightfield2fish.data.tables) to be split into non-overlapping groups
         csv_dir (str): path to directory in which csv resides
-        split_col (str): column to use as id for splitting into groups
+        split_col (str or list): column, or list of columns, to use as id for splitting into groups, see `group_keys`
         save_dir (str): path to directory where split csvs and indices should be saved
         splits (dict): dict of {name:size} by which to split data
         seed (int): salt fir the hash fuction that does the splitting
+        ext (str): file extension of the saved splits, which sets their format, e.g. ".csv" or ".parquet"
     """
 
-    df = pd.read_csv(os.path.join(csv_dir, csv_name))
-    splits = hashsplit(df[split_col], splits=splits, salt=seed)
+    df = read_table(os.path.join(csv_dir, csv_name))
+    splits = hashsplit(group_keys(df, split_col), splits=splits, salt=seed)
 
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
@@ -83,6 +147,137 @@ def split_and_save(
 
     for k, v in splits.items():
         df_subset = df.iloc[v, :].reset_index(drop=True)
-        fname = "{}.csv".format(k)
+        fname = "{}{}".format(k, ext)
         fpath = os.path.join(save_dir, fname)
-        df_subset.to_csv(fpath, index=False)
+        write_table(df_subset, fpath)
+
+
+MEMBERSHIP_NAME = "membership.npy"
+PARTS_NAME = "parts.json"
+# membership code of rows that fall in no split, i.e. whose hash number is exactly 0
+NO_SPLIT = 255
+
+
+def stream_split_and_save(
+    csv_name="data_by_images_normalized.csv",
+    csv_dir="/allen/aics/modeling/data/brightfield2fish/preprocessed",
+    split_col="file",
+    save_dir="data/splits",
+    splits={"train": 0.7, "valid": 0.15, "test": 0.15},
+    seed=0,
+    chunksize=2 ** 17,
+    file_format="csv",
+    dtype=None,
+):
+    r"""
+    Streaming version of `split_and_save` for manifests too large to load at once.
+    The csv is read chunksize rows at a time, and since every row's split only depends on the hash of its key, the splits are identical to `split_and_save`.
+    Each chunk's rows are appended to its splits as one part file per chunk, save_dir/<split>/part-<chunk>.<file_format>,
+    and each row's split is saved as one byte per row in save_dir/membership.npy, with the split names, part files and counts in save_dir/parts.json.
+    Memory use is bounded by the chunk size, independently of the size of the manifest.
+
+    Args:
+        csv_name (str): csv (or parquet or feather, by extension, see brightfield2fish.data.tables.iter_table) to be split into non-overlapping groups
+        csv_dir (str): path to directory in which csv resides
+        split_col (str or list): column, or list of columns, to use as id for splitting into groups, see `group_keys`
+        save_dir (str): path to directory where split parts and membership should be saved
+        splits (dict): dict of {name:size} by which to split data, at most 255 splits
+        seed (int): salt for the hash fuction that does the splitting
+        chunksize (int): number of csv rows read at a time
+        file_format (str): "csv", or the smaller and faster to read "parquet" or "feather", which need pyarrow (see brightfield2fish.data.tables)
+        dtype (dict or None): {column: dtype} passed to pd.read_csv, for csv input. Column types are otherwise inferred chunk by chunk,
+            so pin any column whose type inference may differ between chunks, e.g. one that mixes numbers and strings
+
+    Returns:
+        (dict): the parts.json index, {"splits", "rows", "counts", "parts"}
+    """
+    if file_format not in ("parquet", "feather", "csv"):
+        raise ValueError("unknown file format {}".format(file_format))
+    names = sorted(splits)
+    if len(names) >= NO_SPLIT:
+        raise ValueError("at most {} splits are supported".format(NO_SPLIT))
+
+    # clear parts of a previous run, which may have had more chunks
+    for name in names:
+        split_dir = os.path.join(save_dir, name)
+        if not os.path.exists(split_dir):
+            os.makedirs(split_dir)
+        for fname in os.listdir(split_dir):
+            if fname.startswith("part-"):
+                os.remove(os.path.join(split_dir, fname))
+
+    index = {"splits": names, "rows": 0, "counts": {k: 0 for k in names}}
+    index["parts"] = {k: [] for k in names}
+
+    codes_path = os.path.join(save_dir, MEMBERSHIP_NAME + ".codes.tmp")
+    with open(codes_path, "wb") as fp:
+        reader = iter_table(
+            os.path.join(csv_dir, csv_name), chunksize=chunksize, dtype=dtype
+        )
+        for i, chunk in enumerate(reader):
+            inds = hashsplit(group_keys(chunk, split_col), splits=splits, salt=seed)
+            codes = np.full(len(chunk), NO_SPLIT, dtype=np.uint8)
+            for code, name in enumerate(names):
+                codes[inds[name]] = code
+                if len(inds[name]) == 0:
+                    continue
+                fname = os.path.join(name, "part-{:05d}.{}".format(i, file_format))
+                write_table(chunk.iloc[inds[name]], os.path.join(save_dir, fname))
+                index["parts"][name] += [fname]
+                index["counts"][name] += len(inds[name])
+            fp.write(codes.tobytes())
+            index["rows"] += len(chunk)
+
+    # prepend an npy header, now that the number of rows is known, so the membership can be memory mapped with np.load
+    tmp_path = os.path.join(save_dir, MEMBERSHIP_NAME + ".tmp")
+    with open(tmp_path, "wb") as fp:
+        np.lib.format.write_array_header_1_0(
+            fp, {"descr": "|u1", "fortran_order": False, "shape": (index["rows"],)}
+        )
+        with open(codes_path, "rb") as fp_codes:
+            shutil.copyfileobj(fp_codes, fp)
+    os.replace(tmp_path, os.path.join(save_dir, MEMBERSHIP_NAME))
+    os.remove(codes_path)
+
+    tmp_path = os.path.join(save_dir, PARTS_NAME + ".tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(index, fp)
+    os.replace(tmp_path, os.path.join(save_dir, PARTS_NAME))
+
+    return index
+
+
+def read_split(save_dir, split, dtype=None):
+    r"""
+    Read one split saved by `stream_split_and_save` into a dataframe.
+
+    Args:
+        save_dir (str): directory the split parts were saved in
+        split (str): name of the split, e.g. "train"
+        dtype (dict or None): {column: dtype} passed to pd.read_csv for csv parts, see `stream_split_and_save`
+
+    Returns:
+        (pd.DataFrame): rows of the split, in manifest order
+    """
+    with open(os.path.join(save_dir, PARTS_NAME), "r") as fp:
+        parts = json.load(fp)["parts"][split]
+    dfs = [read_table(os.path.join(save_dir, p), dtype=dtype) for p in parts]
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    return pd.concat(dfs, ignore_index=True)
+
+
+def split_membership(save_dir):
+    r"""
+    Which split every manifest row is in, as saved by `stream_split_and_save`.
+
+    Args:
+        save_dir (str): directory the split parts were saved in
+
+    Returns:
+        (dict): {name: row indices} for every split, as in splits.json from `split_and_save`
+    """
+    with open(os.path.join(save_dir, PARTS_NAME), "r") as fp:
+        names = json.load(fp)["splits"]
+    codes = np.load(os.path.join(save_dir, MEMBERSHIP_NAME), mmap_mode="r")
+    return {k: np.flatnonzero(codes == i).tolist() for i, k in enumerate(names)}
@@ -0,0 +1,139 @@
+"""
+This module computes per-image normalization statistics (mean, std, min, max, and percentiles with their neighbouring order statistics) once, in parallel,
+and saves them to a sidecar csv keyed by file path, size and mtime, so the datasets can look them up instead of recomputing them every sample.
+"""
+
+import os
+import concurrent
+import functools
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from brightfield2fish.data.tables import read_table, write_table
+from brightfield2fish.data.utils import (
+    volume_stats,
+    percentile,
+    percentile_key,
+    percentile_neighbours,
+)
+
+KEY_COLUMNS = ["path", "size", "mtime"]
+NEIGHBOURS = ["lower", "upper"]
+
+
+def file_key(path):
+    r"""
+    Identify the current version of a file by its path, size and modification time.
+
+    Args:
+        path (str): path to the file
+    Returns:
+        (dict): path, size and mtime of the file
+    """
+    st = os.stat(path)
+    return {"path": path, "size": st.st_size, "mtime": st.st_mtime}
+
+
+def image_stats(path, percentiles=(0.01, 99.99), math_dtype=np.float64):
+    r"""
+    Compute whole-volume normalization statistics for a single channel 3D image.
+
+    Args:
+        path (str): path to the image file
+        percentiles (tuple): percentiles of pixel intensity to record, e.g. the brightfield clip percentiles
+        math_dtype (numpy.dtype): data type in which statistics are computed, should match the datasets' math_dtype
+    Returns:
+        (dict): path, size, mtime, mean, std, min, max, and per percentile its value and the order statistics below and above it
+            (see `brightfield2fish.data.utils.percentile_neighbours`)
+    """
+    from brightfield2fish.data.dataset import read_zyx
+
+    key = file_key(path)
+    raw = read_zyx(path)
+    out = {**key, **volume_stats(raw.astype(math_dtype))}
+    if len(percentiles) > 0:
+        neighbours = percentile_neighbours(raw, list(percentiles))
+        values = percentile(raw, list(percentiles), neighbours=neighbours)
+        values = np.asarray(values, dtype=math_dtype)
+        out.update({percentile_key(q): v for q, v in zip(percentiles, values)})
+        for side, row in zip(NEIGHBOURS, neighbours):
+            out.update({percentile_key(q, side): v for q, v in zip(percentiles, row)})
+    return out
+
+
+def compute_stats_index(
+    paths,
+    csv_path=None,
+    percentiles=(0.01, 99.99),
+    math_dtype=np.float64,
+    max_workers=None,
+):
+    r"""
+    Compute normalization statistics for many images in parallel, reusing up-to-date rows from an existing stats index.
+
+    Args:
+        paths (list): image file paths, e.g. df["normalized_single_channel_image"]
+        csv_path (str or None): if not None, sidecar csv (or parquet or feather, by extension) to read existing stats from and save the updated index to
+        percentiles (tuple): percentiles of pixel intensity to record
+        math_dtype (numpy.dtype): data type in which statistics are computed
+        max_workers (int or None): number of processes used to compute statistics
+    Returns:
+        (pd.DataFrame): one row of statistics per image
+    """
+    paths = sorted(set(paths))
+
+    # keep rows whose files haven't changed, as long as they have all the percentiles (and their neighbours) we want
+    keys = [
+        percentile_key(q, side) for q in percentiles for side in [None] + NEIGHBOURS
+    ]
+    df_keep = pd.DataFrame(columns=KEY_COLUMNS)
+    if csv_path is not None and os.path.exists(csv_path):
+        df_old = read_table(csv_path, float_precision="round_trip")
+        if all(k in df_old for k in keys):
+            current = pd.DataFrame([file_key(p) for p in paths], columns=KEY_COLUMNS)
+            df_keep = df_old.merge(current, how="inner", on=KEY_COLUMNS)
+    todo = [p for p in paths if p not in set(df_keep["path"])]
+
+    worker = functools.partial(
+        image_stats, percentiles=percentiles, math_dtype=math_dtype
+    )
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        rows = list(tqdm(executor.map(worker, todo), total=len(todo)))
+
+    frames = [f for f in (df_keep, pd.DataFrame(rows)) if len(f) > 0]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=KEY_COLUMNS)
+    df = pd.concat(frames, ignore_index=True, sort=False)
+    df = df.sort_values("path").reset_index(drop=True)
+
+    if csv_path is not None:
+        write_table(df, csv_path)
+
+    return df
+
+
+def load_stats_index(stats, check_files=True):
+    r"""
+    Load a stats index as a lookup table for the datasets.
+
+    Args:
+        stats (str or pd.DataFrame): path to a sidecar table written by compute_stats_index, or the dataframe it returned
+        check_files (bool): if True, drop entries whose file size or mtime no longer match the file on disk
+    Returns:
+        (dict): {path: {"mean", "std", "min", "max", "percentile_*", "percentile_*_lower", "percentile_*_upper"}}
+    """
+    df = (
+        read_table(stats, float_precision="round_trip")
+        if isinstance(stats, str)
+        else stats
+    )
+
+    if check_files:
+        current = pd.DataFrame(
+            [file_key(p) for p in df["path"] if os.path.exists(p)], columns=KEY_COLUMNS,
+        )
+        df = df.merge(current, how="inner", on=KEY_COLUMNS)
+
+    df = df.drop(["size", "mtime"], axis=1).set_index("path")
+    return df.to_dict(orient="index")
@@ -0,0 +1,155 @@
+"""
+This module reads and writes the dataframes exchanged between preprocessing stages and read by the datasets (e.g. data_by_channels.csv or the split csvs),
+in a format chosen by file extension: csv, or the typed, columnar parquet (.parquet, .pq) and feather (.feather, .arrow) formats.
+In the columnar formats, string columns with many repeated values (e.g. file paths repeated per channel, or channel_content) are dictionary encoded,
+so they are stored, parsed and held in memory once per distinct value. The columnar formats need pyarrow (the pyarrow extra of setup.py), which is only imported when they are used.
+"""
+
+import os
+import pandas as pd
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+FEATHER_EXTENSIONS = (".feather", ".arrow")
+
+
+def table_format(path):
+    r"""
+    Format of a table file, by its extension.
+
+    Args:
+        path (str): file path
+    Returns:
+        (str): "parquet", "feather", or "csv" for any other extension
+    """
+    path = str(path).lower()
+    if path.endswith(PARQUET_EXTENSIONS):
+        return "parquet"
+    if path.endswith(FEATHER_EXTENSIONS):
+        return "feather"
+    return "csv"
+
+
+def _require_pyarrow(path):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError(
+            "pyarrow is needed to read and write {}, install it with `pip install pyarrow`, or use a .csv path".format(
+                path
+            )
+        )
+
+
+def dictionary_encode(df, max_unique_fraction=0.5):
+    r"""
+    Convert string columns with many repeated values to categoricals, which the columnar formats store dictionary encoded.
+
+    Args:
+        df (pd.DataFrame): dataframe
+        max_unique_fraction (float): encode a column if its number of distinct values is at most this fraction of its rows
+    Returns:
+        (pd.DataFrame): copy of df with categorical columns
+    """
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        values = df[col].dropna()
+        if not all(isinstance(v, str) for v in values):
+            continue
+        if df[col].nunique() <= max_unique_fraction * len(df):
+            df[col] = df[col].astype("category")
+    return df
+
+
+def write_table(df, path, max_unique_fraction=0.5):
+    r"""
+    Save a dataframe, without its index, in the format given by the path's extension (see `table_format`).
+    The file is written to a temporary path first and then moved into place.
+
+    Args:
+        df (pd.DataFrame): dataframe to save
+        path (str): output path
+        max_unique_fraction (float): for columnar formats, see `dictionary_encode`
+    Returns:
+        (str): path
+    """
+    fmt = table_format(path)
+    tmp_path = path + ".tmp"
+    if fmt == "csv":
+        df.to_csv(tmp_path, index=False)
+    else:
+        _require_pyarrow(path)
+        df = dictionary_encode(df, max_unique_fraction=max_unique_fraction)
+        if fmt == "parquet":
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.reset_index(drop=True).to_feather(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_table(path, columns=None, categorical=False, **csv_kwargs):
+    r"""
+    Read a dataframe in the format given by the path's extension (see `table_format`).
+
+    Args:
+        path (str): input path
+        columns (list or None): if not None, only read these columns
+        categorical (bool): if True, keep dictionary encoded columns as categoricals, else return them as object columns, whose repeated strings are still shared
+        **csv_kwargs: extra arguments for pd.read_csv, e.g. dtype or float_precision, ignored for columnar formats
+    Returns:
+        (pd.DataFrame): the table
+    """
+    fmt = table_format(path)
+    if fmt == "csv":
+        return pd.read_csv(path, usecols=columns, **csv_kwargs)
+
+    _require_pyarrow(path)
+    if fmt == "parquet":
+        df = pd.read_parquet(path, columns=columns)
+    else:
+        df = pd.read_feather(path, columns=columns)
+    if not categorical:
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(object)
+    return df
+
+
+def iter_table(path, chunksize, **csv_kwargs):
+    r"""
+    Read a table chunksize rows at a time, without loading all of it.
+
+    Args:
+        path (str): input path
+        chunksize (int): number of rows per chunk. Feather files are read one record batch at a time, whatever their size
+        **csv_kwargs: extra arguments for pd.read_csv, ignored for columnar formats
+    Returns:
+        (generator): yields pd.DataFrame chunks, whose index continues from one chunk to the next
+    """
+    fmt = table_format(path)
+    if fmt == "csv":
+        yield from pd.read_csv(path, chunksize=chunksize, **csv_kwargs)
+        return
+
+    _require_pyarrow(path)
+    if fmt == "parquet":
+        import pyarrow.parquet
+
+        batches = pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunksize)
+    else:
+        import pyarrow.ipc
+
+        reader = pyarrow.ipc.open_file(path)
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+
+    start = 0
+    for batch in batches:
+        df = batch.to_pandas()
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(object)
+        df.index = pd.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
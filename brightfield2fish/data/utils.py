@@ -1,71 +1,340 @@
 import random
+import warnings
 import numpy as np
 import torch
 from functools import partial
 from PIL import Image
 
 
-def normalize_image_zero_one(im):
+def normalize_image_zero_one(im, stats=None):
     r"""
     Normalize a Numpy array to have min zero and max one.
 
     Args:
         im (numpy.ndarray): data matrix
+        stats (dict or None): if not None, use stats["min"] and stats["max"] (e.g. of the whole volume im was cropped from) instead of those of im
     Returns:
         (numpy.ndarray): normalized data matrix
     """
+    if stats is not None:
+        im = im - stats["min"]
+        if stats["max"] - stats["min"] > 0:
+            im = im / (stats["max"] - stats["min"])
+        return im
     im = im - np.min(im)
     if np.max(im) > 0:
         im = im / np.max(im)
     return im
 
 
-def normalize_image_center_scale(im):
+def normalize_image_center_scale(im, stats=None):
     r"""
     Normalize a Numpy array to have mean zero and variance one.
 
     Args:
         im (numpy.ndarray): data matrix
+        stats (dict or None): if not None, use stats["mean"] and stats["std"] (e.g. of the whole volume im was cropped from) instead of those of im
     Returns:
         (numpy.ndarray): normalized data matrix
     """
+    if stats is not None:
+        return (im - stats["mean"]) / stats["std"]
     im = im - np.mean(im)
     im = im / np.std(im)
     return im
 
 
-def normalize_image_zero_one_torch(im):
+def normalize_image_zero_one_torch(im, stats=None, batch_dims=0):
     r"""
     Normalize a Pytorch tensor to have min zero and max one.
 
     Args:
         im (torch.Tensor): data matrix
+        stats (dict or None): if not None, use stats["min"] and stats["max"] instead of those of im, as scalars or as tensors with one value per sample
+        batch_dims (int): number of leading dimensions of im indexing samples, each of which is normalized on its own
     Returns:
         (torch.Tensor): normalized data matrix
     """
-    im = im - torch.min(im)
-    if torch.max(im) > 0:
-        im = im / torch.max(im)
-    return im
+    if stats is None:
+        lo, hi = _min_max(_orderable(_flat_samples(im, batch_dims)))
+        stats = {"min": lo, "max": hi}
+    lo = _per_sample(stats["min"], im, batch_dims)
+    scale = _per_sample(stats["max"], im, batch_dims) - lo
+    return (im - lo) / torch.where(scale > 0, scale, torch.ones_like(scale))
 
 
-def normalize(im, content="Brightfield"):
+def normalize(im, content="Brightfield", stats=None):
     r"""
     Normalize a numpy array to either have min zero and max one, or mean zero and unit variance, depending on the `content` arg.
 
     Args:
         im (numpy.ndarray): data matrix
         content (str): content of the image to normalize.  If `content="Brightfield"`, normalize to mean zero and unit variaince, else normalize to min zero and max one.
+        stats (dict or None): if not None, precomputed statistics (see `volume_stats`) to normalize with instead of those of im
     Returns:
         (numpy.ndarray): normalized data matrix
     """
     return (
-        normalize_image_center_scale(im)
+        normalize_image_center_scale(im, stats=stats)
         if content == "Brightfield"
-        else normalize_image_zero_one(im)
+        else normalize_image_zero_one(im, stats=stats)
     )
 
 
+def volume_stats(im, by_slice=False):
+    r"""
+    Compute the whole-volume statistics used by `normalize`, so that crops of the volume can later be normalized exactly as the whole volume would be.
+
+    Args:
+        im (numpy.ndarray): data matrix, in the dtype normalization will be done in
+        by_slice (bool): if True, accumulate the statistics in float64 one slice (along the first axis) at a time, rather than making full size temporaries of im
+    Returns:
+        (dict): mean, std, min and max of im
+    """
+    if not by_slice:
+        return {
+            "mean": np.mean(im),
+            "std": np.std(im),
+            "min": np.min(im),
+            "max": np.max(im),
+        }
+
+    slices = im.reshape(-1, *im.shape[-2:]) if im.ndim > 2 else im[np.newaxis]
+    mean = sum(s.sum(dtype=np.float64) for s in slices) / im.size
+    sq_dev = 0.0
+    for s in slices:
+        d = s.astype(np.float64).ravel() - mean
+        sq_dev += np.dot(d, d)
+    return {
+        "mean": mean,
+        "std": np.sqrt(sq_dev / im.size),
+        "min": np.float64(min(s.min() for s in slices)),
+        "max": np.float64(max(s.max() for s in slices)),
+    }
+
+
+def _histogrammable(im):
+    return np.issubdtype(im.dtype, np.integer) and im.dtype.itemsize <= 2
+
+
+def order_statistics(im, ranks, chunk_size=2 ** 22):
+    r"""
+    Values at some positions of the sorted, flattened array.
+    For 8 and 16 bit integer arrays (e.g. raw uint16 microscopy data), these come from a full-range histogram, built in linear time
+    and in chunks, without sorting or copying the data to float. Other arrays are partitioned.
+
+    Args:
+        im (numpy.ndarray): data matrix
+        ranks (list): positions in the sorted array, in [0, im.size)
+        chunk_size (int): number of elements counted at a time in the histogram path
+    Returns:
+        (numpy.ndarray): values of im.dtype, one per rank
+    """
+    ranks = np.asarray(ranks, dtype=np.intp)
+    if not _histogrammable(im):
+        return np.partition(im.ravel(), np.unique(ranks))[ranks]
+    return _ranked(_histogram([im], im.dtype, chunk_size=chunk_size), ranks, im.dtype)
+
+
+def _histogram(blocks, dtype, chunk_size=2 ** 22):
+    # full-range histogram of 8 or 16 bit integer blocks, counted chunk_size elements at a time
+    info = np.iinfo(dtype)
+    counts = np.zeros(int(info.max) - int(info.min) + 1, dtype=np.int64)
+    for block in blocks:
+        flat = np.asarray(block).ravel()
+        for i in range(0, flat.size, chunk_size):
+            chunk = flat[i : i + chunk_size]
+            if info.min < 0:
+                chunk = chunk.astype(np.int32) - int(info.min)
+            counts += np.bincount(chunk, minlength=len(counts))
+    return counts
+
+
+def _ranked(counts, ranks, dtype):
+    # values at some positions of the sorted data a histogram was built from
+    info = np.iinfo(dtype)
+    values = np.searchsorted(np.cumsum(counts), ranks, side="right") + int(info.min)
+    return values.astype(dtype)
+
+
+def _percentile_ranks(n, q):
+    # ranks of the order statistics below and above each percentile, and the weight of the upper one, as numpy's linear method places them
+    quantiles = np.asanyarray(np.true_divide(q, 100))
+    virtual = np.asanyarray((n - 1) * quantiles)
+    previous = np.asanyarray(np.floor(virtual))
+    following = np.asanyarray(previous + 1)
+    previous[virtual >= n - 1], following[virtual >= n - 1] = n - 1, n - 1
+    previous[virtual < 0], following[virtual < 0] = 0, 0
+    gamma = np.asanyarray(virtual - np.floor(virtual), dtype=virtual.dtype)
+    return np.stack([previous, following]).astype(np.intp), gamma
+
+
+def _linear_percentile(n, q, order_stats):
+    # numpy's linear method, on the needed order statistics only
+    ranks, gamma = _percentile_ranks(n, q)
+    a, b = order_stats(ranks.ravel()).reshape(ranks.shape)
+    diff_b_a = np.subtract(b, a)
+    out = np.asanyarray(np.add(a, diff_b_a * gamma))
+    np.subtract(
+        b, diff_b_a * (1 - gamma), out=out, where=gamma >= 0.5, casting="unsafe"
+    )
+    return out[()] if out.ndim == 0 else out
+
+
+def _clipped_median(n, order_stats, a_min=None, a_max=None):
+    # clipping preserves order, so the middle of the clipped array is the clipped middle
+    middle = order_stats(sorted({(n - 1) // 2, n // 2}))
+    if a_min is not None or a_max is not None:
+        middle = np.clip(middle, a_min, a_max)
+    return np.mean(middle)
+
+
+def percentile_neighbours(im, q):
+    r"""
+    The order statistics of im below and above each percentile, from which `percentile` interpolates.
+    Stored alongside the stats of an image (see brightfield2fish.data.stats_index), they give exact percentiles of im, and of any
+    non-decreasing function of it, without looking at im again.
+
+    Args:
+        im (numpy.ndarray): data matrix
+        q (float or list): percentile or percentiles, in [0, 100]
+    Returns:
+        (numpy.ndarray): values of im.dtype, of shape (2,) + np.shape(q), the lower neighbours first
+    """
+    ranks, _ = _percentile_ranks(im.size, q)
+    return order_statistics(im, ranks.ravel()).reshape(ranks.shape)
+
+
+def percentile(im, q, transform=None, neighbours=None):
+    r"""
+    Exact drop-in for np.percentile(im, q) with the default "linear" method, linear time for 8 and 16 bit integer arrays (see `order_statistics`).
+
+    Args:
+        im (numpy.ndarray): data matrix
+        q (float or list): percentile or percentiles, in [0, 100]
+        transform (callable or None): if not None, a non-decreasing elementwise function of arrays (e.g. a cast and `normalize` with fixed stats),
+            and the result is exactly np.percentile(transform(im), q), computed by transforming only the needed order statistics of im
+        neighbours (array-like or None): if not None, the result of `percentile_neighbours(im, q)`, e.g. from a stats index, used instead of
+            the order statistics of im
+    Returns:
+        (numpy.float64 or numpy.ndarray): percentiles of im, as np.percentile returns them
+    """
+    if neighbours is not None:
+        neighbours = np.asarray(neighbours, dtype=im.dtype).ravel()
+        if transform is not None:
+            neighbours = transform(neighbours)
+        return _linear_percentile(im.size, q, lambda ranks: neighbours)
+    if not _histogrammable(im):
+        return np.percentile(im if transform is None else transform(im), q)
+    if transform is None:
+        return _linear_percentile(im.size, q, partial(order_statistics, im))
+
+    # a non-decreasing function maps the order statistics of im to those of transform(im)
+    def order_stats(ranks):
+        return transform(order_statistics(im, ranks))
+
+    return _linear_percentile(im.size, q, order_stats)
+
+
+def median(im, a_min=None, a_max=None):
+    r"""
+    Exact drop-in for np.median(np.clip(im, a_min, a_max)) over the whole array, without making the clipped copy.
+    Linear time for 8 and 16 bit integer arrays (see `order_statistics`).
+
+    Args:
+        im (numpy.ndarray): data matrix
+        a_min (float or None): if not None, lower clip bound
+        a_max (float or None): if not None, upper clip bound
+    Returns:
+        (numpy.float64): median of the clipped im
+    """
+    return _clipped_median(im.size, partial(order_statistics, im), a_min, a_max)
+
+
+def percentile_key(q, neighbour=None):
+    r"""
+    Name of the key under which a percentile is stored in a stats dict (see `volume_stats` and brightfield2fish.data.stats_index).
+
+    Args:
+        q (float): percentile, e.g. 99.99
+        neighbour (str or None): "lower" or "upper" for the key of the order statistic on that side of the percentile (see `percentile_neighbours`)
+    Returns:
+        (str): key, e.g. "percentile_99.99" or "percentile_99.99_lower"
+    """
+    key = "percentile_{}".format(float(q))
+    return key if neighbour is None else "{}_{}".format(key, neighbour)
+
+
+def shift_scale(stats, content="Brightfield"):
+    r"""
+    Express `normalize` as (im - shift) / scale, for the given whole-volume statistics.
+
+    Args:
+        stats (dict): statistics of the image (see `volume_stats`)
+        content (str): content of the image to normalize, as in `normalize`
+    Returns:
+        (tuple): (shift, scale)
+    """
+    if content == "Brightfield":
+        return stats["mean"], stats["std"]
+    scale = stats["max"] - stats["min"]
+    return stats["min"], scale if scale > 0 else 1.0
+
+
+def normalize_into(
+    im,
+    content="Brightfield",
+    stats=None,
+    clip_percentiles=None,
+    renormalize=True,
+    out=None,
+    dtype=np.float32,
+):
+    r"""
+    Fused, in place version of the cast / clip / `normalize` chain.
+    All the work happens in a single output buffer of `dtype`, instead of in several full size float64 copies of the data.
+
+    Args:
+        im (numpy.ndarray): data matrix, of any numeric dtype
+        content (str): content of the image to normalize, as in `normalize`
+        stats (dict or None): if not None, precomputed statistics of im (see `volume_stats`), optionally with clip percentiles (see `percentile_key`)
+        clip_percentiles (list or None): if not None, lower and upper percentiles of pixel intensity at which to clip the image
+        renormalize (bool): if True, normalize the clipped image, else clip the normalized image
+        out (numpy.ndarray or None): preallocated output buffer of the same shape as im, if None one is allocated
+        dtype (numpy.dtype): data type of the allocated output buffer
+    Returns:
+        (numpy.ndarray): normalized data matrix
+    """
+    if out is None:
+        out = np.empty(im.shape, dtype=dtype)
+    np.copyto(out, im, casting="unsafe")
+
+    bounds = None
+    if clip_percentiles is not None:
+        keys = [percentile_key(q) for q in clip_percentiles]
+        if stats is not None and all(k in stats for k in keys):
+            bounds = [stats[k] for k in keys]
+        else:
+            bounds = percentile(
+                im, clip_percentiles, transform=partial(np.asarray, dtype=out.dtype)
+            )
+        if renormalize:
+            np.clip(out, bounds[0], bounds[1], out=out)
+            stats, bounds = None, None
+
+    if stats is None:
+        stats = volume_stats(out, by_slice=True)
+
+    shift, scale = shift_scale(stats, content=content)
+    np.subtract(out, shift, out=out)
+    np.divide(out, scale, out=out)
+
+    if bounds is not None:
+        np.clip(out, (bounds[0] - shift) / scale, (bounds[1] - shift) / scale, out=out)
+
+    return out
+
+
 def float_to_uint(im, uint_dtype=np.uint8):
     r"""
     Convert an array of floats to unsigned ints, contrast stretrching so to the dynamic range of the output data type.
@@ -91,6 +360,7 @@ def prep_fish(
     median_subtract=True,
     math_dtype=np.float64,
     out_dtype=np.uint16,
+    block_z=None,
 ):
     r"""
     Normalize a Numpy array to have min zero and max one.
@@ -103,25 +373,498 @@ def prep_fish(
         median_subtract (bool): if True, set all pixels below the median value to zero
         math_dtype (numpy.dtype): numpy dtype in which internal computations are performed
         out_dtype (numpy.dtype): numpy dtype in for output array
+        block_z (int or None): if not None, normalize block_z z slices at a time (see `prep_fish_blocks`), so that only one block is held in math_dtype rather than the whole volume
     Returns:
         (numpy.ndarray): normalized data single channel 3D array
     """
-    img3d = image.get_image_data("ZYX", T=T, C=channel)
-    img3d = img3d.astype(math_dtype)
-    img3d = np.clip(
-        img3d,
-        a_min=np.percentile(img3d, clip_percentiles[0]),
-        a_max=np.percentile(img3d, clip_percentiles[1]),
+    raw = image.get_image_data("ZYX", T=T, C=channel)
+    if block_z is not None:
+        return np.asarray(
+            prep_fish_blocks(
+                raw,
+                clip_percentiles=clip_percentiles,
+                median_subtract=median_subtract,
+                math_dtype=math_dtype,
+                out_dtype=out_dtype,
+                block_z=block_z,
+            )
+        )
+    return _prep_channel(
+        raw,
+        clip_percentiles=clip_percentiles,
+        median_subtract=median_subtract,
+        math_dtype=math_dtype,
+        out_dtype=out_dtype,
     )
-    if median_subtract:
-        img3d -= np.median(img3d)
-        img3d[img3d < 0] = 0
+
+
+def _prep_channel(raw, clip_percentiles, median_subtract, math_dtype, out_dtype):
+    # clip bounds and median come from the raw (e.g. uint16) data, see `percentile`
+    a_min, a_max = np.asarray(percentile(raw, clip_percentiles), dtype=math_dtype)
+    med = median(raw, a_min, a_max) if median_subtract else None
+    img3d = _clip_subtract(raw.astype(math_dtype), a_min, a_max, med)
     img3d = normalize_image_zero_one(img3d)
     if "uint" in str(out_dtype):
         img3d = float_to_uint(img3d, uint_dtype=out_dtype)
     return img3d
 
 
+def _clip_subtract(img, a_min, a_max, med):
+    # in place clip and median subtraction of prep_fish, shared by the in memory and block-wise paths so they agree bit for bit
+    np.clip(img, a_min, a_max, out=img)
+    if med is not None:
+        img -= med
+        img[img < 0] = 0
+    return img
+
+
+class ZBlocks:
+    r"""
+    A ZYX volume as consecutive blocks of z slices, computed one at a time as they are iterated over (e.g. by `prep_fish_blocks`), so it can only be iterated over once.
+    np.asarray assembles the blocks into an array, and brightfield2fish.data.chunked.write_chunked writes them as they come.
+
+    Args:
+        blocks (iterable): blocks of z slices, in order
+        shape (tuple): shape of the whole volume
+        dtype (numpy.dtype): data type of the blocks
+    """
+
+    def __init__(self, blocks, shape, dtype):
+        self._blocks = iter(blocks)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        return self._blocks
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.empty(self.shape, dtype=self.dtype)
+        z = 0
+        for block in self:
+            out[z : z + len(block)] = block
+            z += len(block)
+        if z != self.shape[0]:
+            raise ValueError("got {} z slices, expected {}".format(z, self.shape[0]))
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+
+def prep_fish_blocks(
+    raw,
+    clip_percentiles=[0, 99.99],
+    median_subtract=True,
+    math_dtype=np.float64,
+    out_dtype=np.uint16,
+    block_z=8,
+):
+    r"""
+    Out of core version of the normalization done by `prep_fish`, in two passes over blocks of z slices of a raw volume.
+    The first pass accumulates a histogram of the raw values, from which come the clip percentiles, the median, and the extremes of the normalized volume.
+    The second pass clips, median subtracts, scales and converts one block at a time, as the returned blocks are iterated over.
+    Peak memory is a few block sized math_dtype temporaries instead of several whole volume ones, and the output is identical to `prep_fish`.
+
+    Args:
+        raw (numpy.ndarray): raw 8 or 16 bit integer ZYX data, or anything with shape and dtype that can be sliced along z, e.g. a numpy.memmap or a brightfield2fish.data.chunked.ChunkedVolume
+        clip_percentiles (list): min and max percentiles of pixel values at which to clip image signal
+        median_subtract (bool): if True, set all pixels below the median value to zero
+        math_dtype (numpy.dtype): numpy dtype in which internal computations are performed
+        out_dtype (numpy.dtype): numpy dtype in for output array
+        block_z (int): number of z slices read and normalized at a time
+    Returns:
+        (ZBlocks): normalized data single channel 3D array, as blocks of block_z z slices
+    Raises:
+        TypeError: if raw is not 8 or 16 bit integer data, whose percentiles can't be accumulated block by block
+
+    Example:
+        >>> blocks = prep_fish_blocks(ChunkedVolume("/path/to/raw.cvol"), block_z=4)
+        >>> write_chunked("/path/to/prepped.cvol", blocks)
+    """
+    dtype = np.dtype(raw.dtype)
+    if not (np.issubdtype(dtype, np.integer) and dtype.itemsize <= 2):
+        raise TypeError(
+            "block-wise prep needs 8 or 16 bit integer data, got {}".format(dtype)
+        )
+
+    def read_blocks():
+        for z in range(0, raw.shape[0], block_z):
+            yield np.asarray(raw[z : z + block_z])
+
+    n = int(np.prod(raw.shape))
+    order_stats = partial(_ranked, _histogram(read_blocks(), dtype), dtype=dtype)
+    a_min, a_max = np.asarray(
+        _linear_percentile(n, clip_percentiles, order_stats), dtype=math_dtype
+    )
+    med = _clipped_median(n, order_stats, a_min, a_max) if median_subtract else None
+    # clipping and subtracting preserve order, so the extremes of the whole prepped volume are the prepped raw extremes
+    lo, hi = _clip_subtract(
+        order_stats([0, n - 1]).astype(math_dtype), a_min, a_max, med
+    )
+    # as in `normalize_image_zero_one`, whose max after subtracting the min is hi - lo
+    scale = hi - lo
+
+    def blocks():
+        for block in read_blocks():
+            img = _clip_subtract(block.astype(math_dtype), a_min, a_max, med)
+            img = img - lo
+            if scale > 0:
+                img = img / scale
+            if "uint" in str(out_dtype):
+                img = float_to_uint(img, uint_dtype=out_dtype)
+            yield img
+
+    return ZBlocks(
+        blocks(), raw.shape, out_dtype if "uint" in str(out_dtype) else math_dtype
+    )
+
+
+def iter_prep_fish_channels(
+    image,
+    channels,
+    T=0,
+    clip_percentiles=[[0, 99.99]],
+    median_subtract=[True],
+    math_dtype=np.float64,
+    out_dtype=np.uint16,
+    block_z=None,
+):
+    r"""
+    Generator version of `prep_fish_channels`, which normalizes each channel only when it is requested,
+    so that e.g. one channel can be written to disk while the next is normalized.
+
+    Args:
+        image (aicsimageio.AICSImage): input image object
+        channels (list): channels to select for prep
+        T (int): time point to select for prep
+        clip_percentiles (list): per channel [min, max] percentiles of pixel values at which to clip image signal, or a single pair for all channels
+        median_subtract (list): per channel bools, if True, set all pixels below the median value to zero, or a single bool for all channels
+        math_dtype (numpy.dtype): numpy dtype in which internal computations are performed
+        out_dtype (numpy.dtype): numpy dtype in for output array
+        block_z (int or None): if not None, yield each channel as ZBlocks of block_z z slices, normalized as they are iterated over, see `prep_fish_blocks`
+    Returns:
+        (generator): yields normalized data single channel 3D arrays, one per channel
+    """
+    channels = list(channels)
+    if np.ndim(clip_percentiles) == 1:
+        clip_percentiles = [clip_percentiles]
+    clip_percentiles = np.broadcast_to(
+        np.asarray(clip_percentiles, dtype=np.float64), (len(channels), 2)
+    )
+    median_subtract = np.broadcast_to(median_subtract, (len(channels),))
+
+    img4d = image.get_image_data("CZYX", T=T)[channels]
+
+    for i in range(len(channels)):
+        if block_z is not None:
+            yield prep_fish_blocks(
+                img4d[i],
+                clip_percentiles=clip_percentiles[i],
+                median_subtract=median_subtract[i],
+                math_dtype=math_dtype,
+                out_dtype=out_dtype,
+                block_z=block_z,
+            )
+            continue
+        yield _prep_channel(
+            img4d[i],
+            clip_percentiles=clip_percentiles[i],
+            median_subtract=median_subtract[i],
+            math_dtype=math_dtype,
+            out_dtype=out_dtype,
+        )
+
+
+def prep_fish_channels(
+    image,
+    channels,
+    T=0,
+    clip_percentiles=[[0, 99.99]],
+    median_subtract=[True],
+    math_dtype=np.float64,
+    out_dtype=np.uint16,
+):
+    r"""
+    Batch version of `prep_fish`, for several channels of the same image.
+    The image is decoded once into a CZYX array, and the clip percentiles and medians of every channel are computed from histograms of the raw data (see `percentile`).
+    Only one channel at a time is cast to math_dtype, and results are identical to calling `prep_fish` per channel.
+
+    Args:
+        image (aicsimageio.AICSImage): input image object
+        channels (list): channels to select for prep
+        T (int): time point to select for prep
+        clip_percentiles (list): per channel [min, max] percentiles of pixel values at which to clip image signal, or a single pair for all channels
+        median_subtract (list): per channel bools, if True, set all pixels below the median value to zero, or a single bool for all channels
+        math_dtype (numpy.dtype): numpy dtype in which internal computations are performed
+        out_dtype (numpy.dtype): numpy dtype in for output array
+    Returns:
+        (list): normalized data single channel 3D arrays, one per channel
+    """
+    return list(
+        iter_prep_fish_channels(
+            image,
+            channels,
+            T=T,
+            clip_percentiles=clip_percentiles,
+            median_subtract=median_subtract,
+            math_dtype=math_dtype,
+            out_dtype=out_dtype,
+        )
+    )
+
+
+def to_tensor(a):
+    r"""
+    torch.from_numpy, also for dtypes this version of torch can't wrap (e.g. uint16 before torch 2.3), which are widened losslessly,
+    and without warnings for read only arrays (e.g. memory maps), which should only be copied from.
+
+    Args:
+        a (numpy.ndarray): array
+    Returns:
+        (torch.Tensor): tensor sharing memory with a where possible
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            return torch.from_numpy(a)
+    except TypeError:
+        return torch.from_numpy(a.astype(np.promote_types(a.dtype, np.int8)))
+
+
+def _flat_samples(im, batch_dims):
+    return im.reshape(im.shape[:batch_dims] + (-1,))
+
+
+def _per_sample(value, im, batch_dims):
+    # a scalar, or one value per sample, shaped to broadcast against im
+    value = torch.as_tensor(value, dtype=im.dtype, device=im.device)
+    return value.reshape(value.shape + (1,) * (im.dim() - value.dim()))
+
+
+def _orderable(im):
+    # cpu min/max and selection kernels don't cover every unsigned integer type (e.g. uint16), so widen those losslessly
+    if im.is_floating_point() or im.dtype in (torch.int32, torch.int64):
+        return im
+    return im.to(torch.int32 if im.element_size() <= 2 else torch.int64)
+
+
+def _min_max(flat):
+    # per sample min and max along the last dimension, as torch.aminmax (torch 1.11) gives them
+    return flat.min(dim=-1)[0], flat.max(dim=-1)[0]
+
+
+def _std_mean(flat):
+    # population std and mean along the last dimension, as torch.std_mean(flat, dim=-1, unbiased=False) gives them
+    return flat.std(dim=-1, unbiased=False), flat.mean(dim=-1)
+
+
+def _stats_dtype(im):
+    return im.dtype if im.is_floating_point() else torch.float64
+
+
+def volume_stats_torch(im, batch_dims=0):
+    r"""
+    Torch version of `volume_stats`, for whole volumes or batches of them.
+
+    Args:
+        im (torch.Tensor): data matrix, in the dtype normalization will be done in
+        batch_dims (int): number of leading dimensions of im indexing samples, each of which gets its own statistics
+    Returns:
+        (dict): mean, std, min and max of im, as tensors of shape im.shape[:batch_dims]
+    """
+    flat = _flat_samples(im, batch_dims)
+    std, mean = _std_mean(flat.to(_stats_dtype(im)))
+    lo, hi = _min_max(_orderable(flat))
+    return {"mean": mean, "std": std, "min": lo, "max": hi}
+
+
+def normalize_image_center_scale_torch(im, stats=None, batch_dims=0):
+    r"""
+    Normalize a Pytorch tensor to have mean zero and variance one.
+
+    Args:
+        im (torch.Tensor): data matrix, floating point
+        stats (dict or None): if not None, use stats["mean"] and stats["std"] instead of those of im, as scalars or as tensors with one value per sample
+        batch_dims (int): number of leading dimensions of im indexing samples, each of which is normalized on its own
+    Returns:
+        (torch.Tensor): normalized data matrix
+    """
+    if stats is None:
+        std, mean = _std_mean(_flat_samples(im, batch_dims))
+        stats = {"mean": mean, "std": std}
+    return (im - _per_sample(stats["mean"], im, batch_dims)) / _per_sample(
+        stats["std"], im, batch_dims
+    )
+
+
+def normalize_torch(im, content="Brightfield", stats=None, batch_dims=0):
+    r"""
+    Torch version of `normalize`. With stats from `volume_stats` or a stats index, crops are normalized as the whole volume would be.
+    Statistics are cast to the dtype of im, so e.g. a float32 tensor is normalized in float32.
+
+    Args:
+        im (torch.Tensor): data matrix, floating point
+        content (str): content of the image to normalize, as in `normalize`
+        stats (dict or None): if not None, precomputed statistics to normalize with instead of those of im, as scalars or as tensors with one value per sample
+        batch_dims (int): number of leading dimensions of im indexing samples, each of which is normalized on its own
+
+    Example:
+        >>> batch = torch.from_numpy(crops).to(torch.float32)  # (N, Z, Y, X)
+        >>> batch = normalize_torch(batch, content="DNA", batch_dims=1)
+    """
+    if content == "Brightfield":
+        return normalize_image_center_scale_torch(
+            im, stats=stats, batch_dims=batch_dims
+        )
+    return normalize_image_zero_one_torch(im, stats=stats, batch_dims=batch_dims)
+
+
+def _order_statistics_torch(flat, ranks):
+    # values at the given ranks along the last dimension, stacked along a new first one
+    if flat.is_floating_point() or flat.element_size() > 2:
+        values = {r: torch.kthvalue(flat, r + 1, dim=-1).values for r in set(ranks)}
+        return torch.stack([values[r] for r in ranks])
+
+    # one full-range histogram per sample for 8 and 16 bit integers, as in `order_statistics`
+    info = torch.iinfo(flat.dtype)
+    n_bins = int(info.max) - int(info.min) + 1
+    rows = flat.reshape(-1, flat.shape[-1])
+    bins = rows.to(torch.int64 if len(rows) * n_bins > 2 ** 31 else torch.int32)
+    bins = bins - int(info.min) + n_bins * torch.arange(len(rows)).to(bins).unsqueeze(1)
+    counts = torch.bincount(bins.ravel(), minlength=len(rows) * n_bins)
+    ranks = torch.as_tensor(ranks, dtype=torch.int64).repeat(len(rows), 1)
+    # the bin holding each rank, as torch.searchsorted(cumsum, ranks, right=True) (torch 1.6) finds it
+    cumsum = counts.reshape(len(rows), n_bins).cumsum(-1)
+    values = (cumsum.unsqueeze(1) <= ranks.unsqueeze(-1)).sum(-1)
+    return (values + int(info.min)).T.reshape((ranks.shape[1],) + flat.shape[:-1])
+
+
+def percentile_torch(im, q, batch_dims=0):
+    r"""
+    Torch version of `percentile`, i.e. np.percentile with the default "linear" method, from per sample histograms for 8 and 16 bit integers (see `order_statistics`) and by selection otherwise.
+    Exactly equal to np.percentile for integer tensors, whose percentiles are computed in float64.
+
+    Args:
+        im (torch.Tensor): data matrix
+        q (float or list): percentile or percentiles, in [0, 100]
+        batch_dims (int): number of leading dimensions of im indexing samples, each of which gets its own percentiles
+    Returns:
+        (torch.Tensor): percentiles of im, of shape np.shape(q) + im.shape[:batch_dims]
+    """
+    flat = _flat_samples(im, batch_dims)
+    n = flat.shape[-1]
+    q = np.asarray(q, dtype=np.float64)
+    virtual = (n - 1) * np.true_divide(q, 100).ravel()
+    previous = np.clip(np.floor(virtual), 0, n - 1).astype(int)
+    following = np.clip(np.floor(virtual) + 1, 0, n - 1).astype(int)
+
+    dtype = _stats_dtype(im)
+    a, b = (
+        _order_statistics_torch(flat, list(previous) + list(following))
+        .to(dtype)
+        .reshape((2, len(virtual)) + flat.shape[:-1])
+    )
+    gamma = torch.as_tensor(virtual - np.floor(virtual), dtype=dtype, device=im.device)
+    gamma = gamma.reshape(gamma.shape + (1,) * (a.dim() - 1))
+    diff_b_a = b - a
+    out = torch.where(gamma >= 0.5, b - diff_b_a * (1 - gamma), a + diff_b_a * gamma)
+    return out.reshape(q.shape + out.shape[1:])
+
+
+def median_torch(im, a_min=None, a_max=None, batch_dims=0):
+    r"""
+    Torch version of `median`, the median of im clipped to [a_min, a_max], without making the clipped copy.
+
+    Args:
+        im (torch.Tensor): data matrix
+        a_min (float, torch.Tensor or None): if not None, lower clip bound, a scalar or one value per sample
+        a_max (float, torch.Tensor or None): if not None, upper clip bound, a scalar or one value per sample
+        batch_dims (int): number of leading dimensions of im indexing samples, each of which gets its own median
+    Returns:
+        (torch.Tensor): medians, of shape im.shape[:batch_dims]
+    """
+    flat = _flat_samples(im, batch_dims)
+    n = flat.shape[-1]
+    dtype = _stats_dtype(im)
+    middle = _order_statistics_torch(flat, sorted({(n - 1) // 2, n // 2})).to(dtype)
+    if a_min is not None or a_max is not None:
+        # elementwise, as torch.clamp only takes tensor bounds from torch 1.9
+        if a_min is not None:
+            middle = torch.max(middle, torch.as_tensor(a_min, dtype=dtype))
+        if a_max is not None:
+            middle = torch.min(middle, torch.as_tensor(a_max, dtype=dtype))
+    return middle.mean(0)
+
+
+def float_to_uint_torch(im, uint_dtype=torch.uint8):
+    r"""
+    Torch version of `float_to_uint`, contrast stretching floats in [0, 1] to the dynamic range of an unsigned integer type.
+
+    Args:
+        im (torch.Tensor): data matrix
+        uint_dtype (torch.dtype): unsigned integer type, e.g. torch.uint8
+    Returns:
+        (torch.Tensor): integer data matrix
+    """
+    imax = torch.iinfo(uint_dtype).max + 1  # eg imax = 256 for uint8
+    return _stretch_torch(im, imax, uint_dtype)
+
+
+def _stretch_torch(im, imax, dtype):
+    im = im * imax
+    im.masked_fill_(im == imax, imax - 1)
+    return im.to(dtype)
+
+
+def prep_fish_torch(
+    im,
+    clip_percentiles=[0, 99.99],
+    median_subtract=True,
+    math_dtype=torch.float64,
+    out_dtype=None,
+    batch_dims=0,
+):
+    r"""
+    Torch version of the normalization done by `prep_fish`, for a raw volume or a batch of them (e.g. the channels of a CZYX image).
+    With the default float64 math_dtype, the output is identical to `prep_fish`.
+    Every step runs in torch's intra-op thread pool, so its size is set with torch.set_num_threads.
+
+    Args:
+        im (torch.Tensor): raw data, e.g. a ZYX volume
+        clip_percentiles (list): min and max percentiles of pixel values at which to clip image signal
+        median_subtract (bool): if True, set all pixels below the median value to zero
+        math_dtype (torch.dtype): torch dtype in which internal computations are performed
+        out_dtype (torch.dtype or None): torch dtype for the output tensor. If None, the uint16 range of `prep_fish`, as torch.uint16,
+            or held losslessly in torch.int32 by versions of torch without uint16 (before 2.3)
+        batch_dims (int): number of leading dimensions of im indexing volumes, each of which is normalized on its own
+    Returns:
+        (torch.Tensor): normalized data of the same shape as im
+
+    Example:
+        >>> torch.set_num_threads(8)
+        >>> raw = torch.from_numpy(image.get_image_data("CZYX", T=0))
+        >>> prepped = prep_fish_torch(raw, batch_dims=1)
+    """
+    a_min, a_max = percentile_torch(im, clip_percentiles, batch_dims=batch_dims).to(
+        math_dtype
+    )
+    out = im.to(math_dtype, copy=True)
+    torch.max(out, _per_sample(a_min, out, batch_dims), out=out)
+    torch.min(out, _per_sample(a_max, out, batch_dims), out=out)
+    if median_subtract:
+        out -= _per_sample(
+            median_torch(im, a_min, a_max, batch_dims=batch_dims), out, batch_dims
+        )
+        out.clamp_(min=0)
+    out = normalize_image_zero_one_torch(out, batch_dims=batch_dims)
+    if out_dtype is None:
+        return _stretch_torch(out, 2 ** 16, getattr(torch, "uint16", torch.int32))
+    if "uint" in str(out_dtype):
+        out = float_to_uint_torch(out, uint_dtype=out_dtype)
+    return out
+
+
 def plot_prepped(img3d, reduce_3D_to_2D=partial(np.percentile, q=100, axis=0)):
     r"""
     Plots a 2D projection of a 3D image by returning a PIL Image object.
@@ -142,7 +885,7 @@ class RandomCrop:
     Takes an input  numpy array (e.g. a 3D image) and randomly sets a crop region of size crop_size. Can then apply that specific random crop to other images with the crop method.  Useful for data augmentation on paired images.
 
     Args:
-        array (numpy.ndarray): numpy array whose size and shape will be used in selecting a random region to crop
+        array (numpy.ndarray or tuple): numpy array (or just its shape) whose size and shape will be used in selecting a random region to crop
         crop_size (tuple): tuple of ints of length array.ndim, e.g. (z,y,x) for 3D, specifying the size of the region to select for cropping within the bounds set by array.shape
 
     Example:
@@ -155,16 +898,37 @@ class RandomCrop:
     """
 
     def __init__(self, array, crop_size):
-        start = [random.randint(0, s - c) for s, c in zip(array.shape, crop_size)]
+        shape = array if isinstance(array, tuple) else array.shape
+        start = [random.randint(0, s - c) for s, c in zip(shape, crop_size)]
         self.slices = tuple(slice(s, s + c) for s, c in zip(start, crop_size))
 
-    def crop(self, X):
+    def crop(self, X, origin=None):
         r"""
         Perform random crop on a new data array.
 
         Args:
-            X (numpy.ndarray): array to crop, same size as the array used to initialize the RandomCrop object
+            X (numpy.ndarray): array to crop, same size as the array used to initialize the RandomCrop object, or with fewer dimensions (e.g. a 2D y,x image for a 3D z,y,x crop), in which case only its trailing dimensions are cropped
+            origin (tuple or None): if not None, X is a sub-block of such an array whose first element sits at this index, e.g. the starts of `bounding_slices`
         Returns:
             (numpy.ndarray): cropped array
         """
-        return X[self.slices]
+        slices = self.slices[len(self.slices) - X.ndim :]
+        if origin is None:
+            return X[slices]
+        origin = origin[len(origin) - X.ndim :]
+        return X[tuple(slice(s.start - o, s.stop - o) for s, o in zip(slices, origin))]
+
+
+def bounding_slices(croppers):
+    r"""
+    Smallest block containing the crop regions of several RandomCrop objects, so it can be read once and cropped many times.
+
+    Args:
+        croppers (list): list of RandomCrop objects
+    Returns:
+        (tuple): tuple of slices, one per dimension
+    """
+    return tuple(
+        slice(min(s.start for s in dim), max(s.stop for s in dim))
+        for dim in zip(*[c.slices for c in croppers])
+    )
@@ -0,0 +1,148 @@
+"""
+This module converts single channel 3D images (e.g. the normalized tiffs written by preprocess_images.py)
+into a store of raw, memory-mappable arrays with a small json index, and reads them back with np.memmap.
+"""
+
+import os
+import json
+import hashlib
+import concurrent
+import numpy as np
+from tqdm import tqdm
+
+INDEX_NAME = "index.json"
+
+
+def store_key(path):
+    r"""
+    File name under which an image is saved in a volume store.
+
+    Args:
+        path (str): path to the original image file
+    Returns:
+        (str): raw array file name
+    """
+    return hashlib.sha1(str(path).encode("utf-8")).hexdigest() + ".raw"
+
+
+def _convert_one(path, store_dir):
+    from brightfield2fish.data.dataset import read_zyx
+
+    arr = np.ascontiguousarray(read_zyx(path))
+    fname = store_key(path)
+    tmp_path = os.path.join(store_dir, fname + ".tmp")
+    arr.tofile(tmp_path)
+    os.replace(tmp_path, os.path.join(store_dir, fname))
+    return path, {"file": fname, "shape": list(arr.shape), "dtype": arr.dtype.str}
+
+
+def convert_to_store(
+    df,
+    store_dir,
+    columns=("normalized_single_channel_image",),
+    overwrite=False,
+    max_workers=None,
+):
+    r"""
+    Write every image referenced in some columns of a dataframe to a memory-mappable volume store.
+
+    Args:
+        df (pd.DataFrame): dataframe with image paths, e.g. from data_by_images_normalized.csv
+        store_dir (str): directory of the volume store, created if needed
+        columns (tuple): columns of df containing image paths, e.g. ("normalized_single_channel_image", "fish segmetation path")
+        overwrite (bool): if True, re-convert images already in the store
+        max_workers (int or None): number of processes used for conversion
+    Returns:
+        (dict): the store index, {image path: {"file", "shape", "dtype"}}
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    index_path = os.path.join(store_dir, INDEX_NAME)
+    index = {}
+    if os.path.exists(index_path) and not overwrite:
+        with open(index_path, "r") as fp:
+            index = json.load(fp)
+
+    paths = sorted(
+        set(p for c in columns if c in df.columns for p in df[c].dropna().unique())
+    )
+    todo = [p for p in paths if p not in index]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_convert_one, p, store_dir) for p in todo]
+        for future in tqdm(
+            concurrent.futures.as_completed(futures), total=len(futures)
+        ):
+            path, entry = future.result()
+            index[path] = entry
+
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(index, fp)
+    os.replace(tmp_path, index_path)
+
+    return index
+
+
+class VolumeStore:
+    r"""
+    Read only access to a volume store written by convert_to_store.
+    Arrays are returned as np.memmap, so slicing them only touches the pages that are needed.
+
+    Args:
+        store_dir (str): directory of the volume store
+
+    Example:
+        >>> store = VolumeStore("/path/to/store")
+        >>> arr = store.read("/path/to/image_channel_0.tif")
+        >>> crop = np.asarray(arr[10:42, 100:164, 200:264])
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, INDEX_NAME), "r") as fp:
+            self.index = json.load(fp)
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def shape(self, path):
+        r"""
+        Shape of a stored volume, without touching its pixels.
+
+        Args:
+            path (str): path to the original image file
+        Returns:
+            (tuple): array shape
+        """
+        return tuple(self.index[path]["shape"])
+
+    def read(self, path):
+        r"""
+        Memory map a stored volume.
+
+        Args:
+            path (str): path to the original image file
+        Returns:
+            (numpy.memmap): read only array
+        """
+        entry = self.index[path]
+        return np.memmap(
+            os.path.join(self.store_dir, entry["file"]),
+            dtype=np.dtype(entry["dtype"]),
+            mode="r",
+            shape=tuple(entry["shape"]),
+        )
+
+
+if __name__ == "__main__":
+    from brightfield2fish.data.tables import read_table
+
+    preprocessed_par_dir = "/allen/aics/modeling/data/brightfield2fish/preprocessed"
+
+    df = read_table(os.path.join(preprocessed_par_dir, "data_by_images_normalized.csv"))
+    convert_to_store(df, os.path.join(preprocessed_par_dir, "volume_store"))
@@ -0,0 +1,103 @@
+import multiprocessing
+import numpy as np
+import torch
+
+from brightfield2fish.data.cache import SharedVolumeCache
+
+
+def _put_in_child(cache, key, arr):
+    cache.put(key, arr)
+
+
+def test_SharedVolumeCache_get_put():
+    cache = SharedVolumeCache(max_bytes=2 ** 20)
+    arr = np.random.randint(low=0, high=2 ** 16 - 1, size=(2, 3, 4), dtype=np.uint16)
+
+    assert cache.get("foo") is None
+    assert cache.put("foo", arr)
+    out = cache.get("foo")
+    assert out.dtype == arr.dtype and np.array_equal(out, arr)
+
+    out = cache.get_or_load("foo", lambda: None)
+    assert np.array_equal(out, arr)
+
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 1
+    assert stats["volumes"] == 1 and stats["bytes"] == arr.nbytes
+
+    cache.clear()
+    assert len(cache) == 0 and cache.stats()["bytes"] == 0
+
+
+def test_SharedVolumeCache_lru_eviction():
+    arr = np.zeros((10, 10), dtype=np.uint8)
+    cache = SharedVolumeCache(max_bytes=2 * arr.nbytes)
+
+    cache.put("a", arr)
+    cache.put("b", arr)
+    _ = cache.get("a")
+    cache.put("c", arr)
+
+    assert "a" in cache and "c" in cache and "b" not in cache
+    assert cache.stats()["evictions"] == 1
+    assert not cache.put("big", np.zeros(3 * arr.nbytes, dtype=np.uint8))
+
+    cache.clear()
+
+
+def test_SharedVolumeCache_across_processes():
+    cache = SharedVolumeCache(max_bytes=2 ** 20)
+    arr = np.random.rand(3, 4, 5)
+
+    proc = multiprocessing.Process(target=_put_in_child, args=(cache, "foo", arr))
+    proc.start()
+    proc.join()
+
+    assert np.array_equal(cache.get("foo"), arr)
+    cache.clear()
+
+
+class _CachedDataset(torch.utils.data.Dataset):
+    def __init__(self, cache, arrays):
+        self.cache = cache
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def __getitem__(self, idx):
+        return self.cache.get_or_load(str(idx), lambda: self.arrays[idx])
+
+
+def test_SharedVolumeCache_dataloader_epochs(n_epochs=2):
+    cache = SharedVolumeCache(max_bytes=2 ** 20)
+    arrays = [np.random.rand(3, 4, 5) for _ in range(4)]
+    dset = _CachedDataset(cache, arrays)
+
+    # non persistent workers exit after every epoch, the blocks they cached must survive them
+    loader = torch.utils.data.DataLoader(dset, batch_size=None, num_workers=2)
+    for epoch in range(n_epochs):
+        for idx, out in enumerate(loader):
+            assert np.array_equal(out.numpy(), arrays[idx])
+
+    stats = cache.stats()
+    assert stats["volumes"] == len(arrays)
+    assert stats["misses"] == len(arrays)
+    assert stats["hits"] == (n_epochs - 1) * len(arrays)
+    cache.clear()
+
+
+def test_SharedVolumeCache_missing_block():
+    from multiprocessing import shared_memory
+
+    cache = SharedVolumeCache(max_bytes=2 ** 20)
+    arr = np.random.rand(3, 4, 5)
+    cache.put("foo", arr)
+
+    # e.g. unlinked by a process that exited
+    shm = shared_memory.SharedMemory(name=cache._index["foo"]["name"])
+    shm.close()
+    shm.unlink()
+
+    assert cache.get("foo") is None
+    assert "foo" not in cache and cache.stats()["bytes"] == 0
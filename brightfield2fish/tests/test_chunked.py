@@ -0,0 +1,86 @@
+import itertools
+import os
+import numpy as np
+import pytest
+
+from brightfield2fish.data.chunked import ChunkedVolume, read_chunked, write_chunked
+from brightfield2fish.data.dataset import read_zyx, read_zyx_crop, read_zyx_shape
+from brightfield2fish.data.utils import ZBlocks
+
+
+def test_write_chunked():
+    arr = np.random.randint(low=0, high=2 ** 16 - 1, size=(7, 19, 23), dtype=np.uint16)
+    for codec, shuffle in itertools.product(
+        ("none", "zlib", "lzma", "bz2"), (True, False)
+    ):
+        fpath = os.path.join("tmp_tests", "foo_{}_{}.cvol".format(codec, shuffle))
+        _check_chunked(fpath, arr, codec, shuffle)
+
+
+def _check_chunked(fpath, arr, codec, shuffle):
+    write_chunked(
+        fpath, arr, chunks=(3, 5, 8), codec=codec, shuffle=shuffle, attrs={"a": 1}
+    )
+
+    vol = ChunkedVolume(fpath)
+    assert vol.shape == arr.shape
+    assert vol.dtype == arr.dtype
+    assert vol.attrs == {"a": 1}
+    assert np.array_equal(vol.read(), arr)
+    assert np.array_equal(vol[2:6, 4:17], arr[2:6, 4:17])
+    assert np.array_equal(vol[-1:, :1, 22:], arr[-1:, :1, 22:])
+    assert np.array_equal(
+        read_chunked(fpath, (slice(1, 4), slice(5, 10), slice(8, 16))),
+        arr[1:4, 5:10, 8:16],
+    )
+
+
+def test_write_chunked_empty():
+    fpath = os.path.join("tmp_tests", "foo_empty.cvol")
+    for shape in ((0, 19, 23), (7, 0, 23), (7, 19, 0), (0, 0, 0)):
+        arr = np.zeros(shape, dtype=np.uint16)
+        header = write_chunked(fpath, arr, chunks=(3, 5, 8))
+        assert min(header["chunks"]) >= 1
+        assert header["offsets"] == []
+
+        vol = ChunkedVolume(fpath)
+        assert vol.shape == shape
+        assert np.array_equal(vol.read(), arr)
+        assert vol[1:4, 2:9].shape == arr[1:4, 2:9].shape
+
+    write_chunked(fpath, ZBlocks([], (0, 19, 23), np.uint16), chunks=(3, 5, 8))
+    assert read_chunked(fpath).shape == (0, 19, 23)
+
+
+def test_write_chunked_blocks():
+    arr = np.random.randint(low=0, high=2 ** 16 - 1, size=(7, 19, 23), dtype=np.uint16)
+    fpath = os.path.join("tmp_tests", "foo_blocks.cvol")
+
+    # uneven blocks are regrouped into chunk deep slabs
+    for bounds in ([0, 7], [0, 1, 2, 6, 7], [0, 3, 6, 7], [0, 5, 7]):
+        blocks = (arr[a:b] for a, b in zip(bounds[:-1], bounds[1:]))
+        write_chunked(fpath, ZBlocks(blocks, arr.shape, arr.dtype), chunks=(3, 5, 8))
+        with open(fpath, "rb") as fp:
+            assert fp.read() == _chunked_bytes(arr, chunks=(3, 5, 8))
+        assert np.array_equal(read_chunked(fpath), arr)
+
+    with pytest.raises(ValueError):
+        write_chunked(fpath, ZBlocks([arr[:3]], arr.shape, arr.dtype))
+
+
+def _chunked_bytes(arr, **kwargs):
+    fpath = os.path.join("tmp_tests", "foo_blocks_ref.cvol")
+    write_chunked(fpath, arr, **kwargs)
+    with open(fpath, "rb") as fp:
+        return fp.read()
+
+
+def test_read_zyx_chunked():
+    fpath = os.path.join("tmp_tests", "foo_read.cvol")
+    arr = np.random.randint(low=0, high=2 ** 16 - 1, size=(4, 5, 6), dtype=np.uint16)
+    write_chunked(fpath, arr, chunks=(2, 2, 2))
+
+    slices = (slice(1, 3), slice(0, 4), slice(2, 5))
+    assert np.array_equal(read_zyx(fpath), arr)
+    assert read_zyx_shape(fpath) == arr.shape
+    assert np.array_equal(read_zyx_crop(fpath, slices), arr[slices])
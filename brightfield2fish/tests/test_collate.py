@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+
+from brightfield2fish.data.collate import collate_crops, NormalizeAugmentCollate
+
+
+def test_collate_crops(batch_size=4, n_crops=3, shape=(1, 2, 3, 4)):
+    batch = [
+        (torch.randn(n_crops, *shape), torch.randn(n_crops, *shape))
+        for _ in range(batch_size)
+    ]
+    bf, target = collate_crops(batch)
+    assert bf.shape == target.shape == (batch_size * n_crops, *shape)
+    assert torch.equal(bf[n_crops], batch[1][0][0])
+
+    batch = [{"Brightfield": b, "Target": t} for b, t in batch]
+    out = collate_crops(batch)
+    assert out["Brightfield"].shape == (batch_size * n_crops, *shape)
+
+
+def test_NormalizeAugmentCollate(batch_size=4, n_crops=2, shape=(2, 3, 3)):
+    batch = []
+    for _ in range(batch_size):
+        arr = np.random.randint(
+            low=0, high=2 ** 16 - 1, size=(n_crops, *shape), dtype=np.uint16
+        )
+        arr[0, 0, 0, 0] = 2 ** 16 - 1  # beyond the float16 range before normalizing
+        norm = np.array([[arr.mean(), arr.std()], [arr.mean(), arr.std()]])
+        batch += [(arr, arr.copy(), norm)]
+
+    bf, target = NormalizeAugmentCollate()(batch)
+    assert bf.shape == (batch_size * n_crops, 1, *shape) and bf.dtype == torch.float32
+    expected = (batch[1][0][0] - batch[1][2][0, 0]) / batch[1][2][0, 1]
+    assert np.allclose(bf[n_crops, 0].numpy(), expected, atol=1e-5)
+
+    bf_half, _ = NormalizeAugmentCollate(dtype=torch.float16)(batch)
+    assert bf_half.dtype == torch.float16
+    assert np.allclose(bf_half.float().numpy(), bf.numpy(), atol=1e-2)
+
+    collate = NormalizeAugmentCollate(
+        flip=True, rot90=True, generator=torch.Generator().manual_seed(0)
+    )
+    bf, target = collate(batch)
+    assert torch.equal(bf, target)
@@ -1,12 +1,21 @@
 import os
+import random
 import numpy as np
 import pandas as pd
+import torch
 
-from aicsimageio import OmeTifWriter
+import brightfield2fish.data.utils as utils_module
+from aicsimageio import AICSImage, OmeTifWriter
+from brightfield2fish.data.cache import SharedVolumeCache
+from brightfield2fish.data.collate import NormalizeAugmentCollate, collate_extrude
 from brightfield2fish.data.dataset import (
     FishDataframeDatasetTIFF,
+    FishMultiDataframeDatasetTIFF,
     FishSegDataframeDatasetTIFF,
 )
+from brightfield2fish.data.stats_index import compute_stats_index
+from brightfield2fish.data.tables import write_table
+from brightfield2fish.data.utils import normalize, volume_stats
 
 
 def test_FishDataframeDatasetTIFF(
@@ -58,6 +67,26 @@ def test_FishDataframeDatasetTIFF(
     assert sample[0].shape == sample[1].shape
 
 
+def test_FishDataframeDatasetTIFF_columnar(
+    channel_content="MYL2", split="valid", random_crop=(1, 2, 3)
+):
+    dirname = os.path.dirname(__file__)
+    csv_path = os.path.join(
+        os.path.dirname(os.path.dirname(dirname)),
+        "data",
+        "splits",
+        "{}.csv".format(split),
+    )
+    kwargs = dict(channel_content=channel_content, random_crop=random_crop)
+    dset_csv = FishDataframeDatasetTIFF(csv_path, csv=True, **kwargs)
+
+    for ext in (".parquet", ".feather"):
+        fpath = os.path.join("tmp_tests", "{}{}".format(split, ext))
+        write_table(pd.read_csv(csv_path), fpath)
+        dset = FishDataframeDatasetTIFF(fpath, csv=True, **kwargs)
+        pd.testing.assert_frame_equal(dset.df, dset_csv.df)
+
+
 def test_FishSegDataframeDatasetTIFF(
     channel_content="MYL2",
     split="valid",
@@ -103,3 +132,386 @@ def test_FishSegDataframeDatasetTIFF(
     j = np.random.randint(len(dset.df))
     sample = dset[j]
     assert sample[0].shape == sample[1].shape
+
+
+def test_FishDataframeDatasetTIFF_cache():
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    rows = []
+    for content in ("Brightfield", "DNA"):
+        fpath = os.path.join(fake_tiff_dir, "cache_{}.tiff".format(content))
+        arr = np.random.randint(
+            low=0, high=2 ** 16 - 1, size=(1, 1, 2, 3, 4), dtype=np.uint16
+        )
+        writer = OmeTifWriter(fpath, overwrite_file=True)
+        writer.save(arr)
+        rows += [
+            {
+                "file": "foo.czi",
+                "channel_content": content,
+                "normalized_single_channel_image": fpath,
+            }
+        ]
+
+    cache = SharedVolumeCache(max_bytes=2 ** 20)
+    dset = FishDataframeDatasetTIFF(pd.DataFrame(rows), channel_content="DNA")
+    dset_cached = FishDataframeDatasetTIFF(
+        pd.DataFrame(rows), channel_content="DNA", cache=cache
+    )
+
+    for _ in range(2):
+        for a, b in zip(dset[0], dset_cached[0]):
+            assert np.array_equal(a.numpy(), b.numpy())
+
+    stats = cache.stats()
+    assert stats["misses"] == 2 and stats["hits"] == 2
+    cache.clear()
+
+
+def test_FishDataframeDatasetTIFF_crop_first(random_crop=(2, 3, 4)):
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    rows = []
+    for content in ("Brightfield", "DNA"):
+        fpath = os.path.join(fake_tiff_dir, "crop_first_{}.tiff".format(content))
+        arr = np.random.randint(
+            low=0, high=2 ** 16 - 1, size=(5, 6, 7), dtype=np.uint16
+        )
+        writer = OmeTifWriter(fpath, overwrite_file=True)
+        writer.save(arr)
+        rows += [
+            {
+                "file": "foo.czi",
+                "channel_content": content,
+                "normalized_single_channel_image": fpath,
+            }
+        ]
+
+    dset = FishDataframeDatasetTIFF(
+        pd.DataFrame(rows), random_crop=random_crop, crop_first=False
+    )
+    dset_crop_first = FishDataframeDatasetTIFF(
+        pd.DataFrame(rows), random_crop=random_crop, crop_first=True
+    )
+
+    for seed in range(3):
+        random.seed(seed)
+        sample = dset[0]
+        random.seed(seed)
+        sample_crop_first = dset_crop_first[0]
+        for a, b in zip(sample, sample_crop_first):
+            assert a.shape == (1, *random_crop)
+            assert np.array_equal(a.numpy(), b.numpy())
+
+    assert len(dset_crop_first._stats) == 2
+
+
+def test_FishDataframeDatasetTIFF_float32(random_crop=(2, 3, 4)):
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    rows = []
+    for content in ("Brightfield", "DNA"):
+        fpath = os.path.join(fake_tiff_dir, "float32_{}.tiff".format(content))
+        arr = np.random.randint(
+            low=0, high=2 ** 16 - 1, size=(5, 6, 7), dtype=np.uint16
+        )
+        writer = OmeTifWriter(fpath, overwrite_file=True)
+        writer.save(arr)
+        rows += [
+            {
+                "file": "foo.czi",
+                "channel_content": content,
+                "normalized_single_channel_image": fpath,
+            }
+        ]
+
+    for crop_first in (True, False):
+        dset = FishDataframeDatasetTIFF(
+            pd.DataFrame(rows), random_crop=random_crop, crop_first=crop_first
+        )
+        dset_float32 = FishDataframeDatasetTIFF(
+            pd.DataFrame(rows),
+            random_crop=random_crop,
+            crop_first=crop_first,
+            math_dtype=np.float32,
+        )
+        for seed in range(3):
+            random.seed(seed)
+            sample = dset[0]
+            random.seed(seed)
+            sample_float32 = dset_float32[0]
+            for a, b in zip(sample, sample_float32):
+                assert b.dtype == torch.float32
+                assert np.allclose(a.numpy(), b.numpy(), atol=1e-5)
+
+
+def test_FishDataframeDatasetTIFF_torch_math(random_crop=(2, 3, 4)):
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    rows = []
+    for content in ("Brightfield", "DNA"):
+        fpath = os.path.join(fake_tiff_dir, "torch_math_{}.tiff".format(content))
+        arr = np.random.randint(
+            low=0, high=2 ** 16 - 1, size=(5, 6, 7), dtype=np.uint16
+        )
+        writer = OmeTifWriter(fpath, overwrite_file=True)
+        writer.save(arr)
+        rows += [
+            {
+                "file": "foo.czi",
+                "channel_content": content,
+                "normalized_single_channel_image": fpath,
+            }
+        ]
+
+    for crop_first in (True, False):
+        dset = FishDataframeDatasetTIFF(
+            pd.DataFrame(rows), random_crop=random_crop, crop_first=crop_first
+        )
+        dset_torch = FishDataframeDatasetTIFF(
+            pd.DataFrame(rows),
+            random_crop=random_crop,
+            crop_first=crop_first,
+            torch_math=True,
+        )
+        for seed in range(3):
+            random.seed(seed)
+            sample = dset[0]
+            random.seed(seed)
+            sample_torch = dset_torch[0]
+            for a, b in zip(sample, sample_torch):
+                assert b.shape == (1, *random_crop) and b.dtype == torch.float32
+                assert np.allclose(a.numpy(), b.numpy(), atol=1e-5)
+
+
+def test_FishDataframeDatasetTIFF_n_crops(random_crop=(2, 3, 4), n_crops=3):
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    rows = []
+    for content in ("Brightfield", "DNA"):
+        fpath = os.path.join(fake_tiff_dir, "n_crops_{}.tiff".format(content))
+        arr = np.random.randint(
+            low=0, high=2 ** 16 - 1, size=(5, 6, 7), dtype=np.uint16
+        )
+        writer = OmeTifWriter(fpath, overwrite_file=True)
+        writer.save(arr)
+        rows += [
+            {
+                "file": "foo.czi",
+                "channel_content": content,
+                "normalized_single_channel_image": fpath,
+            }
+        ]
+
+    dset = FishDataframeDatasetTIFF(
+        pd.DataFrame(rows), random_crop=random_crop, crop_first=False, n_crops=n_crops
+    )
+    dset_crop_first = FishDataframeDatasetTIFF(
+        pd.DataFrame(rows), random_crop=random_crop, crop_first=True, n_crops=n_crops
+    )
+
+    for seed in range(3):
+        random.seed(seed)
+        sample = dset[0]
+        random.seed(seed)
+        sample_crop_first = dset_crop_first[0]
+        for a, b in zip(sample, sample_crop_first):
+            assert a.shape == (n_crops, 1, *random_crop)
+            assert np.array_equal(a.numpy(), b.numpy())
+
+
+def test_FishSegDataframeDatasetTIFF_n_crops(random_crop=(2, 3, 4), n_crops=3):
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    fpaths = {}
+    for channel, size in (("Brightfield", (5, 6, 7)), ("Target", (1, 6, 7))):
+        fpaths[channel] = os.path.join(
+            fake_tiff_dir, "seg_n_crops_{}.tiff".format(channel)
+        )
+        arr = np.random.randint(low=0, high=2 ** 16 - 1, size=size, dtype=np.uint16)
+        writer = OmeTifWriter(fpaths[channel], overwrite_file=True)
+        writer.save(arr)
+
+    df = pd.DataFrame(
+        {
+            "probe name": ["MYH7"],
+            "file": [fpaths["Brightfield"]],
+            "fish segmetation path": [fpaths["Target"]],
+        }
+    )
+    # a deeper brightfield than the 2d target, cropped as deep as the test originally did and deeper
+    for crop in ((1, *random_crop[1:]), random_crop):
+        dset = FishSegDataframeDatasetTIFF(df, random_crop=crop, n_crops=n_crops)
+        bf, target = dset[0]
+        assert bf.shape == target.shape == (n_crops, 1, *crop)
+        assert (target == target[:, :, :1]).all()
+
+    # the 2d target stays 2d until the batch is collated
+    dset = FishSegDataframeDatasetTIFF(
+        df, random_crop=random_crop, n_crops=n_crops, fish_3d=False
+    )
+    sample = dset[0]
+    assert sample[1].shape == (n_crops, 1, 1, *random_crop[1:])
+    bf, target = collate_extrude([sample, dset[0]], crops=True)
+    assert bf.shape == target.shape == (2 * n_crops, 1, *random_crop)
+    assert target.stride(2) == 0
+
+
+def test_FishSegDataframeDatasetTIFF_clip(
+    monkeypatch, bf_clip_percentiles=[0.01, 99.99]
+):
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    fpaths = {}
+    for channel, size in (("Brightfield", (5, 61, 67)), ("Target", (1, 61, 67))):
+        fpaths[channel] = os.path.join(
+            fake_tiff_dir, "seg_clip_{}.tiff".format(channel)
+        )
+        arr = np.random.randint(low=0, high=2 ** 16 - 1, size=size, dtype=np.uint16)
+        writer = OmeTifWriter(fpaths[channel], overwrite_file=True)
+        writer.save(arr)
+    raw = AICSImage(fpaths["Brightfield"]).get_image_data("ZYX")
+
+    df = pd.DataFrame(
+        {
+            "probe name": ["MYH7"],
+            "file": [fpaths["Brightfield"]],
+            "fish segmetation path": [fpaths["Target"]],
+        }
+    )
+    dset = FishSegDataframeDatasetTIFF(
+        df, bf_clip_percentiles=bf_clip_percentiles, normalize=False
+    )
+
+    # bit identical to clipping at np.percentile of the normalized float32 image
+    expected = normalize(
+        raw.astype(np.float64), stats=volume_stats(raw.astype(np.float64))
+    ).astype(np.float32)
+    a_min, a_max = np.percentile(expected, bf_clip_percentiles)
+    expected = np.clip(expected, a_min=a_min, a_max=a_max)
+    assert np.array_equal(dset[0][0][0].numpy(), expected)
+
+    # with a stats index, the clip bounds come from its stored order statistics, without a histogram of the image
+    csv_path = os.path.join("tmp_tests", "seg_clip_stats.csv")
+    if os.path.exists(csv_path):
+        os.remove(csv_path)
+    compute_stats_index(
+        [fpaths["Brightfield"]],
+        csv_path=csv_path,
+        percentiles=bf_clip_percentiles,
+        max_workers=1,
+    )
+    dset = FishSegDataframeDatasetTIFF(
+        df, bf_clip_percentiles=bf_clip_percentiles, normalize=False, stats=csv_path
+    )
+
+    def no_histogram(*args, **kwargs):
+        raise AssertionError(
+            "histogram built although the stats index has the clip percentiles"
+        )
+
+    monkeypatch.setattr(utils_module, "_histogram", no_histogram)
+    assert np.array_equal(dset[0][0][0].numpy(), expected)
+
+
+def test_FishDataframeDatasetTIFF_raw(random_crop=(2, 3, 4)):
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    rows = []
+    for content in ("Brightfield", "DNA"):
+        fpath = os.path.join(fake_tiff_dir, "raw_{}.tiff".format(content))
+        arr = np.random.randint(
+            low=0, high=2 ** 16 - 1, size=(5, 6, 7), dtype=np.uint16
+        )
+        writer = OmeTifWriter(fpath, overwrite_file=True)
+        writer.save(arr)
+        rows += [
+            {
+                "file": "foo.czi",
+                "channel_content": content,
+                "normalized_single_channel_image": fpath,
+            }
+        ]
+
+    dset = FishDataframeDatasetTIFF(pd.DataFrame(rows), random_crop=random_crop)
+    dset_raw = FishDataframeDatasetTIFF(
+        pd.DataFrame(rows), random_crop=random_crop, raw=True
+    )
+    collate = NormalizeAugmentCollate()
+
+    for seed in range(3):
+        random.seed(seed)
+        sample = dset[0]
+        random.seed(seed)
+        sample_raw = dset_raw[0]
+        assert sample_raw[0].dtype == np.uint16
+        for a, b in zip(sample, collate([sample_raw])):
+            assert np.allclose(a.numpy(), b[0].numpy(), atol=1e-5)
+
+
+def test_FishMultiDataframeDatasetTIFF(random_crop=(1, 2, 3)):
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    rows = []
+    for i, contents in enumerate(
+        (("Brightfield", "DNA", "CAAX"), ("Brightfield", "DNA"))
+    ):
+        for content in contents:
+            fpath = os.path.join(fake_tiff_dir, "multi_{}_{}.tiff".format(content, i))
+            arr = np.random.randint(
+                low=0, high=2 ** 16 - 1, size=(1, 1, 2, 3, 4), dtype=np.uint16
+            )
+            writer = OmeTifWriter(fpath, overwrite_file=True)
+            writer.save(arr)
+            rows += [
+                {
+                    "file": "multi_{}.czi".format(i),
+                    "channel_content": content,
+                    "normalized_single_channel_image": fpath,
+                }
+            ]
+    df = pd.DataFrame(rows)
+
+    dset = FishMultiDataframeDatasetTIFF(df, channel_contents=["DNA", "CAAX"])
+    assert len(dset) == 2
+
+    # the same images as one dataset per probe
+    for i in range(len(dset)):
+        bf, targets, mask = dset[i]
+        assert bf.shape == (1, 2, 3, 4) and targets.shape == (2, 2, 3, 4)
+        assert mask.tolist() == [True, i == 0]
+        for j, content in enumerate(("DNA", "CAAX")):
+            if not mask[j]:
+                assert not targets[j].any()
+                continue
+            single = FishDataframeDatasetTIFF(df, channel_content=content)
+            k = single.df.index[
+                single.df["Brightfield"] == dset.df.loc[i, "Brightfield"]
+            ]
+            bf_single, target_single = single[k[0]]
+            assert torch.equal(bf, bf_single)
+            assert torch.equal(targets[j], target_single[0])
+
+    dset = FishMultiDataframeDatasetTIFF(
+        df, channel_contents=["DNA", "CAAX"], random_crop=random_crop
+    )
+    bf, targets, mask = dset[0]
+    assert bf.shape == (1, *random_crop) and targets.shape == (2, *random_crop)
@@ -0,0 +1,49 @@
+import os
+import json
+
+from brightfield2fish.data.jobs import n_workers, run_jobs
+
+
+def _square(x):
+    if x < 0:
+        raise ValueError("negative")
+    if x == 13:
+        os._exit(1)  # like being killed by the out of memory killer
+    return x ** 2
+
+
+def test_n_workers():
+    assert n_workers(max_workers=8, worker_memory=2 ** 30, memory_budget=2 ** 32) == 4
+    assert n_workers(max_workers=8, worker_memory=2 ** 33, memory_budget=2 ** 32) == 1
+    assert n_workers(max_workers=3) == 3
+
+
+def test_run_jobs():
+    log_path = os.path.join("tmp_tests", "jobs_log.jsonl")
+    if not os.path.exists("tmp_tests"):
+        os.makedirs("tmp_tests")
+    if os.path.exists(log_path):
+        os.remove(log_path)
+
+    finished = []
+    items = [3, -1, 4, 13, 5]
+    results = run_jobs(
+        _square,
+        items,
+        max_workers=2,
+        max_in_flight=2,
+        retries=1,
+        log_path=log_path,
+        callback=lambda r: finished.append(r["item"]),
+    )
+
+    assert [r["item"] for r in results] == [str(x) for x in items]
+    assert [r["result"] for r in results if r["ok"]] == [9, 16, 25]
+    assert not results[1]["ok"] and "negative" in results[1]["error"]
+    assert not results[3]["ok"] and results[3]["attempts"] == 2
+    assert sorted(finished) == sorted(str(x) for x in items)
+
+    with open(log_path, "r") as fp:
+        log = [json.loads(line) for line in fp]
+    assert len(log) == len(items)
+    assert all("seconds" in r and "result" not in r for r in log)
@@ -0,0 +1,79 @@
+import os
+import numpy as np
+
+from brightfield2fish.data.manifest import RunManifest
+
+
+def test_RunManifest():
+    manifest_dir = os.path.join("tmp_tests", "manifest")
+    manifest_path = os.path.join(manifest_dir, "manifest.jsonl")
+    if not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    in_path = os.path.join(manifest_dir, "in.npy")
+    out_path = os.path.join(manifest_dir, "out.npy")
+    np.save(in_path, np.arange(10))
+    np.save(out_path, np.arange(10) * 2)
+    params = {"clip_percentiles": [0, 99.99]}
+
+    manifest = RunManifest(manifest_path)
+    assert not manifest.up_to_date(in_path, params)
+    manifest.record(in_path, params, [out_path])
+
+    # a crash while appending leaves a partial last line, which is ignored
+    with open(manifest_path, "a") as fp:
+        fp.write('{"input": "bar.czi", "si')
+
+    manifest = RunManifest(manifest_path)
+    assert len(manifest) == 1
+    assert manifest.up_to_date(in_path, params, outputs=[out_path], verify=True)
+    assert not manifest.up_to_date(in_path, {"clip_percentiles": [0, 99.9]})
+    assert not manifest.up_to_date(in_path, params, outputs=[out_path, in_path])
+
+    np.save(out_path, np.arange(11))
+    assert not manifest.up_to_date(in_path, params)
+
+
+def test_RunManifest_compact(n_inputs=3, n_runs=5):
+    manifest_dir = os.path.join("tmp_tests", "manifest_compact")
+    manifest_path = os.path.join(manifest_dir, "manifest.jsonl")
+    if not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    def n_lines():
+        with open(manifest_path, "r") as fp:
+            return len(fp.readlines())
+
+    in_paths = [
+        os.path.join(manifest_dir, "in_{}.npy".format(i)) for i in range(n_inputs)
+    ]
+    out_path = os.path.join(manifest_dir, "out.npy")
+    np.save(out_path, np.arange(10))
+    params = {"clip_percentiles": [0, 99.99]}
+
+    # reruns supersede records, but the file stays within twice the number of inputs
+    manifest = RunManifest(manifest_path)
+    for run in range(n_runs):
+        for in_path in in_paths:
+            np.save(in_path, np.arange(10 + run))
+            manifest.record(in_path, params, [out_path])
+            assert n_lines() <= 2 * len(manifest)
+    assert all(manifest.up_to_date(p, params) for p in in_paths)
+
+    # a partial line from a crash is dropped on load, so later records stay readable
+    with open(manifest_path, "a") as fp:
+        fp.write('{"input": "bar.czi", "si')
+    manifest = RunManifest(manifest_path)
+    assert n_lines() == len(manifest) == n_inputs
+    in_paths += [os.path.join(manifest_dir, "in_new.npy")]
+    np.save(in_paths[-1], np.arange(10))
+    manifest.record(in_paths[-1], params, [out_path])
+
+    manifest = RunManifest(manifest_path)
+    assert len(manifest) == n_inputs + 1
+    assert all(manifest.up_to_date(p, params) for p in in_paths)
+    assert not os.path.exists(manifest_path + ".tmp")
@@ -0,0 +1,92 @@
+import os
+import time
+import threading
+
+from brightfield2fish.data.pipeline import Stage, run_pipeline, stage_graph
+
+
+def _copy(src, dst, suffix=""):
+    with open(src, "r") as fp:
+        text = fp.read()
+    with open(dst, "w") as fp:
+        fp.write(text + suffix)
+
+
+def _fail():
+    raise RuntimeError("oops")
+
+
+def test_run_pipeline():
+    tmp_dir = os.path.join("tmp_tests", "pipeline")
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+    paths = {k: os.path.join(tmp_dir, "{}.txt".format(k)) for k in "abcd"}
+    state_path = os.path.join(tmp_dir, "state.json")
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    with open(paths["a"], "w") as fp:
+        fp.write("a")
+
+    # b and c both only depend on a, so they should run at the same time
+    barrier = threading.Barrier(2, timeout=10)
+
+    def copy_together(src, dst):
+        barrier.wait()
+        _copy(src, dst)
+
+    stages = [
+        Stage(
+            "d",
+            _copy,
+            [paths["b"]],
+            [paths["d"]],
+            params={"src": paths["b"], "dst": paths["d"]},
+        ),
+        Stage(
+            "b",
+            copy_together,
+            [paths["a"]],
+            [paths["b"]],
+            params={"src": paths["a"], "dst": paths["b"]},
+        ),
+        Stage(
+            "c",
+            copy_together,
+            [paths["a"]],
+            [paths["c"]],
+            params={"src": paths["a"], "dst": paths["c"]},
+        ),
+    ]
+    assert stage_graph(stages) == {"b": set(), "c": set(), "d": {"b"}}
+
+    status = run_pipeline(stages, state_path)
+    assert {k: v["status"] for k, v in status.items()} == {
+        "b": "ran",
+        "c": "ran",
+        "d": "ran",
+    }
+
+    status = run_pipeline(stages, state_path)
+    assert all(v["status"] == "skipped" for v in status.values())
+
+    # only the stages downstream of a changed input rerun
+    time.sleep(0.01)
+    with open(paths["b"], "w") as fp:
+        fp.write("changed")
+    status = run_pipeline(stages, state_path, targets=["d"], dry_run=True)
+    assert {k: v["status"] for k, v in status.items()} == {
+        "b": "would run",
+        "d": "would run",
+    }
+    barrier = threading.Barrier(1)
+    status = run_pipeline(stages, state_path, targets=["d"])
+    assert {k: v["status"] for k, v in status.items()} == {"b": "ran", "d": "skipped"}
+
+    # changing params reruns, failures block downstream stages
+    stages[0].params["suffix"] = "!"
+    stages[1] = Stage("b", _fail, [paths["a"]], [paths["b"]])
+    status = run_pipeline(stages, state_path, max_workers=1)
+    assert status["b"]["status"] == "failed"
+    assert "oops" in status["b"]["error"]
+    assert status["c"]["status"] == "skipped"
+    assert status["d"]["status"] == "blocked"
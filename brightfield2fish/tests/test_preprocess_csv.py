@@ -1,9 +1,22 @@
 import os
+import json
+import struct
+import itertools
 import numpy as np
 import pandas as pd
 
 from aicsimageio import OmeTifWriter
-from brightfield2fish.data.preprocess_csv import find_czis, filter_czis, image_shape
+from aicsimageio import AICSImage
+from brightfield2fish.data.preprocess_csv import (
+    find_czis,
+    filter_czis,
+    image_metadata,
+    image_shape,
+    list_dirs,
+    parse_plate_well,
+    parse_plate_well_paths,
+    probe_images,
+)
 
 
 def test_find_and_filter_czis(data="fake"):
@@ -58,4 +71,163 @@ def test_image_shape():
     )
     writer = OmeTifWriter(fpath, overwrite_file=True)
     writer.save(arr)
-    _ = image_shape(fpath)
+    assert image_shape(fpath)["shape"] == AICSImage(fpath).shape
+
+
+def _segment(sid, data):
+    return struct.pack("<16sqq", sid, len(data), len(data)) + data
+
+
+def write_czi_header(path, sizes, pixel_size=(0.1, 0.2, 0.3)):
+    r"""
+    Write a czi file with a real file header, metadata and subblock directory, but no pixel data.
+
+    Args:
+        path (str): path to write to
+        sizes (dict): size per axis letter, in czi order (e.g. {"B": 1, "S": 2, "C": 5, "Z": 3, "Y": 4, "X": 6})
+        pixel_size (tuple): x, y and z distances in the scaling metadata
+    """
+    xml = "<ImageDocument><Metadata><Scaling><Items>"
+    for d, v in zip("XYZ", pixel_size):
+        xml += '<Distance Id="{}"><Value>{}</Value></Distance>'.format(d, v)
+    xml += "</Items></Scaling></Metadata></ImageDocument>"
+    xml = xml.encode()
+    metadata = _segment(
+        b"ZISRAWMETADATA", struct.pack("<ii", len(xml), 0) + bytes(248) + xml
+    )
+
+    # one gray16 subblock entry per plane, dimension entries innermost first
+    axes = list(sizes)
+    planes = itertools.product(*[range(sizes[d]) for d in axes[:-2]])
+    entries = b""
+    for n, plane in enumerate(planes):
+        starts = list(plane) + [0, 0]
+        entries += struct.pack(
+            "<2siqiiBB4si", b"DV", 1, 0, 0, 0, 0, 0, bytes(4), len(axes)
+        )
+        for d, start in reversed(list(zip(axes, starts))):
+            size = sizes[d] if d in "YX" else 1
+            entries += struct.pack("<4siifi", d.encode(), start, size, 0.0, size)
+    directory = _segment(
+        b"ZISRAWDIRECTORY", struct.pack("<i", n + 1) + bytes(124) + entries
+    )
+
+    header_size = 32 + struct.calcsize("<iiii16s16siqqiq")
+    metadata_position = header_size
+    directory_position = metadata_position + len(metadata)
+    header = _segment(
+        b"ZISRAWFILE",
+        struct.pack(
+            "<iiii16s16siqqiq",
+            1,
+            0,
+            0,
+            0,
+            bytes(16),
+            bytes(16),
+            0,
+            directory_position,
+            metadata_position,
+            0,
+            0,
+        ),
+    )
+    with open(path, "wb") as fp:
+        fp.write(header + metadata + directory)
+
+
+def test_image_metadata_czi():
+    fpath = os.path.join("tmp_tests", "foo.czi")
+
+    # extra scene and B axes are not counted as TCZYX
+    write_czi_header(fpath, {"B": 1, "S": 2, "C": 5, "Z": 3, "Y": 4, "X": 6})
+    metadata = image_metadata(fpath)
+    assert metadata["shape"] == (1, 5, 3, 4, 6)
+    assert metadata["dtype"] == np.dtype(np.uint16).str
+    assert metadata["physical_pixel_size"] == [0.1, 0.2, 0.3]
+
+    write_czi_header(fpath, {"S": 3, "T": 2, "C": 1, "Z": 4, "Y": 5, "X": 7})
+    assert image_metadata(fpath)["shape"] == (2, 1, 4, 5, 7)
+
+
+def test_probe_images():
+    cache_dir = os.path.join("tmp_tests", "probe_images")
+    cache_path = os.path.join(cache_dir, "metadata.json")
+    log_path = os.path.join(cache_dir, "log.jsonl")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    for path in (cache_path, log_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    fpaths = [os.path.join(cache_dir, "foo_{}.ome.tiff".format(i)) for i in range(2)]
+    for fpath in fpaths:
+        arr = np.random.randint(
+            low=0, high=2 ** 16 - 1, size=(1, 2, 3, 4, 5), dtype=np.uint16
+        )
+        writer = OmeTifWriter(fpath, overwrite_file=True)
+        writer.save(arr)
+
+    def n_probed():
+        with open(log_path, "r") as fp:
+            return len(fp.readlines())
+
+    metadata = probe_images(fpaths, cache_path=cache_path, log_path=log_path)
+    assert [m["shape"] for m in metadata] == [AICSImage(f).shape for f in fpaths]
+    assert n_probed() == 2
+
+    # cached headers aren't read again, unless their file changed
+    assert probe_images(fpaths, cache_path=cache_path, log_path=log_path) == metadata
+    assert n_probed() == 2
+
+    writer = OmeTifWriter(fpaths[0], overwrite_file=True)
+    writer.save(np.zeros((1, 1, 3, 4, 5), dtype=np.uint16))
+    metadata = probe_images(fpaths, cache_path=cache_path, log_path=log_path)
+    assert n_probed() == 3
+    assert metadata[0]["shape"] == AICSImage(fpaths[0]).shape
+
+    # missing files are unreadable, and don't stop the others being probed
+    missing = os.path.join(cache_dir, "missing.ome.tiff")
+    metadata = probe_images(
+        [missing] + fpaths, cache_path=cache_path, log_path=log_path
+    )
+    assert metadata[0] is None
+    assert [m["shape"] for m in metadata[1:]] == [AICSImage(f).shape for f in fpaths]
+
+
+def test_parse_plate_well_paths():
+    paths = [
+        "/allen/aics/microscopy/Data/RnD_Sandbox/5500000007/ZSD1/5500000007_40X_20181010_2-Scene-17-P27-B04.czi",
+        "/allen/aics/microscopy/Data/RnD_Sandbox/5500000013/ZSD2/5500000013_40X_20190110_1-Scene-2-P3-E07.ome.czi",
+    ]
+    df = parse_plate_well_paths(paths)
+    assert df.to_dict(orient="records") == [
+        {**parse_plate_well(p), "file": p} for p in paths
+    ]
+
+
+def test_list_dirs():
+    list_dir = os.path.join("tmp_tests", "list_dirs")
+    cache_path = os.path.join("tmp_tests", "list_dirs.json")
+    if not os.path.exists(list_dir):
+        os.makedirs(list_dir)
+    for fname in os.listdir(list_dir):
+        os.remove(os.path.join(list_dir, fname))
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+    open(os.path.join(list_dir, "a.czi"), "w").close()
+    assert list_dirs([list_dir], cache_path=cache_path) == {list_dir: ["a.czi"]}
+
+    # a cached listing is used as long as the directory mtime is unchanged
+    with open(cache_path, "r") as fp:
+        cache = json.load(fp)
+    cache[list_dir]["files"] = ["cached.czi"]
+    with open(cache_path, "w") as fp:
+        json.dump(cache, fp)
+    assert list_dirs([list_dir], cache_path=cache_path) == {list_dir: ["cached.czi"]}
+
+    open(os.path.join(list_dir, "b.czi"), "w").close()
+    os.utime(list_dir, (0, 0))
+    listing = list_dirs([list_dir], cache_path=cache_path)
+    assert sorted(listing[list_dir]) == ["a.czi", "b.czi"]
@@ -0,0 +1,55 @@
+import os
+import pandas as pd
+
+from brightfield2fish.data.preprocess_fish_segs import tidy_fish_segs, match_fish_segs
+
+
+def test_match_fish_segs():
+    par_dir = os.path.abspath(os.path.join("tmp_tests", "mip_with_seg"))
+    scenes = {
+        "B04": "5500000007_40X_20181010_2-Scene-17-P27-B04",
+        "B05": "5500000007_40X_20181010_2-Scene-18-P28-B05",
+    }
+
+    df_seg = pd.DataFrame(
+        {
+            "plate": [5500000007, 5500000007],
+            "cell_line": ["AICS", "AICS"],
+            "cell_age": [18, 18],
+            "well": ["B04", "B05"],
+            "probe_488": ["MYH7", "MYH7"],
+            "probe_638": ["TNNT2", None],
+            "probe_561": [None, None],
+            "dot_488": [1.0, 1.0],
+            "dot_638": [2.0, None],
+            "dot_561": [None, None],
+        }
+    )
+    df_exp = pd.DataFrame(
+        {"FileName_BF": [s + "-OME.ome.tif" for s in scenes.values()]}
+    )
+
+    # one segmentation per scene in each output subdirectory, plus some noise
+    for out_subdir, wells in (
+        ("out_488_1.0", ("B04", "B05")),
+        ("out_638_2.0", ("B04",)),
+    ):
+        d = os.path.join(par_dir, "5500000007_AICS", out_subdir)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        for well in wells:
+            open(os.path.join(d, scenes[well] + "_seg.tif"), "w").close()
+        open(os.path.join(d, "notes.txt"), "w").close()
+
+    df_3d = pd.DataFrame({"file": ["/data/{}.czi".format(s) for s in scenes.values()]})
+
+    df_tidy = tidy_fish_segs(df_seg, df_exp, par_dir)
+    assert len(df_tidy) == 3
+    df = match_fish_segs(df_tidy, df_3d)
+
+    assert len(df) == 3
+    for _, row in df.iterrows():
+        assert os.path.exists(row["fish segmetation path"])
+        scene_id = os.path.splitext(os.path.basename(row["file"]))[0]
+        assert os.path.basename(row["fish segmetation path"]) == scene_id + "_seg.tif"
+        assert "out_{}_".format(row["wavelength"]) in row["fish segmetation path"]
@@ -1,8 +1,18 @@
 import os
+import time
+import weakref
 import numpy as np
+import pandas as pd
 from aicsimageio import AICSImage, OmeTifWriter
 
-from brightfield2fish.data.preprocess_images import normalize
+from brightfield2fish.data import preprocess_images as preprocess_images_module
+from brightfield2fish.data.chunked import ChunkedVolume
+from brightfield2fish.data.preprocess_images import (
+    normalize,
+    normalize_all,
+    preprocess_file,
+    preprocess_images,
+)
 
 
 def test_normalize():
@@ -16,3 +26,188 @@ def test_normalize():
 
     for channel in (0, 1):
         _ = normalize(im, channel=channel)
+
+
+def test_normalize_all():
+    fpath = os.path.join("tmp_tests", "foo_all.ome.tiff")
+    arr = np.random.randint(
+        low=0, high=2 ** 16 - 1, size=(1, 3, 4, 5, 6), dtype=np.uint16
+    )
+    writer = OmeTifWriter(fpath, overwrite_file=True)
+    writer.save(arr)
+    im = AICSImage(fpath)
+
+    channels = list(range(im.shape[1]))
+    for channel, out in zip(channels, normalize_all(im, channels=channels)):
+        assert np.array_equal(out, normalize(im, channel=channel))
+
+
+def test_preprocess_images_resume():
+    fpath = os.path.join("tmp_tests", "foo_resume.ome.tiff")
+    out_dir = os.path.join("tmp_tests", "preprocessed_resume")
+    manifest_path = os.path.join(out_dir, "manifest.jsonl")
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    arr = np.random.randint(
+        low=0, high=2 ** 16 - 1, size=(1, 2, 3, 4, 5), dtype=np.uint16
+    )
+    writer = OmeTifWriter(fpath, overwrite_file=True)
+    writer.save(arr)
+
+    df = pd.DataFrame(
+        {
+            "file": [fpath, fpath],
+            "channel_index": [0, 1],
+            "channel_content": ["Brightfield", "DNA"],
+            "normalized_single_channel_image": [
+                os.path.join(out_dir, "foo_resume_channel_{}.tif".format(c))
+                for c in (0, 1)
+            ],
+        }
+    )
+
+    assert preprocess_images(df, manifest_path=manifest_path, max_workers=1) == [fpath]
+    assert preprocess_images(df, manifest_path=manifest_path, max_workers=1) == []
+
+    # a missing output is rewritten
+    os.remove(df.loc[1, "normalized_single_channel_image"])
+    assert preprocess_images(df, manifest_path=manifest_path, max_workers=1) == [fpath]
+    assert os.path.exists(df.loc[1, "normalized_single_channel_image"])
+    assert preprocess_images(df, manifest_path=manifest_path, max_workers=1) == []
+
+
+def test_preprocess_images_chunked():
+    fpath = os.path.join("tmp_tests", "foo_chunked.ome.tiff")
+    out_dir = os.path.join("tmp_tests", "preprocessed_chunked")
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    arr = np.random.randint(
+        low=0, high=2 ** 16 - 1, size=(1, 2, 3, 4, 5), dtype=np.uint16
+    )
+    writer = OmeTifWriter(fpath, overwrite_file=True)
+    writer.save(arr)
+
+    df = pd.DataFrame(
+        {
+            "file": [fpath, fpath],
+            "channel_index": [0, 1],
+            "channel_content": ["Brightfield", "DNA"],
+            "normalized_single_channel_image": [
+                os.path.join(out_dir, "foo_chunked_channel_{}.cvol".format(c))
+                for c in (0, 1)
+            ],
+        }
+    )
+
+    assert preprocess_images(
+        df, max_workers=1, writer="chunked", writer_kwargs={"chunks": (2, 2, 2)}
+    ) == [fpath]
+
+    im = AICSImage(fpath)
+    for channel, out_path in zip((0, 1), df["normalized_single_channel_image"]):
+        vol = ChunkedVolume(out_path)
+        assert vol.attrs["channel_name"] == df.loc[channel, "channel_content"]
+        assert np.array_equal(vol.read(), normalize(im, channel=channel))
+
+
+def test_preprocess_file_overlapped():
+    fpath = os.path.join("tmp_tests", "foo_overlap.ome.tiff")
+    out_dir = os.path.join("tmp_tests", "preprocessed_overlap")
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    arr = np.random.randint(
+        low=0, high=2 ** 16 - 1, size=(1, 3, 4, 5, 6), dtype=np.uint16
+    )
+    writer = OmeTifWriter(fpath, overwrite_file=True)
+    writer.save(arr)
+    im = AICSImage(fpath)
+
+    df = pd.DataFrame(
+        {
+            "file": [fpath] * 3,
+            "channel_index": [0, 1, 2],
+            "channel_content": ["Brightfield", "DNA", "FISH"],
+            "normalized_single_channel_image": [
+                os.path.join(out_dir, "foo_overlap_channel_{}.cvol".format(c))
+                for c in (0, 1, 2)
+            ],
+        }
+    )
+
+    # block-wise normalization streams into the writers with the same output
+    for write_threads, block_z in ((1, None), (3, None), (2, 3)):
+        timing = {}
+        paths = preprocess_file(
+            fpath,
+            df,
+            writer="chunked",
+            write_threads=write_threads,
+            block_z=block_z,
+            timing=timing,
+        )
+        assert set(timing) == {"decode", "normalize", "write", "wall"}
+        for channel, path in enumerate(paths):
+            assert np.array_equal(
+                ChunkedVolume(path).read(), normalize(im, channel=channel)
+            )
+
+    df["normalized_single_channel_image"] = [
+        os.path.join(out_dir, "foo_overlap_channel_{}.tif".format(c)) for c in (0, 1, 2)
+    ]
+    paths = preprocess_file(fpath, df, writer="ome-tiff", block_z=1)
+    for channel, path in enumerate(paths):
+        out = AICSImage(path).get_image_data("ZYX", T=0, C=0)
+        assert np.array_equal(out, normalize(im, channel=channel))
+
+
+def test_preprocess_file_in_flight(monkeypatch, n_channels=6):
+    fpath = os.path.join("tmp_tests", "foo_in_flight.ome.tiff")
+    out_dir = os.path.join("tmp_tests", "preprocessed_in_flight")
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    arr = np.zeros((1, n_channels, 2, 3, 4), dtype=np.uint16)
+    writer = OmeTifWriter(fpath, overwrite_file=True)
+    writer.save(arr)
+
+    # count the normalized channels alive whenever a new one is made, with slow writes
+    alive, peak = set(), []
+
+    def fake_channels(image, channels, **kwargs):
+        for c in channels:
+            image_ZYX = np.zeros((2, 3, 4), dtype=np.uint16)
+            alive.add(id(image_ZYX))
+            weakref.finalize(image_ZYX, alive.discard, id(image_ZYX))
+            peak.append(len(alive))
+            yield image_ZYX
+            del image_ZYX
+
+    def slow_write(path, image_ZYX, channel_name, pixel_size):
+        time.sleep(0.05)
+        open(path, "w").close()
+
+    monkeypatch.setattr(
+        preprocess_images_module, "iter_prep_fish_channels", fake_channels
+    )
+    monkeypatch.setitem(preprocess_images_module.WRITERS, "slow", (slow_write, ".tif"))
+
+    df = pd.DataFrame(
+        {
+            "file": [fpath] * n_channels,
+            "channel_index": list(range(n_channels)),
+            "channel_content": ["DNA"] * n_channels,
+            "normalized_single_channel_image": [
+                os.path.join(out_dir, "foo_in_flight_channel_{}.tif".format(c))
+                for c in range(n_channels)
+            ],
+        }
+    )
+    for write_threads in (1, 2, 3):
+        peak.clear()
+        preprocess_file(fpath, df, writer="slow", write_threads=write_threads)
+        assert len(peak) == n_channels
+        assert max(peak) == write_threads
@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import pandas as pd
+
+from aicsimageio import OmeTifWriter
+from brightfield2fish.data.shards import export_shards, ShardedPairDataset
+
+
+def test_ShardedPairDataset(n_files=5, world_size=2):
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    shard_dir = os.path.join("tmp_tests", "shards")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    rows = []
+    for i in range(n_files):
+        for content in ("Brightfield", "DNA"):
+            fpath = os.path.join(fake_tiff_dir, "shard_{}_{}.tiff".format(content, i))
+            arr = np.random.randint(
+                low=0, high=2 ** 16 - 1, size=(1, 1, 2, 3, 4), dtype=np.uint16
+            )
+            writer = OmeTifWriter(fpath, overwrite_file=True)
+            writer.save(arr)
+            rows += [
+                {
+                    "file": "foo_{}.czi".format(i),
+                    "channel_content": content,
+                    "normalized_single_channel_image": fpath,
+                }
+            ]
+    df = pd.DataFrame(rows)
+
+    index = export_shards(df, shard_dir, samples_per_shard=1, max_workers=1)
+    assert sum(s["samples"] for s in index["shards"]) == n_files
+
+    # every rank reads as many samples, each at most once across ranks
+    samples = []
+    for rank in range(world_size):
+        dset = ShardedPairDataset(
+            shard_dir, shuffle_buffer=3, rank=rank, world_size=world_size, raw=True
+        )
+        samples += [list(dset)]
+    assert [len(s) for s in samples] == [n_files // world_size] * world_size
+    samples = sum(samples, [])
+    assert len(set(bf.tobytes() for bf, _, _ in samples)) == len(samples)
+
+    # uneven shards (of 2, 2 and 1 samples) are split evenly over ranks and workers
+    index = export_shards(df, shard_dir, samples_per_shard=2, max_workers=1)
+    assert [s["samples"] for s in index["shards"]] == [2, 2, 1]
+    dset = ShardedPairDataset(shard_dir)
+    for epoch in range(3):
+        dset.set_epoch(epoch)
+        ranges = [
+            dset.shards_for(rank, world_size, worker_id, num_workers=2)
+            for rank in range(world_size)
+            for worker_id in range(2)
+        ]
+        assert [sum(stop - start for _, start, stop in r) for r in ranges] == [1] * 4
+        assert len(set(sum(ranges, []))) == 4
+
+    dset = ShardedPairDataset(
+        shard_dir, shuffle_buffer=3, random_crop=(1, 2, 3), rank=0, world_size=1
+    )
+    samples = list(dset)
+    assert len(samples) == n_files
+    for bf, target in samples:
+        assert bf.shape == target.shape == (1, 1, 2, 3)
+        assert float(target.min()) >= 0 and float(target.max()) <= 1
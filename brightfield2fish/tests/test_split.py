@@ -1,5 +1,17 @@
 import os
-from brightfield2fish.data.split_data import split_and_save
+import hashlib
+import itertools
+import numpy as np
+import pandas as pd
+from brightfield2fish.data.split_data import (
+    group_keys,
+    hashsplit,
+    read_split,
+    split_and_save,
+    split_membership,
+    stream_split_and_save,
+)
+from brightfield2fish.data.tables import write_table
 
 
 def test_split_data():
@@ -19,3 +31,112 @@ def test_split_data():
         os.rmdir(os.path.join("tmp_tests", "data", "splits"))
 
     split_and_save(csv_path)
+
+
+def _hashsplit_digits(X, splits, salt, N):
+    # the original per item implementation, which existing splits.json files were made with
+    splits = {k: v / sum(splits.values()) for k, v in splits.items()}
+    bounds = np.cumsum([0.0] + [v for k, v in sorted(splits.items())])
+    hashes = [
+        hashlib.sha512((str(x) + str(salt)).encode("utf-8")).hexdigest() for x in X
+    ]
+    nums = np.array(
+        [float("".join(filter(str.isdigit, h))[:N]) / 10 ** N for h in hashes]
+    )
+    return {
+        k: np.flatnonzero((nums > bounds[i]) & (nums <= bounds[i + 1])).tolist()
+        for i, k in enumerate(sorted(splits))
+    }
+
+
+def test_hashsplit():
+    splits = {"train": 0.7, "valid": 0.15, "test": 0.15}
+    X = ["file_{}.czi".format(i % 300) for i in range(1500)] + [1.5, None]
+    for salt, N in itertools.product((0, 1, "foo"), (1, 5, 8, 18)):
+        assert hashsplit(X, splits, salt=salt, N=N) == _hashsplit_digits(
+            X, splits, salt, N
+        )
+
+
+def test_group_keys():
+    df = pd.DataFrame(
+        {"plate": [1, 1, 2, 2, 3], "well": ["A1", "A1", "A1", "B2", "A1"]}
+    )
+    keys = group_keys(df, ["plate", "well"])
+    assert keys.tolist() == ["1/A1", "1/A1", "2/A1", "2/B2", "3/A1"]
+
+    split = hashsplit(keys, {"train": 0.5, "test": 0.5})
+    assert sorted(sum(split.values(), [])) == list(range(len(df)))
+    assert any(set(v) >= {0, 1} for v in split.values())
+
+
+def test_stream_split_and_save():
+    dirname = os.path.dirname(__file__)
+    csv_dir = os.path.join(os.path.dirname(os.path.dirname(dirname)), "data")
+    csv_name = "data_by_images_normalized.csv"
+    splits = {"train": 0.7, "valid": 0.15, "test": 0.15}
+
+    df = pd.read_csv(os.path.join(csv_dir, csv_name), dtype={"cell_line": str})
+    expected = hashsplit(df["file"], splits=splits, salt=0)
+
+    for file_format in ("csv", "parquet", "feather"):
+        save_dir = os.path.join("tmp_tests", "data", "stream_splits_" + file_format)
+        index = stream_split_and_save(
+            csv_name,
+            csv_dir=csv_dir,
+            save_dir=save_dir,
+            splits=splits,
+            chunksize=100,
+            file_format=file_format,
+            dtype={"cell_line": str},
+        )
+
+        assert index["rows"] == len(df)
+        assert all(
+            p.endswith("." + file_format) for v in index["parts"].values() for p in v
+        )
+        assert split_membership(save_dir) == expected
+        for k, v in expected.items():
+            pd.testing.assert_frame_equal(
+                read_split(save_dir, k, dtype={"cell_line": str}),
+                df.iloc[v].reset_index(drop=True),
+                check_dtype=False,
+            )
+
+
+def test_stream_split_and_save_columnar():
+    dirname = os.path.dirname(__file__)
+    csv_path = os.path.join(
+        os.path.dirname(os.path.dirname(dirname)),
+        "data",
+        "data_by_images_normalized.csv",
+    )
+    df = pd.read_csv(csv_path, dtype={"cell_line": str})
+    splits = {"train": 0.7, "valid": 0.15, "test": 0.15}
+    expected = hashsplit(df["file"], splits=splits, salt=0)
+
+    for ext in (".parquet", ".feather"):
+        table_dir = os.path.join("tmp_tests", "data")
+        table_name = "data_by_images_normalized{}".format(ext)
+        if not os.path.exists(table_dir):
+            os.makedirs(table_dir)
+        write_table(df, os.path.join(table_dir, table_name))
+
+        save_dir = os.path.join(table_dir, "stream_splits_columnar")
+        index = stream_split_and_save(
+            table_name,
+            csv_dir=table_dir,
+            save_dir=save_dir,
+            splits=splits,
+            chunksize=100,
+            file_format="csv",
+            dtype={"cell_line": str},
+        )
+        assert index["rows"] == len(df)
+        assert split_membership(save_dir) == expected
+        for k, v in expected.items():
+            pd.testing.assert_frame_equal(
+                read_split(save_dir, k, dtype={"cell_line": str}),
+                df.iloc[v].reset_index(drop=True),
+                check_dtype=False,
+            )
@@ -0,0 +1,94 @@
+import os
+import random
+import numpy as np
+import pandas as pd
+
+from aicsimageio import OmeTifWriter
+from brightfield2fish.data.dataset import (
+    FishDataframeDatasetTIFF,
+    FishSegDataframeDatasetTIFF,
+)
+from brightfield2fish.data.stats_index import (
+    compute_stats_index,
+    load_stats_index,
+    percentile_key,
+)
+
+
+def _fake_manifest():
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    rows = []
+    for content in ("Brightfield", "DNA"):
+        fpath = os.path.join(fake_tiff_dir, "stats_{}.tiff".format(content))
+        arr = np.random.randint(
+            low=0, high=2 ** 16 - 1, size=(5, 6, 7), dtype=np.uint16
+        )
+        writer = OmeTifWriter(fpath, overwrite_file=True)
+        writer.save(arr)
+        rows += [
+            {
+                "file": "foo.czi",
+                "channel_content": content,
+                "normalized_single_channel_image": fpath,
+            }
+        ]
+    return pd.DataFrame(rows)
+
+
+def test_compute_stats_index():
+    df = _fake_manifest()
+    csv_path = os.path.join("tmp_tests", "stats.csv")
+    if os.path.exists(csv_path):
+        os.remove(csv_path)
+
+    df_stats = compute_stats_index(
+        df["normalized_single_channel_image"], csv_path=csv_path, max_workers=1
+    )
+    assert len(df_stats) == 2
+    assert percentile_key(99.99) in df_stats
+    assert percentile_key(99.99, "lower") in df_stats
+    assert percentile_key(99.99, "upper") in df_stats
+
+    # nothing changed, so nothing is recomputed
+    df_stats_again = compute_stats_index(
+        df["normalized_single_channel_image"], csv_path=csv_path, max_workers=1
+    )
+    assert df_stats_again.equals(pd.read_csv(csv_path, float_precision="round_trip"))
+
+    stats = load_stats_index(csv_path)
+    assert set(stats.keys()) == set(df["normalized_single_channel_image"])
+
+
+def test_datasets_with_stats(random_crop=(2, 3, 4)):
+    df = _fake_manifest()
+    csv_path = os.path.join("tmp_tests", "stats.csv")
+    compute_stats_index(
+        df["normalized_single_channel_image"], csv_path=csv_path, max_workers=1
+    )
+
+    dset = FishDataframeDatasetTIFF(df, random_crop=random_crop, crop_first=False)
+    dset_stats = FishDataframeDatasetTIFF(df, random_crop=random_crop, stats=csv_path)
+    for seed in range(3):
+        random.seed(seed)
+        sample = dset[0]
+        random.seed(seed)
+        sample_stats = dset_stats[0]
+        for a, b in zip(sample, sample_stats):
+            assert np.array_equal(a.numpy(), b.numpy())
+
+    df_seg = pd.DataFrame(
+        {
+            "probe name": ["DNA"],
+            "file": df["normalized_single_channel_image"][0],
+            "fish segmetation path": df["normalized_single_channel_image"][1],
+        }
+    )
+    dset = FishSegDataframeDatasetTIFF(df_seg, channel_content="DNA")
+    dset_stats = FishSegDataframeDatasetTIFF(
+        df_seg, channel_content="DNA", stats=csv_path
+    )
+    for a, b in zip(dset[0], dset_stats[0]):
+        assert np.allclose(a.numpy(), b.numpy(), atol=1e-5)
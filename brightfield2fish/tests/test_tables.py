@@ -0,0 +1,96 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+from brightfield2fish.data.tables import (
+    dictionary_encode,
+    iter_table,
+    read_table,
+    table_format,
+    write_table,
+)
+
+
+def _fake_manifest(n=12):
+    return pd.DataFrame(
+        {
+            "file": ["/path/to/image_{}.czi".format(i // 4) for i in range(n)],
+            "channel_index": [i % 4 for i in range(n)],
+            "channel_content": [
+                ("Brightfield", "DNA", "FISH", "CAAX")[i % 4] for i in range(n)
+            ],
+            "normalized_single_channel_image": [
+                "/path/to/image_{}_channel_{}.tif".format(i // 4, i % 4)
+                for i in range(n)
+            ],
+        }
+    )
+
+
+def test_table_format():
+    assert table_format("foo.csv") == "csv"
+    assert table_format("foo.PARQUET") == "parquet"
+    assert table_format("foo.arrow") == "feather"
+    assert table_format("foo.txt") == "csv"
+
+
+def test_dictionary_encode():
+    df = dictionary_encode(_fake_manifest())
+    assert isinstance(df["file"].dtype, pd.CategoricalDtype)
+    assert isinstance(df["channel_content"].dtype, pd.CategoricalDtype)
+    assert df["normalized_single_channel_image"].dtype == object
+
+
+def test_csv_table():
+    fpath = os.path.join("tmp_tests", "manifest.csv")
+    df = _fake_manifest()
+    write_table(df, fpath)
+    pd.testing.assert_frame_equal(read_table(fpath), df)
+
+    chunks = list(iter_table(fpath, chunksize=5))
+    assert [len(c) for c in chunks] == [5, 5, 2]
+    pd.testing.assert_frame_equal(pd.concat(chunks), df)
+
+
+def test_columnar_tables():
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    df = _fake_manifest()
+    for ext in (".parquet", ".feather"):
+        fpath = os.path.join("tmp_tests", "manifest" + ext)
+        write_table(df, fpath)
+
+        # repeated strings are stored dictionary encoded, unique ones aren't
+        if ext == ".parquet":
+            schema = pyarrow.parquet.read_schema(fpath)
+        else:
+            schema = pyarrow.ipc.open_file(fpath).schema
+        assert pyarrow.types.is_dictionary(schema.field("file").type)
+        assert pyarrow.types.is_dictionary(schema.field("channel_content").type)
+        assert pyarrow.types.is_string(
+            schema.field("normalized_single_channel_image").type
+        )
+
+        pd.testing.assert_frame_equal(read_table(fpath), df)
+        pd.testing.assert_frame_equal(
+            read_table(fpath, columns=["file", "channel_index"]),
+            df[["file", "channel_index"]],
+        )
+        df_cat = read_table(fpath, categorical=True)
+        assert isinstance(df_cat["channel_content"].dtype, pd.CategoricalDtype)
+        pd.testing.assert_frame_equal(df_cat.astype(df.dtypes.to_dict()), df)
+
+        chunks = list(iter_table(fpath, chunksize=5))
+        if ext == ".parquet":
+            assert [len(c) for c in chunks] == [5, 5, 2]
+        pd.testing.assert_frame_equal(pd.concat(chunks), df)
+
+
+def test_columnar_tables_without_pyarrow(monkeypatch):
+    monkeypatch.setitem(sys.modules, "pyarrow", None)
+    fpath = os.path.join("tmp_tests", "manifest_no_pyarrow.parquet")
+    with pytest.raises(ImportError, match="pip install pyarrow"):
+        write_table(_fake_manifest(), fpath)
+    assert not os.path.exists(fpath)
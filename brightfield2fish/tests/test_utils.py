@@ -1,17 +1,33 @@
 import os
+import tracemalloc
 import numpy as np
+import pytest
 import torch
 from aicsimageio import AICSImage, OmeTifWriter
 
+from brightfield2fish.data.chunked import ChunkedVolume, write_chunked
 from brightfield2fish.data.utils import (
     normalize_image_zero_one,
     normalize_image_center_scale,
     normalize_image_zero_one_torch,
     normalize,
+    normalize_torch,
+    normalize_into,
+    volume_stats,
+    volume_stats_torch,
+    percentile,
+    percentile_neighbours,
+    percentile_torch,
+    median,
+    median_torch,
     float_to_uint,
+    float_to_uint_torch,
     prep_fish,
+    prep_fish_blocks,
+    prep_fish_torch,
     plot_prepped,
     RandomCrop,
+    to_tensor,
 )
 
 
@@ -29,6 +45,28 @@ def test_normalize_image_zero_one_torch():
     )
 
 
+def test_normalize_torch(batch_size=3):
+    im = np.random.randn(batch_size, 10, 20, 30)
+    for content in ("Brightfield", "Fluor"):
+        # per sample normalization of a batch
+        expected = np.stack([normalize(a, content=content) for a in im])
+        im_norm = normalize_torch(torch.from_numpy(im), content=content, batch_dims=1)
+        assert np.allclose(im_norm.numpy(), expected)
+
+        # with whole volume stats, as for crops
+        stats = volume_stats_torch(torch.from_numpy(im), batch_dims=1)
+        for k, v in stats.items():
+            assert np.allclose(v.numpy(), [volume_stats(a)[k] for a in im])
+        crop = torch.from_numpy(im[:, :2, :3, :4])
+        im_norm = normalize_torch(crop, content=content, stats=stats, batch_dims=1)
+        stats_0 = {k: v[0].item() for k, v in stats.items()}
+        expected = normalize(im[0, :2, :3, :4], content=content, stats=stats_0)
+        assert np.allclose(im_norm[0].numpy(), expected)
+
+    im_norm = normalize_image_zero_one_torch(torch.zeros(2, 3), batch_dims=1)
+    assert torch.equal(im_norm, torch.zeros(2, 3))
+
+
 def test_normalize_image_center_scale():
     im = np.random.randn(10, 20, 30)
     im_norm = normalize_image_center_scale(im)
@@ -45,6 +83,109 @@ def test_normalize():
     assert np.isclose(np.mean(im_norm_bf), 0) and np.isclose(np.std(im_norm_bf), 1)
 
 
+def test_volume_stats():
+    im = np.random.randint(low=0, high=2 ** 16 - 1, size=(10, 20, 30), dtype=np.uint16)
+    stats = volume_stats(im.astype(np.float64))
+    stats_by_slice = volume_stats(im, by_slice=True)
+    for k, v in stats.items():
+        assert np.isclose(stats_by_slice[k], v)
+
+
+def test_normalize_into():
+    im = np.random.randint(low=0, high=2 ** 16 - 1, size=(10, 20, 30), dtype=np.uint16)
+
+    for content in ("Brightfield", "Fluor"):
+        expected = normalize(im.astype(np.float64), content=content)
+        buf = np.empty(im.shape, dtype=np.float32)
+        im_norm = normalize_into(im, content=content, out=buf)
+        assert im_norm is buf
+        assert np.allclose(im_norm, expected, atol=1e-5)
+
+    # clip then normalize, as in FishSegDataframeDatasetTIFF
+    clip_percentiles = [0.01, 99.99]
+    expected = normalize(im.astype(np.float64)).astype(np.float32)
+    expected = np.clip(
+        expected,
+        a_min=np.percentile(expected, clip_percentiles[0]),
+        a_max=np.percentile(expected, clip_percentiles[1]),
+    )
+    expected = normalize(expected)
+    im_norm = normalize_into(im, clip_percentiles=clip_percentiles)
+    assert im_norm.dtype == np.float32
+    assert np.allclose(im_norm, expected, atol=1e-4)
+
+
+def test_percentile(q=[0, 0.01, 37.5, 50, 99.99, 100]):
+    for dtype in (np.uint16, np.uint8, np.int16):
+        info = np.iinfo(dtype)
+        for size in ((1,), (2, 3, 4), (5, 61, 67)):
+            arr = np.random.randint(low=info.min, high=info.max, size=size, dtype=dtype)
+            arr_f = arr.astype(np.float64)
+
+            # bit identical clip bounds, with no float copy
+            bounds = percentile(arr, q)
+            assert bounds.dtype == np.float64
+            assert np.array_equal(bounds, np.percentile(arr_f, q))
+            assert percentile(arr, 99.99) == np.percentile(arr_f, 99.99)
+
+            assert median(arr) == np.median(arr_f)
+            a_min, a_max = bounds[2], bounds[4]
+            assert median(arr, a_min, a_max) == np.median(np.clip(arr_f, a_min, a_max))
+
+    arr = np.random.rand(3, 4, 5)
+    assert np.array_equal(percentile(arr, q), np.percentile(arr, q))
+
+    # percentiles of the normalized image, from the order statistics of the raw one
+    arr = np.random.randint(low=0, high=2 ** 16 - 1, size=(5, 61, 67), dtype=np.uint16)
+    stats = volume_stats(arr.astype(np.float64))
+    for dtype in (np.float64, np.float32, np.float16):
+
+        def transform(x):
+            return normalize(x.astype(np.float64), stats=stats).astype(dtype)
+
+        bounds = percentile(arr, q, transform=transform)
+        expected = np.percentile(transform(arr), q)
+        assert bounds.dtype == expected.dtype
+        assert np.array_equal(bounds, expected)
+
+        # and from stored neighbouring order statistics, as in a stats index
+        neighbours = percentile_neighbours(arr, q).astype(np.float64)
+        assert np.array_equal(
+            percentile(arr, q, transform=transform, neighbours=neighbours), expected
+        )
+
+
+def test_percentile_torch(q=[0, 0.01, 37.5, 50, 99.99, 100]):
+    for dtype in (np.uint16, np.uint8, np.int16):
+        info = np.iinfo(dtype)
+        arr = np.random.randint(
+            low=info.min, high=info.max, size=(3, 5, 61, 67), dtype=dtype
+        )
+        arr_f = arr.astype(np.float64)
+
+        # bit identical to numpy, per sample
+        bounds = percentile_torch(torch.from_numpy(arr), q, batch_dims=1)
+        assert bounds.shape == (len(q), 3) and bounds.dtype == torch.float64
+        expected = np.stack([np.percentile(a, q) for a in arr_f], axis=-1)
+        assert np.array_equal(bounds.numpy(), expected)
+        assert percentile_torch(torch.from_numpy(arr[0]), 99.99).item() == percentile(
+            arr[0], 99.99
+        )
+
+        a_min, a_max = bounds[2], bounds[4]
+        medians = median_torch(torch.from_numpy(arr), a_min, a_max, batch_dims=1)
+        for a, m, lo, hi in zip(arr, medians.numpy(), a_min.numpy(), a_max.numpy()):
+            assert m == median(a, lo, hi)
+        assert median_torch(torch.from_numpy(arr[1])).item() == np.median(arr_f[1])
+
+
+def test_float_to_uint_torch():
+    arr_f = np.random.rand(10, 20, 30)
+    arr_f[0, 0, 0] = 1
+    arr_u = float_to_uint_torch(torch.from_numpy(arr_f), uint_dtype=torch.uint8)
+    assert np.array_equal(arr_u.numpy(), float_to_uint(arr_f, uint_dtype=np.uint8))
+
+
 def test_float_to_uint():
     arr_f = np.random.rand(10, 20, 30)
     arr_u = float_to_uint(arr_f)
@@ -59,7 +200,136 @@ def test_prep_fish():
     writer = OmeTifWriter(fpath, overwrite_file=True)
     writer.save(arr)
     im = AICSImage(fpath)
-    _ = prep_fish(im)
+    out = prep_fish(im)
+
+    # same as clipping and median subtracting a float64 copy
+    img3d = im.get_image_data("ZYX", T=0, C=1).astype(np.float64)
+    img3d = np.clip(img3d, np.percentile(img3d, 0), np.percentile(img3d, 99.99))
+    img3d -= np.median(img3d)
+    img3d[img3d < 0] = 0
+    img3d = float_to_uint(normalize_image_zero_one(img3d), uint_dtype=np.uint16)
+    assert np.array_equal(out, img3d)
+
+
+def test_prep_fish_blocks():
+    fpath = os.path.join("tmp_tests", "foo_blocks.ome.tiff")
+    arr = np.random.randint(
+        low=0, high=2 ** 16 - 1, size=(1, 2, 7, 4, 5), dtype=np.uint16
+    )
+    writer = OmeTifWriter(fpath, overwrite_file=True)
+    writer.save(arr)
+    im = AICSImage(fpath)
+
+    for block_z in (1, 3, 7, 10):
+        for median_subtract in (True, False):
+            kwargs = {
+                "clip_percentiles": [0.01, 99.9],
+                "median_subtract": median_subtract,
+            }
+            expected = prep_fish(im, **kwargs)
+            assert np.array_equal(prep_fish(im, block_z=block_z, **kwargs), expected)
+
+            kwargs["math_dtype"], kwargs["out_dtype"] = np.float32, np.float32
+            expected = prep_fish(im, **kwargs)
+            out = np.asarray(
+                prep_fish_blocks(
+                    im.get_image_data("ZYX", T=0, C=1), block_z=block_z, **kwargs
+                )
+            )
+            assert out.dtype == np.float32 and np.array_equal(out, expected)
+
+    # a constant volume
+    out = prep_fish_blocks(np.full((3, 4, 5), 7, dtype=np.uint8), block_z=2)
+    assert np.array_equal(np.asarray(out), np.zeros((3, 4, 5), dtype=np.uint16))
+
+    with pytest.raises(TypeError):
+        prep_fish_blocks(np.random.rand(3, 4, 5))
+
+
+def test_prep_fish_blocks_out_of_core(shape=(32, 256, 256), block_z=2):
+    fpath = os.path.join("tmp_tests", "foo_large.ome.tiff")
+    raw = np.random.randint(low=0, high=2 ** 12, size=shape, dtype=np.uint16)
+    writer = OmeTifWriter(fpath, overwrite_file=True)
+    writer.save(raw[np.newaxis, :, np.newaxis])
+    im = AICSImage(fpath)
+    im.get_image_data("ZYX", T=0, C=0)
+
+    tracemalloc.start()
+    expected = prep_fish(im, channel=0)
+    peak_in_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    # read from disk, normalized and written a block at a time
+    raw_path = os.path.join("tmp_tests", "foo_raw.cvol")
+    write_chunked(raw_path, raw, chunks=(block_z, 256, 256), codec="none")
+    out_path = os.path.join("tmp_tests", "foo_prepped.cvol")
+    tracemalloc.start()
+    write_chunked(
+        out_path,
+        prep_fish_blocks(ChunkedVolume(raw_path), block_z=block_z),
+        chunks=(block_z, 64, 64),
+    )
+    peak_blocks = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert np.array_equal(ChunkedVolume(out_path).read(), expected)
+    assert peak_blocks < peak_in_memory / 8
+
+
+def test_prep_fish_torch():
+    fpath = os.path.join("tmp_tests", "foo_torch.ome.tiff")
+    arr = np.random.randint(
+        low=0, high=2 ** 16 - 1, size=(1, 3, 4, 50, 60), dtype=np.uint16
+    )
+    writer = OmeTifWriter(fpath, overwrite_file=True)
+    writer.save(arr)
+    im = AICSImage(fpath)
+
+    # all channels at once, identical to prep_fish per channel
+    out = prep_fish_torch(
+        torch.from_numpy(im.get_image_data("CZYX", T=0)), batch_dims=1
+    )
+    assert out.dtype == torch.uint16
+    for c in range(3):
+        assert np.array_equal(out[c].numpy(), prep_fish(im, channel=c))
+
+    raw = torch.from_numpy(im.get_image_data("ZYX", T=0, C=1))
+    out = prep_fish_torch(
+        raw, clip_percentiles=[1, 99], median_subtract=False, out_dtype=torch.uint8
+    )
+    expected = prep_fish(
+        im, clip_percentiles=[1, 99], median_subtract=False, out_dtype=np.uint8
+    )
+    assert np.array_equal(out.numpy(), expected)
+
+
+def test_prep_fish_torch_without_uint16(monkeypatch):
+    raw = np.random.randint(low=0, high=2 ** 16 - 1, size=(4, 50, 60), dtype=np.uint16)
+    expected = prep_fish_torch(torch.from_numpy(raw))
+
+    # torch before 2.3 has no uint16, so the default output holds its range in int32
+    monkeypatch.delattr(torch, "uint16")
+    out = prep_fish_torch(torch.from_numpy(raw))
+    assert out.dtype == torch.int32
+    assert np.array_equal(out.numpy(), expected.numpy())
+
+
+def test_to_tensor(monkeypatch):
+    a = np.random.randint(low=0, high=2 ** 16 - 1, size=(4, 5), dtype=np.uint16)
+    assert to_tensor(a).dtype == torch.uint16
+
+    # torch before 2.3 can't wrap uint16, which is widened losslessly instead
+    from_numpy = torch.from_numpy
+
+    def old_from_numpy(a):
+        if a.dtype == np.uint16:
+            raise TypeError("can't convert np.ndarray of type numpy.uint16")
+        return from_numpy(a)
+
+    monkeypatch.setattr(torch, "from_numpy", old_from_numpy)
+    t = to_tensor(a)
+    assert t.dtype == torch.int32
+    assert np.array_equal(t.numpy(), a)
 
 
 def test_plot_prepped():
@@ -0,0 +1,44 @@
+import os
+import numpy as np
+import pandas as pd
+
+from aicsimageio import OmeTifWriter
+from brightfield2fish.data.dataset import FishDataframeDatasetTIFF, read_zyx
+from brightfield2fish.data.volume_store import convert_to_store, VolumeStore
+
+
+def test_convert_to_store():
+    fake_tiff_dir = os.path.join("tmp_tests", "fake_tiffs")
+    store_dir = os.path.join("tmp_tests", "volume_store")
+    if not os.path.exists(fake_tiff_dir):
+        os.makedirs(fake_tiff_dir)
+
+    rows = []
+    for content in ("Brightfield", "DNA"):
+        fpath = os.path.join(fake_tiff_dir, "store_{}.tiff".format(content))
+        arr = np.random.randint(
+            low=0, high=2 ** 16 - 1, size=(1, 1, 2, 3, 4), dtype=np.uint16
+        )
+        writer = OmeTifWriter(fpath, overwrite_file=True)
+        writer.save(arr)
+        rows += [
+            {
+                "file": "foo.czi",
+                "channel_content": content,
+                "normalized_single_channel_image": fpath,
+            }
+        ]
+    df = pd.DataFrame(rows)
+
+    index = convert_to_store(df, store_dir, overwrite=True, max_workers=1)
+    assert len(index) == 2
+
+    store = VolumeStore(store_dir)
+    for fpath in df["normalized_single_channel_image"]:
+        assert store.shape(fpath) == (2, 3, 4)
+        assert np.array_equal(store.read(fpath), read_zyx(fpath))
+
+    dset = FishDataframeDatasetTIFF(df, channel_content="DNA")
+    dset_store = FishDataframeDatasetTIFF(df, channel_content="DNA", store=store_dir)
+    for a, b in zip(dset[0], dset_store[0]):
+        assert np.array_equal(a.numpy(), b.numpy())
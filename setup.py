@@ -26,6 +26,9 @@ requirements = [
 
 setup_requirements = ["pytest-runner"]
 
+# parquet and feather tables, see brightfield2fish.data.tables
+pyarrow_requirements = ["pyarrow>=3.0"]
+
 test_requirements = [
     "pip>=19.0.3",
     "bumpversion>=0.5.3",
@@ -39,7 +42,7 @@ test_requirements = [
     "pytest-cov>=2.6.1",
     "pytest-raises>=0.10",
     "pytest-runner>=4.4",
-]
+] + pyarrow_requirements
 
 dev_requirements = [
     "altair",
@@ -50,12 +53,13 @@ dev_requirements = [
     "pre-commit",
     "scikit-learn",
     "tox",
-]
+] + pyarrow_requirements
 
 extra_requirements = {
     "test": test_requirements,
     "setup": setup_requirements,
     "dev": dev_requirements,
+    "pyarrow": pyarrow_requirements,
     "all": test_requirements + setup_requirements + dev_requirements,
 }
 
@@ -71,7 +75,9 @@ setup(
         "Programming Language :: Python :: 3.7",
     ],
     description="translate brightfield images to and from FISH assay",
-    entry_points={"console_scripts": []},
+    entry_points={
+        "console_scripts": ["brightfield2fish=brightfield2fish.bin.cli:main"]
+    },
     install_requires=requirements,
     license="Allen Institute Software License",
     long_description=readme + "\n\n" + history,